@@ -0,0 +1,170 @@
+""" Times each phase of the pipeline at several data scales.
+
+For every scale a synthetic dataset is generated with
+`scripts.generate_data`, and the steps of `sparkify_redshift.main` are run
+one statement at a time on the local DuckDB backend: creating the tables,
+each staging COPY and each star-schema insert. The timings are written as
+JSON and, given a stored baseline, any step that got slower by more than the
+tolerance is flagged as a regression.
+
+Typical Usage example:
+    $ python3 -m benchmarks.etl_benchmark -o results.json [-b baseline.json]
+        [--scales 1,5,20] [--tolerance 0.25]
+"""
+import os
+import sys
+import copy
+import json
+import time
+import getopt
+import tempfile
+from scripts.generate_data import generate
+from scripts.create_tables import drop_tables, create_tables
+from scripts.etl import plan_staging, load_staging_tables, insert_tables, \
+    copy_target, CFG_FILE
+from scripts.sql_queries import insert_table_steps, insert_table_dependencies
+from scripts.scheduler import topological_order
+from scripts.time_dimension import extend_time_dimension
+from scripts.db import connect
+
+# Data generated for a scale of 1; other scales multiply these
+BASE_SCALE = {'n_songs': 500, 'n_users': 50, 'n_events': 5000, 'days': 10}
+# Regressions smaller than this many seconds are treated as noise
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def generate_scale(config, scale, work_dir, seed=0):
+    """ Generates a dataset at one scale for the local backend
+
+    Args:
+        config: a dict of the loaded json config
+        scale: Int, multiplier of `BASE_SCALE`
+        work_dir: String, directory for the generated data and DB file
+        seed: Int, random seed for the generated data
+
+    Returns:
+        a copy of `config` that runs on the generated data locally
+    """
+    config = copy.deepcopy(config)
+    config['ETL']['BACKEND'] = 'local'
+    config['ETL']['SONG_MANIFESTS'] = 'false'
+    config['COMPACTION']['ENABLED'] = 'false'
+    config['PARQUET']['ENABLED'] = 'false'
+    config['LOCAL']['DATA_DIR'] = os.path.join(work_dir, 'data')
+    config['LOCAL']['DB_PATH'] = os.path.join(work_dir, 'sparkify.duckdb')
+
+    sizes = {key: value * scale if key != 'days' else value
+             for key, value in BASE_SCALE.items()}
+    generate(config['LOCAL']['DATA_DIR'], seed=seed, **sizes)
+    return config
+
+
+def benchmark_scale(config, scale, work_dir, seed=0):
+    """ Generates a dataset at one scale and times each pipeline step on it
+
+    Args:
+        config: a dict of the loaded json config
+        scale: Int, multiplier of `BASE_SCALE`
+        work_dir: String, directory for the generated data and DB file
+        seed: Int, random seed for the generated data
+
+    Returns:
+        dict of step name to seconds
+    """
+    config = generate_scale(config, scale, work_dir, seed)
+
+    conn = connect(config)
+    cur = conn.cursor()
+    timings = {
+        'drop_tables': timed(drop_tables, cur, conn),
+        'create_tables': timed(create_tables, cur, conn),
+    }
+
+    copy_queries, log_keys = plan_staging(cur, config, full_refresh=True)
+    for query in copy_queries:
+        timings['copy ' + copy_target(query)] = timed(
+            load_staging_tables, cur, conn, [query])
+
+    timings['insert times'] = timed(extend_time_dimension, cur, config)
+    conn.commit()
+    for step in topological_order(insert_table_dependencies):
+        timings['insert ' + step] = timed(
+            insert_tables, cur, conn, [insert_table_steps[step]])
+
+    conn.close()
+    timings['total'] = sum(timings.values())
+    return timings
+
+
+def find_regressions(results, baseline, tolerance):
+    """ Compares benchmark results with a stored baseline
+
+    Args:
+        results: dict of scale to a dict of step name to seconds
+        baseline: a previous `results` dict
+        tolerance: Float, allowed slowdown as a fraction, e.g. 0.25 for 25%
+
+    Returns:
+        list of dicts describing each step that got slower than allowed
+    """
+    regressions = []
+    for scale, timings in results.items():
+        for step, seconds in timings.items():
+            before = baseline.get(scale, {}).get(step)
+            if before is None:
+                continue
+            if seconds > before * (1 + tolerance) and \
+                    seconds - before > MIN_REGRESSION_SECONDS:
+                regressions.append({'scale': scale, 'step': step,
+                                    'baseline': before, 'seconds': seconds})
+    return regressions
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "o:b:", ["scales=", "tolerance=",
+                                                  "seed="])
+    except getopt.GetoptError:
+        print("USAGE: etl_benchmark.py -o <results.json> [-b <baseline.json>]"
+              " [--scales 1,5,20] [--tolerance 0.25] [--seed 0]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    results = {}
+    for scale in opts.get('--scales', '1,5').split(','):
+        with tempfile.TemporaryDirectory() as work_dir:
+            results[scale] = benchmark_scale(config, int(scale), work_dir,
+                                             int(opts.get('--seed', 0)))
+        print("Scale {}: {:.2f}s total".format(scale,
+                                                results[scale]['total']))
+        for step, seconds in results[scale].items():
+            print("    {:<28}{:>8.3f}s".format(step, seconds))
+
+    if '-o' in opts:
+        with open(opts['-o'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if '-b' in opts:
+        with open(opts['-b']) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(
+            results, baseline, float(opts.get('--tolerance', 0.25)))
+        for r in regressions:
+            print("REGRESSION at scale {scale}: {step} took {seconds:.3f}s, "
+                  "baseline {baseline:.3f}s".format(**r))
+        if regressions:
+            sys.exit(1)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,108 @@
+""" Compares the raw JSON inputs with their Parquet conversions.
+
+For each dataset under a local data directory (laid out like the S3 bucket,
+with `song_data/` and `log_data/` sub-directories) this reports the bytes on
+disk and the time it takes to parse every record, as JSON and as Parquet.
+Parsing the JSON includes the type coercion COPY would have to do.
+
+Typical Usage example:
+    $ python3 -m benchmarks.parquet_vs_json -d <data_dir> [-o results.json]
+"""
+import os
+import sys
+import json
+import time
+import getopt
+import tempfile
+import pyarrow.parquet as pq
+from scripts.convert_parquet import DATASETS, coerce, iter_local_lines, \
+    convert_lines
+
+
+def directory_bytes(path, suffix):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(path)
+               for name in files if name.endswith(suffix))
+
+
+def parse_json(path, dataset):
+    """ Parses and type-coerces every JSON record, returning the row count """
+    schema, fields = DATASETS[dataset]
+    rows = 0
+    for line in iter_local_lines(path):
+        if line.strip():
+            record = json.loads(line)
+            [coerce(record.get(name), field.type)
+             for field, name in zip(schema, fields)]
+            rows += 1
+    return rows
+
+
+def benchmark_dataset(data_dir, dataset, out_dir):
+    """ Measures one dataset as JSON and as Parquet
+
+    Args:
+        data_dir: String, local directory holding the dataset
+        dataset: String, `log_data` or `song_data`
+        out_dir: String, directory to write the Parquet files to
+
+    Returns:
+        dict of measurements
+    """
+    path = os.path.join(data_dir, dataset)
+    start = time.time()
+    rows = parse_json(path, dataset)
+    json_seconds = time.time() - start
+
+    start = time.time()
+    convert_lines(iter_local_lines(path), dataset, out_dir)
+    convert_seconds = time.time() - start
+
+    start = time.time()
+    table = pq.read_table(out_dir)
+    parquet_seconds = time.time() - start
+    assert table.num_rows == rows
+
+    json_bytes = directory_bytes(path, '.json')
+    parquet_bytes = directory_bytes(out_dir, '.parquet')
+    return {
+        'rows': rows,
+        'json_bytes': json_bytes,
+        'parquet_bytes': parquet_bytes,
+        'bytes_ratio': parquet_bytes / json_bytes if json_bytes else None,
+        'json_parse_seconds': json_seconds,
+        'parquet_read_seconds': parquet_seconds,
+        'convert_seconds': convert_seconds,
+    }
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "d:o:")
+    except getopt.GetoptError:
+        print("USAGE: parquet_vs_json.py -d <data_dir> [-o <results.json>]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for dataset in DATASETS:
+            results[dataset] = benchmark_dataset(
+                opts['-d'], dataset, os.path.join(tmp, dataset))
+
+    for dataset, result in results.items():
+        print("{}: {} rows, JSON {:.1f} KB parsed in {:.3f}s, Parquet {:.1f} "
+              "KB ({:.0%}) read in {:.3f}s".format(
+                  dataset, result['rows'], result['json_bytes'] / 1024,
+                  result['json_parse_seconds'],
+                  result['parquet_bytes'] / 1024, result['bytes_ratio'] or 0,
+                  result['parquet_read_seconds']))
+
+    if '-o' in opts:
+        with open(opts['-o'], 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,135 @@
+""" Compares the songplays insert before and after the match-key join.
+
+The original insert joined `staging_songs` to all of `staging_events` on the
+free-text title and artist name columns. The current one first builds
+`staging_events_keyed` (NextSong events only) and `staging_songs_keyed`,
+both distributed and sorted on a hash of the normalized title and artist,
+and joins on that key. For each scale of generated data this times both
+versions on the local backend and checks that they insert the same number
+of rows.
+
+Typical Usage example:
+    $ python3 -m benchmarks.songplays_join [-o results.json] [--scales 1,5]
+"""
+import sys
+import json
+import time
+import getopt
+import tempfile
+from scripts.create_tables import drop_tables, create_tables
+from scripts.etl import plan_staging, load_staging_tables, CFG_FILE
+from scripts.sql_queries import songplay_table_insert, \
+    staging_events_keyed_insert, staging_songs_keyed_insert
+from scripts.db import connect
+from benchmarks.etl_benchmark import generate_scale
+
+# The songplays insert as it was before the match key
+legacy_songplay_table_insert = ("""
+INSERT INTO songplays (
+    user_id,
+    start_time,
+    level,
+    song_id,
+    artist_id,
+    session_id,
+    location,
+    user_agent
+)
+SELECT DISTINCT
+    s_events.user_id,
+    s_events.ts,
+    s_events.level,
+    s_songs.song_id,
+    s_songs.artist_id,
+    s_events.session_id,
+    s_events.location,
+    s_events.user_agent
+FROM staging_songs s_songs
+    JOIN staging_events s_events
+        ON s_songs.title = s_events.song_title
+           AND s_songs.artist_name = s_events.artist_name;
+""")
+
+
+def time_inserts(cur, conn, queries):
+    """ Runs queries into an emptied songplays table
+
+    Returns:
+        seconds: Float, time taken by the queries
+        rows: Int, number of rows in songplays afterwards
+    """
+    cur.execute("DELETE FROM songplays;")
+    conn.commit()
+    start = time.time()
+    for query in queries:
+        cur.execute(query)
+    conn.commit()
+    seconds = time.time() - start
+    cur.execute("SELECT COUNT(*) FROM songplays;")
+    return seconds, cur.fetchone()[0]
+
+
+def compare_songplays(config):
+    """ Loads the staging tables and runs both versions of the songplays
+    insert on them
+
+    Args:
+        config: a dict of the loaded json config, for the local backend
+
+    Returns:
+        dict with the `before` and `after` seconds and row counts, and
+        whether the row counts are `equivalent`
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    copy_queries, log_keys = plan_staging(cur, config, full_refresh=True)
+    load_staging_tables(cur, conn, copy_queries)
+
+    before_seconds, before_rows = time_inserts(
+        cur, conn, [legacy_songplay_table_insert])
+    after_seconds, after_rows = time_inserts(
+        cur, conn, [staging_events_keyed_insert, staging_songs_keyed_insert,
+                    songplay_table_insert])
+    conn.close()
+    return {'before': {'seconds': before_seconds, 'rows': before_rows},
+            'after': {'seconds': after_seconds, 'rows': after_rows},
+            'equivalent': before_rows == after_rows}
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "o:", ["scales=", "seed="])
+    except getopt.GetoptError:
+        print("USAGE: songplays_join.py [-o <results.json>] "
+              "[--scales 1,5] [--seed 0]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    results = {}
+    for scale in opts.get('--scales', '1,5').split(','):
+        with tempfile.TemporaryDirectory() as work_dir:
+            results[scale] = compare_songplays(generate_scale(
+                config, int(scale), work_dir, int(opts.get('--seed', 0))))
+        result = results[scale]
+        print("Scale {}: before {:.3f}s ({} rows), after {:.3f}s ({} rows)"
+              .format(scale, result['before']['seconds'],
+                      result['before']['rows'], result['after']['seconds'],
+                      result['after']['rows']))
+
+    if '-o' in opts:
+        with open(opts['-o'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if not all(result['equivalent'] for result in results.values()):
+        print("Row counts differ between the two versions of the insert")
+        sys.exit(1)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,121 @@
+""" Compares committing every statement with committing each phase once.
+
+The drop, create, staging and insert phases of a full refresh are run on one
+pooled connection, first committing after every statement as the pipeline
+used to, then committing each phase in a single transaction, see
+`CONNECTIONS.SINGLE_TRANSACTION_PHASES`. For each phase the wall time and
+the number of commits are reported.
+
+By default the phases run on the local DuckDB backend over a synthetic
+dataset at each scale, as in `etl_benchmark.py`. Commits are cheap there, so
+the commit counts are the interesting part; with `--redshift` the phases run
+against the configured cluster and S3 data, where every commit is serialized
+across the cluster.
+
+Typical Usage example:
+    $ python3 -m benchmarks.transactions [-o results.json] [--scales 1,5]
+    $ python3 -m benchmarks.transactions --redshift
+"""
+import sys
+import json
+import time
+import getopt
+import tempfile
+from benchmarks.etl_benchmark import generate_scale
+from scripts.create_tables import drop_tables, create_tables
+from scripts.etl import plan_staging, load_staging_tables, insert_tables, \
+    CFG_FILE
+from scripts.sql_queries import insert_table_steps, insert_table_dependencies
+from scripts.scheduler import topological_order
+from scripts.time_dimension import extend_time_dimension
+from scripts.db import connect, get_pool
+
+MODES = {'statement': False, 'phase': True}
+
+
+def benchmark_phases(config, single):
+    """ Runs a full refresh one phase at a time on one connection
+
+    Args:
+        config: a dict of the loaded json config
+        single: Bool, commit each phase once rather than every statement
+
+    Returns:
+        dict of phase name to a dict of its `seconds` and `commits`
+    """
+    pool = get_pool(config)
+    conn = connect(config)
+    cur = conn.cursor()
+    results = {}
+
+    def run_phase(phase, fn, *args):
+        commits = pool.commits
+        start = time.time()
+        fn(*args)
+        results[phase] = {'seconds': time.time() - start,
+                          'commits': pool.commits - commits}
+
+    order = topological_order(insert_table_dependencies)
+    run_phase('drop_tables', drop_tables, cur, conn, None, None, single)
+    run_phase('create_tables', create_tables, cur, conn, None, None, single)
+    copy_queries, log_keys = plan_staging(cur, config, full_refresh=True)
+    run_phase('staging', load_staging_tables, cur, conn, copy_queries, None,
+              None, single)
+    run_phase('times', extend_time_dimension, cur, config)
+    run_phase('insert', insert_tables, cur, conn,
+              [insert_table_steps[step] for step in order], None, None,
+              order, single)
+    conn.close()
+
+    results['total'] = {
+        key: sum(phase[key] for phase in results.values())
+        for key in ('seconds', 'commits')}
+    return results
+
+
+def print_comparison(label, results):
+    print(label)
+    print("    {:<16}{:>23}{:>23}".format('', 'per statement', 'per phase'))
+    for phase in results['statement']:
+        before, after = results['statement'][phase], results['phase'][phase]
+        print("    {:<16}{:>9.3f}s {:>4} commits{:>9.3f}s {:>4} "
+              "commits".format(phase, before['seconds'], before['commits'],
+                               after['seconds'], after['commits']))
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "o:", ["scales=", "seed=",
+                                                "redshift"])
+    except getopt.GetoptError:
+        print("USAGE: transactions.py [-o <results.json>] [--scales 1,5] "
+              "[--seed 0] [--redshift]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    results = {}
+    if '--redshift' in opts:
+        results['redshift'] = {mode: benchmark_phases(config, single)
+                               for mode, single in MODES.items()}
+        print_comparison("Redshift:", results['redshift'])
+    else:
+        for scale in opts.get('--scales', '1,5').split(','):
+            results[scale] = {}
+            for mode, single in MODES.items():
+                with tempfile.TemporaryDirectory() as work_dir:
+                    results[scale][mode] = benchmark_phases(
+                        generate_scale(config, int(scale), work_dir,
+                                       int(opts.get('--seed', 0))), single)
+            print_comparison("Scale {}:".format(scale), results[scale])
+
+    if '-o' in opts:
+        with open(opts['-o'], 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,178 @@
+"""
+A small client for analytical queries that caches their results on disk.
+
+Results are cached per normalized SQL statement, its parameters and the
+warehouse's load version, which `etl()` bumps in the same transaction as
+every load. The version is taken together with the time it was loaded, as
+recreating the tables starts the version numbers over. A cached result is
+therefore reused until new data is loaded, and entries of older load
+versions are never hit again and age out. Each result is stored as an Arrow
+IPC file, which is memory-mapped back without any parsing. Least recently
+used entries are evicted once the cache grows past `ANALYTICS.CACHE_MAX_MB`.
+
+Typical Usage example:
+    client = AnalyticsClient(config)
+    rows = client.query("SELECT COUNT(*) FROM songplays")
+"""
+import os
+import re
+import json
+import hashlib
+import pyarrow as pa
+from scripts.db import connect
+from scripts.sql_queries import load_version_latest_select
+
+CACHE_SUFFIX = '.arrow'
+
+
+def normalize_sql(query):
+    """ Normalizes a statement so trivially different spellings share a
+    cache entry: comments are dropped, whitespace collapsed, trailing
+    semicolons removed and everything outside quotes lower-cased
+
+    Args:
+        query: String SQL statement
+
+    Returns:
+        String
+    """
+    parts = re.split(r"('(?:[^']|'')*'|\"[^\"]*\")", query)
+    normalized = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            normalized.append(part)
+        else:
+            part = re.sub(r'--[^\n]*', ' ', part)
+            part = re.sub(r'/\*.*?\*/', ' ', part, flags=re.DOTALL)
+            normalized.append(re.sub(r'\s+', ' ', part).lower())
+    return ''.join(normalized).strip().rstrip(';').strip()
+
+
+def cache_key(query, params, version):
+    """ Hashes a normalized statement, its parameters and a load version
+    with the time it was loaded """
+    text = json.dumps([normalize_sql(query), params, version], default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def rows_to_table(rows, description):
+    """ Builds an Arrow table from DB-API rows and a cursor description """
+    names = [column[0] for column in description]
+    arrays = [pa.array([row[i] for row in rows]) for i in range(len(names))]
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def table_to_rows(table):
+    """ Turns an Arrow table back into a list of row tuples """
+    return list(zip(*[column.to_pylist() for column in table.columns]))
+
+
+class AnalyticsClient:
+    """ Runs analytical queries through a local on-disk result cache.
+
+    Attributes:
+        cache_dir: String, directory the cached results are kept in
+        max_bytes: Int, size the cache is evicted down to
+        hits: Int, number of queries answered from the cache
+        misses: Int, number of queries run on the warehouse
+    """
+
+    def __init__(self, config, cache_dir=None, max_bytes=None):
+        """
+        Args:
+            config: a dict of the loaded json config
+            cache_dir: String, defaults to `ANALYTICS.CACHE_DIR`
+            max_bytes: Int, defaults to `ANALYTICS.CACHE_MAX_MB`
+        """
+        settings = config['ANALYTICS']
+        self.config = config
+        self.cache_dir = cache_dir or settings['CACHE_DIR']
+        self.max_bytes = max_bytes if max_bytes is not None else \
+            int(settings['CACHE_MAX_MB']) * 1024 ** 2
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def connection(self):
+        if self._conn is None:
+            self._conn = connect(self.config, 'dashboard')
+        return self._conn
+
+    def load_version(self):
+        """ Returns the warehouse's current load version and the time it was
+        loaded, or (0, None) before the first load """
+        cur = self.connection().cursor()
+        cur.execute(load_version_latest_select)
+        version = cur.fetchone() or (0, None)
+        self.connection().rollback()
+        return tuple(version)
+
+    def query_table(self, query, params=None):
+        """ Runs a query, or loads its cached result
+
+        Args:
+            query: String SQL statement
+            params: optional query parameters
+
+        Returns:
+            a pyarrow Table of the result
+        """
+        path = os.path.join(self.cache_dir, cache_key(
+            query, params, self.load_version()) + CACHE_SUFFIX)
+        if os.path.exists(path):
+            self.hits += 1
+            os.utime(path)
+            # The table keeps the memory map open for as long as it is used
+            return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+        self.misses += 1
+        cur = self.connection().cursor()
+        cur.execute(query, params)
+        table = rows_to_table(cur.fetchall(), cur.description)
+        self.connection().rollback()
+
+        tmp_path = path + '.tmp'
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+        self.evict()
+        return table
+
+    def query(self, query, params=None):
+        """ Like `query_table`, but returns a list of row tuples, like a
+        cursor's fetchall() """
+        return table_to_rows(self.query_table(query, params))
+
+    def evict(self):
+        """ Deletes the least recently used results until the cache fits in
+        `max_bytes`
+
+        Returns:
+            Int, the number of results deleted
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        evicted = 0
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+            evicted += 1
+        return evicted
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
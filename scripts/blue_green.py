@@ -0,0 +1,225 @@
+"""
+Rebuilds the warehouse in a shadow schema and swaps it in atomically, so
+readers never see empty, half loaded or locked tables.
+
+With `BLUE_GREEN.ENABLED`, the warehouse lives in `BLUE_GREEN.SCHEMA` and
+every connection from `db.connect` reads it through its search_path. A full
+refresh then never touches those tables. Instead:
+
+    1. `BLUE_GREEN.SHADOW_SCHEMA` is dropped and created afresh
+    2. the full star schema is created and loaded in it, by the usual
+       `create_db_tables()` and `etl()` on connections pointed at it
+    3. the shadow is validated: the fact and dimension tables must have rows,
+       songplays at least `BLUE_GREEN.MIN_ROW_RATIO` of the live row count,
+       and the rollups must match a recomputation
+    4. in one transaction, the live schema is renamed to
+       `BLUE_GREEN.PREVIOUS_SCHEMA` and the shadow to the live schema
+
+Readers keep using the old tables until the swap commits, and see the new
+ones from their next statement on. The previous version is kept until the
+next rebuild, so `--rollback` can swap it back in at once. A shadow that
+fails validation is left in place to be looked into, and the live schema is
+not touched.
+
+Incremental runs load the live schema directly. Either way, new songplays
+are first built in staging_songplays and then moved into songplays with
+ALTER TABLE APPEND, see `etl.append_songplays`.
+
+Typical Usage example:
+    $ python3 sparkify_redshift.py --full-refresh
+    $ python3 -m scripts.blue_green --rollback
+"""
+import sys
+import json
+import time
+import getopt
+from scripts.db import connect, warehouse_schema, schema_create
+from scripts.create_tables import create_db_tables
+from scripts.etl import etl
+from scripts.rollups import check_rollups
+from scripts.metrics import execute
+from scripts.checkpoints import skip, commit
+
+CFG_FILE = 'dwh_config.json'
+
+# Tables a validated build must have rows in
+REQUIRED_TABLES = ['songplays', 'users', 'songs', 'artists', 'times']
+
+schema_drop = "DROP SCHEMA IF EXISTS {} CASCADE;"
+schema_rename = "ALTER SCHEMA {} RENAME TO {};"
+schema_exists_select = ("""
+SELECT COUNT(*)
+FROM information_schema.schemata
+WHERE schema_name = %s;
+""")
+table_exists_select = ("""
+SELECT COUNT(*)
+FROM information_schema.tables
+WHERE table_schema = %s
+    AND table_name = %s;
+""")
+
+
+def schema_config(config, schema):
+    """ Returns a copy of the config whose connections use another schema """
+    return dict(config, BLUE_GREEN=dict(config['BLUE_GREEN'], SCHEMA=schema))
+
+
+def schema_exists(cur, schema):
+    cur.execute(schema_exists_select, (schema,))
+    return cur.fetchone()[0] > 0
+
+
+def table_exists(cur, schema, table):
+    cur.execute(table_exists_select, (schema, table))
+    return cur.fetchone()[0] > 0
+
+
+def table_rows(cur, table):
+    cur.execute("SELECT COUNT(*) FROM {};".format(table))
+    return cur.fetchone()[0]
+
+
+def validate_shadow(config):
+    """ Checks a freshly built shadow schema before it is swapped in
+
+    Args:
+        config: a dict of the loaded json config
+
+    Returns:
+        list of String problems, empty if the shadow can be swapped in
+    """
+    settings = config['BLUE_GREEN']
+    problems = []
+    conn = connect(schema_config(config, settings['SHADOW_SCHEMA']))
+    cur = conn.cursor()
+    rows = {table: table_rows(cur, table) for table in REQUIRED_TABLES}
+    problems += ["{} is empty".format(table)
+                 for table in REQUIRED_TABLES if not rows[table]]
+    mismatches = check_rollups(cur, config['ROLLUPS'])
+    problems += ["{} differs from songplays in {} groups".format(
+        name, len(groups)) for name, groups in mismatches.items() if groups]
+
+    if table_exists(cur, settings['SCHEMA'], 'songplays'):
+        cur.execute("SELECT COUNT(*) FROM {}.songplays;".format(
+            settings['SCHEMA']))
+        live_rows = cur.fetchone()[0]
+        if rows['songplays'] < live_rows * float(settings['MIN_ROW_RATIO']):
+            problems.append(
+                "songplays has {} rows, under {} of the {} live rows".format(
+                    rows['songplays'], settings['MIN_ROW_RATIO'],
+                    live_rows))
+    conn.close()
+    return problems
+
+
+def swap_schemas(config, report=None, checkpoints=None, rollback=False):
+    """ Swaps the shadow, or on rollback the previous, schema in for the
+    live one, in one transaction
+
+    Args:
+        config: a dict of the loaded json config
+        report: a metrics.RunReport to record each statement in
+        checkpoints: a checkpoints.Checkpoints to record the swap in
+        rollback: Bool, swap the previous version back in. The version
+            rolled back from becomes the previous one, so rolling back again
+            undoes the rollback.
+    """
+    settings = config['BLUE_GREEN']
+    live, shadow, previous = (settings['SCHEMA'], settings['SHADOW_SCHEMA'],
+                              settings['PREVIOUS_SCHEMA'])
+    conn = connect(schema_config(config, None))
+    cur = conn.cursor()
+    if rollback:
+        if not schema_exists(cur, previous):
+            conn.close()
+            raise RuntimeError("There is no previous version to roll back to")
+        statements = [schema_drop.format(shadow),
+                      schema_rename.format(live, shadow),
+                      schema_rename.format(previous, live),
+                      schema_rename.format(shadow, previous)]
+    else:
+        statements = [schema_drop.format(previous)]
+        if schema_exists(cur, live):
+            statements.append(schema_rename.format(live, previous))
+        statements.append(schema_rename.format(shadow, live))
+
+    start = time.time()
+    for statement in statements:
+        execute(cur, statement, 'blue_green', report)
+    commit(conn, cur, checkpoints, 'blue_green/swap')
+    conn.close()
+    if report is not None:
+        report.record_event('blue_green', 'rollback' if rollback else 'swap',
+                            time.time() - start)
+    print("Schema {} is now live".format(
+        live if not rollback else "{} (rolled back)".format(live)))
+
+
+def rebuild(config, report=None, checkpoints=None):
+    """ Builds the warehouse in the shadow schema, validates it and swaps it
+    in
+
+    Args:
+        config: a dict of the loaded json config
+        report: a metrics.RunReport to record the run in
+        checkpoints: a checkpoints.Checkpoints to record each step in. A
+            resumed rebuild carries on in the shadow schema it was building.
+
+    Returns:
+        the metrics.RunReport of the run
+    """
+    if warehouse_schema(config) is None:
+        raise ValueError("Set BLUE_GREEN.ENABLED to rebuild in a shadow "
+                         "schema")
+    shadow = config['BLUE_GREEN']['SHADOW_SCHEMA']
+    shadow_config = schema_config(config, shadow)
+
+    if not skip(checkpoints, 'blue_green/reset'):
+        conn = connect(schema_config(config, None))
+        cur = conn.cursor()
+        execute(cur, schema_drop.format(shadow), 'blue_green', report)
+        # Pooled connections to the shadow keep their search_path to it
+        execute(cur, schema_create.format(shadow), 'blue_green', report)
+        commit(conn, cur, checkpoints, 'blue_green/reset')
+        conn.close()
+    print("Building the warehouse in schema {}".format(shadow))
+
+    create_db_tables(False, shadow_config, report, checkpoints)
+    report = etl(True, shadow_config, report, checkpoints)
+
+    if not skip(checkpoints, 'blue_green/swap'):
+        problems = validate_shadow(config)
+        if problems:
+            raise RuntimeError("Schema {} failed validation, the live schema "
+                               "is unchanged: {}".format(shadow,
+                                                         '; '.join(problems)))
+        swap_schemas(config, report, checkpoints)
+    return report
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["rollback", "validate"])
+    except getopt.GetoptError:
+        print("USAGE: blue_green.py [--rollback | --validate]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    if '--rollback' in opts:
+        swap_schemas(config, rollback=True)
+    elif '--validate' in opts:
+        problems = validate_shadow(config)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+    else:
+        rebuild(config)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
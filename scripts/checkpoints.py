@@ -0,0 +1,219 @@
+"""
+Records the steps of a run as they finish, so a failed run can be resumed
+where it stopped.
+
+Every statement of `create_db_tables()` and `etl()`, plus their staging plan,
+load state and maintenance phases, is a named step such as
+`create_tables/DROP songplays`, `staging/COPY staging_songs[1]` or
+`insert/songplays`. On Redshift a step is recorded in the `run_state` table
+in the same transaction that commits its work, so a step is either done and
+recorded or neither. On the local backend the finished steps are written to
+`CHECKPOINTS.STATE_DIR/run-<run_id>.json` right after each commit.
+
+`run_state` is not one of the pipeline's tables, so a full refresh never
+drops it. The options of a run and its staging plan, the COPYs it runs and
+the log files they load, are saved under `S3.MANIFEST_PREFIX/runs/<run_id>/`.
+A resumed run reuses them rather than listing S3 again, so it records exactly
+the log files that were staged.
+
+Resuming a run skips every step it already finished. The staging tables are
+committed before the inserts start and only emptied by the COPYs themselves,
+so after a failed insert the resumed run goes on from the staged data without
+downloading it from S3 again:
+
+    $ python3 sparkify_redshift.py -c --full-refresh
+    ...
+    Run 20200101T120000 failed, resume it with:
+        python3 sparkify_redshift.py --resume 20200101T120000
+"""
+import os
+import json
+import threading
+from scripts.db import connect, get_object_store, is_local
+from scripts.manifests import split_s3_url
+from scripts.sql_queries import run_state_table_create, run_state_select, \
+    run_state_insert
+
+
+class Checkpoints:
+    """ The finished steps of one run
+
+    Attributes:
+        run_id: String, the run the steps belong to
+        finished: set of the String names of the finished steps
+    """
+
+    def __init__(self, config, run_id, resume=False):
+        """
+        Args:
+            config: a dict of the loaded json config
+            run_id: String, the `run_id` of the run's metrics.RunReport
+            resume: Bool, load the steps the run has already finished
+        """
+        self.config = config
+        self.run_id = run_id
+        self.local = is_local(config)
+        self.path = os.path.join(config['CHECKPOINTS']['STATE_DIR'],
+                                 'run-{}.json'.format(run_id))
+        self.finished = set()
+        self._lock = threading.Lock()
+
+        if self.local:
+            os.makedirs(config['CHECKPOINTS']['STATE_DIR'], exist_ok=True)
+            if resume and os.path.exists(self.path):
+                with open(self.path) as f:
+                    self.finished = set(json.load(f)['finished'])
+        else:
+            conn = connect(config)
+            cur = conn.cursor()
+            cur.execute(run_state_table_create)
+            conn.commit()
+            if resume:
+                cur.execute(run_state_select, (run_id,))
+                self.finished = {row[0] for row in cur.fetchall()}
+            conn.close()
+
+        if resume:
+            print("Resuming run {}, {} steps already finished".format(
+                run_id, len(self.finished)))
+
+    def done(self, step):
+        """ Returns True if the run has already finished the step """
+        with self._lock:
+            return step in self.finished
+
+    def mark(self, cur, step):
+        """ Records a step as finished in the cursor's open transaction
+
+        Only the run_state table is written here; the caller commits the
+        step's work and the record together and then calls `finish`.
+
+        Args:
+            cur: Psycopg2 DB cursor object the step ran on
+            step: String, the step's name
+        """
+        if not self.local:
+            cur.execute(run_state_insert, (self.run_id, step))
+
+    def finish(self, steps):
+        """ Notes committed steps as finished, writing the local state file
+
+        Args:
+            steps: list of String step names
+        """
+        with self._lock:
+            self.finished.update(steps)
+            if self.local:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'run_id': self.run_id,
+                               'finished': sorted(self.finished)}, f,
+                              indent=2)
+                os.replace(tmp_path, self.path)
+
+    def save_document(self, name, document):
+        """ Saves a JSON document of the run, see `save_document` """
+        save_document(self.config, self.run_id, name, document)
+
+    def load_document(self, name):
+        """ Loads a JSON document of the run, see `load_document` """
+        return load_document(self.config, self.run_id, name)
+
+
+def document_key(config, run_id, name):
+    bucket, prefix = split_s3_url(config['S3']['MANIFEST_PREFIX'])
+    return bucket, '{}/runs/{}/{}.json'.format(prefix.rstrip('/'), run_id,
+                                               name)
+
+
+def save_document(config, run_id, name, document):
+    """ Saves a JSON document of a run next to its manifests
+
+    Args:
+        config: a dict of the loaded json config
+        run_id: String, the run's ID
+        name: String, e.g. `plan`
+        document: a JSON serializable object
+    """
+    bucket, key = document_key(config, run_id, name)
+    get_object_store(config).put_object(
+        Bucket=bucket, Key=key, Body=json.dumps(document).encode('utf-8'))
+
+
+def load_document(config, run_id, name):
+    """ Loads a JSON document saved by `save_document` """
+    bucket, key = document_key(config, run_id, name)
+    body = get_object_store(config).get_object(
+        Bucket=bucket, Key=key)['Body'].read()
+    return json.loads(body.decode('utf-8'))
+
+
+def skip(checkpoints, step):
+    """ Returns True, and says so, if a resumed run already finished a step
+
+    Args:
+        checkpoints: a Checkpoints object, or None when not checkpointing
+        step: String, the step's name
+    """
+    if checkpoints is None or not checkpoints.done(step):
+        return False
+    print("Skipping {}, finished before".format(step))
+    return True
+
+
+def commit(conn, cur, checkpoints, step):
+    """ Commits a step's work, recording the step as finished with it
+
+    Args:
+        conn: psycopg2 DB connection object
+        cur: Psycopg2 DB cursor object the step ran on
+        checkpoints: a Checkpoints object, or None when not checkpointing
+        step: String, the step's name
+    """
+    if checkpoints is None:
+        conn.commit()
+        return
+    checkpoints.mark(cur, step)
+    conn.commit()
+    checkpoints.finish([step])
+
+
+class PhaseCommits:
+    """ Commits the steps of a phase one by one, or all of them at once
+
+    Redshift serializes commits across the cluster, so committing a phase's
+    statements together saves a commit per statement. Either way each step
+    is recorded as finished in the transaction that commits it, so a resumed
+    run redoes exactly the steps that were rolled back.
+    """
+
+    def __init__(self, conn, checkpoints=None, single_transaction=False):
+        """
+        Args:
+            conn: psycopg2 DB connection object the phase runs on
+            checkpoints: a Checkpoints object, or None when not checkpointing
+            single_transaction: Bool, commit once in `commit_phase` rather
+                than after every step
+        """
+        self.conn = conn
+        self.checkpoints = checkpoints
+        self.single_transaction = single_transaction
+        self.pending = []
+
+    def step_done(self, cur, step):
+        """ Commits a finished step, or leaves it for `commit_phase` """
+        if not self.single_transaction:
+            commit(self.conn, cur, self.checkpoints, step)
+            return
+        if self.checkpoints is not None:
+            self.checkpoints.mark(cur, step)
+        self.pending.append(step)
+
+    def commit_phase(self):
+        """ Commits the steps left uncommitted, if there are any """
+        if not self.pending:
+            return
+        self.conn.commit()
+        if self.checkpoints is not None:
+            self.checkpoints.finish(self.pending)
+        self.pending = []
@@ -3,33 +3,148 @@
 This module should be called from the terminal to clean up the AWS resources
 created in `setup_redshift.py` once the Redshift cluster is no longer needed.
 
+The cluster and the IAM role and policy are deleted in parallel, and the
+cleanup waits until the cluster is actually gone, for up to
+`PROVISIONING.DEADLINE_SECONDS`. The WLM parameter group is deleted after
+the cluster, which no longer uses it then. Resources that are already
+deleted are skipped, so the cleanup can be rerun after a partial failure.
+
+With `LIFECYCLE.MODE` set to `pause`, the cluster is paused instead, and
+resumed by the next setup. With `snapshot`, a final snapshot is taken as the
+cluster is deleted, and the next setup restores from it; only the newest
+`LIFECYCLE.SNAPSHOT_RETAIN` snapshots are kept. Both keep the IAM role and
+the parameter group the cluster uses.
+
 Typical Usage example:
-    $ python3 cleanup_redshift.py
+    $ python3 cleanup_redshift.py [--mode create|pause|snapshot]
 """
 import os
+import sys
 import json
-from scripts.helpers import get_aws_clients
+import time
+import getopt
+from concurrent.futures import ThreadPoolExecutor
+from scripts.helpers import get_aws_clients, poll
+from scripts.setup_redshift import find_policy_arn, list_snapshots, \
+    wait_for_cluster_status
 
 CFG_FILE = 'dwh_config.json'
 
 
-def delete_redshift_cluster(config, redshift):
+def delete_redshift_cluster(config, redshift, snapshot_id=None):
     """ Deletes the Redshift cluster specified in config
 
     Args:
         config: a ConfigParser object
         redshift: a boto3 client object for the AWS Redshift service
+        snapshot_id: String, name of a final snapshot to take of the cluster,
+            or None to take none
+
+    Returns:
+        dict with AWS API response, or None if the cluster is already gone
+        or being deleted
     """
+    if snapshot_id:
+        options = {'SkipFinalClusterSnapshot': False,
+                   'FinalClusterSnapshotIdentifier': snapshot_id}
+    else:
+        options = {'SkipFinalClusterSnapshot': True}
     try:
         print("Deleting Redshift Cluster: ", config['CLUSTER']['IDENTIFIER'])
         return redshift.delete_cluster(
             ClusterIdentifier=config['CLUSTER']['IDENTIFIER'],
-            SkipFinalClusterSnapshot=True
+            **options
         )
+    except redshift.exceptions.ClusterNotFoundFault:
+        print("Redshift Cluster {} is already deleted".format(
+            config['CLUSTER']['IDENTIFIER']))
     except Exception as e:
         print(e)
 
 
+def confirm_cluster_deleted(config, redshift, deadline_seconds=None):
+    """ Polls the Redshift cluster, with a growing delay, until it is gone
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+        deadline_seconds: Float, how long to wait, defaults to
+            `PROVISIONING.DEADLINE_SECONDS`
+
+    Returns:
+        Bool, True if the cluster no longer exists
+    """
+    settings = config['PROVISIONING']
+    if deadline_seconds is None:
+        deadline_seconds = float(settings['DEADLINE_SECONDS'])
+
+    def check():
+        try:
+            redshift.describe_clusters(
+                ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])
+            return False
+        except redshift.exceptions.ClusterNotFoundFault:
+            return True
+
+    deleted = poll(check, deadline_seconds, float(settings['POLL_SECONDS']),
+                   float(settings['MAX_POLL_SECONDS']))
+    if deleted:
+        print("Redshift Cluster {} is deleted".format(
+            config['CLUSTER']['IDENTIFIER']))
+    else:
+        print("Redshift Cluster {} is still being deleted after {:.0f}s, "
+              "rerun the cleanup to keep waiting".format(
+                  config['CLUSTER']['IDENTIFIER'], deadline_seconds))
+    return deleted
+
+
+def pause_redshift_cluster(config, redshift):
+    """ Pauses the Redshift cluster and waits until it is paused
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+
+    Returns:
+        Bool, True if the cluster is paused
+    """
+    try:
+        print("Pausing Redshift Cluster: ", config['CLUSTER']['IDENTIFIER'])
+        redshift.pause_cluster(
+            ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])
+    except redshift.exceptions.InvalidClusterStateFault as e:
+        # Already paused or pausing
+        print(e)
+    except redshift.exceptions.ClusterNotFoundFault:
+        print("Redshift Cluster {} does not exist".format(
+            config['CLUSTER']['IDENTIFIER']))
+        return False
+    return wait_for_cluster_status(config, redshift, 'paused') == 'paused'
+
+
+def snapshot_name(config):
+    """ Names a final snapshot after `LIFECYCLE.SNAPSHOT_PREFIX` and the
+    current time """
+    return '{}-{}'.format(config['LIFECYCLE']['SNAPSHOT_PREFIX'],
+                          time.strftime('%Y%m%d-%H%M%S', time.gmtime()))
+
+
+def prune_snapshots(config, redshift):
+    """ Deletes all but the newest `LIFECYCLE.SNAPSHOT_RETAIN` snapshots
+
+    Returns:
+        list of the String identifiers of the deleted snapshots
+    """
+    retain = int(config['LIFECYCLE']['SNAPSHOT_RETAIN'])
+    deleted = []
+    for snapshot in list_snapshots(config, redshift, False)[retain:]:
+        print("Deleting snapshot: ", snapshot['SnapshotIdentifier'])
+        redshift.delete_cluster_snapshot(
+            SnapshotIdentifier=snapshot['SnapshotIdentifier'])
+        deleted.append(snapshot['SnapshotIdentifier'])
+    return deleted
+
+
 def detach_and_delete_iam_policy(config, iam):
     """ Detaches policy from Redshift role & deletes the policy
 
@@ -38,15 +153,25 @@ def detach_and_delete_iam_policy(config, iam):
         iam: a boto3 client object for the AWS IAM service
 
     Returns:
-        dict with AWS API response
+        dict with AWS API response, or None if the policy is already gone
     """
+    policy_arn = find_policy_arn(config, iam)
+    if policy_arn is None:
+        print("Policy {} is already deleted".format(
+            config['IAM_ROLE']['POLICY_NAME']))
+        return None
+
     try:
         print("Detaching policy: ", config['IAM_ROLE']['POLICY_NAME'])
         iam.detach_role_policy(RoleName=config['IAM_ROLE']['NAME'],
-                               PolicyArn=config['IAM_ROLE']['POLICY_ARN'])
+                               PolicyArn=policy_arn)
+    except iam.exceptions.NoSuchEntityException:
+        print("Policy {} is already detached".format(
+            config['IAM_ROLE']['POLICY_NAME']))
 
+    try:
         print("Deleting policy: ", config['IAM_ROLE']['POLICY_NAME'])
-        return iam.delete_policy(PolicyArn=config['IAM_ROLE']['POLICY_ARN'])
+        return iam.delete_policy(PolicyArn=policy_arn)
     except Exception as e:
         print(e)
 
@@ -59,26 +184,118 @@ def delete_iam_role(config, iam):
         iam: a boto3 client object for the AWS IAM service
 
     Returns:
-        dict with AWS API response
+        dict with AWS API response, or None if the role is already gone
     """
     try:
         print("Deleting IAM Role: ", config['IAM_ROLE']['NAME'])
         return iam.delete_role(RoleName=config['IAM_ROLE']['NAME'])
+    except iam.exceptions.NoSuchEntityException:
+        print("IAM Role {} is already deleted".format(
+            config['IAM_ROLE']['NAME']))
     except Exception as e:
         print(e)
 
 
-def cleanup_redshift_cluster():
+def delete_iam_resources(config, iam):
+    """ Deletes the policy and then the role, which can not be deleted while
+    the policy is attached
+
+    Returns:
+        Bool, True if the role no longer exists
+    """
+    detach_and_delete_iam_policy(config, iam)
+    delete_iam_role(config, iam)
+    try:
+        iam.get_role(RoleName=config['IAM_ROLE']['NAME'])
+        return False
+    except iam.exceptions.NoSuchEntityException:
+        return True
+
+
+def delete_cluster_resources(config, redshift, snapshot_id=None):
+    """ Deletes the cluster, optionally taking a final snapshot, and waits
+    until it is gone
+
+    Returns:
+        Bool, True if the cluster no longer exists
+    """
+    delete_redshift_cluster(config, redshift, snapshot_id)
+    deleted = confirm_cluster_deleted(config, redshift)
+    if snapshot_id:
+        prune_snapshots(config, redshift)
+    return deleted
+
+
+def delete_wlm_parameter_group(config, redshift):
+    """ Deletes the WLM cluster parameter group made by the setup, which can
+    not be deleted while a cluster is in it
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+
+    Returns:
+        Bool, True if the parameter group no longer exists
+    """
+    name = config['WLM']['PARAMETER_GROUP']
+    try:
+        print("Deleting cluster parameter group: ", name)
+        redshift.delete_cluster_parameter_group(ParameterGroupName=name)
+    except redshift.exceptions.ClusterParameterGroupNotFoundFault:
+        print("Cluster parameter group {} is already deleted".format(name))
+    except Exception as e:
+        print(e)
+        return False
+    return True
+
+
+def cleanup_redshift_cluster(mode=None):
+    """ Deletes or pauses the Redshift cluster, and deletes the IAM role and
+    policy and the WLM parameter group if the cluster is not kept for a
+    later run
+
+    Args:
+        mode: String, `create`, `pause` or `snapshot`, defaults to
+            `LIFECYCLE.MODE`
+
+    Returns:
+        Bool, True if all of them are gone, or the cluster is paused
+    """
     with open(CFG_FILE) as f:
         config = json.load(f)
+    mode = mode or config['LIFECYCLE']['MODE']
 
+    start = time.time()
     iam, redshift = get_aws_clients(config)
-    delete_redshift_cluster(config, redshift)
-    detach_and_delete_iam_policy(config, iam)
-    delete_iam_role(config, iam)
+    if mode == 'pause':
+        done = [pause_redshift_cluster(config, redshift)]
+    elif mode == 'snapshot':
+        done = [delete_cluster_resources(config, redshift,
+                                         snapshot_name(config))]
+    else:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            cluster = executor.submit(delete_cluster_resources, config,
+                                      redshift)
+            role = executor.submit(delete_iam_resources, config, iam)
+            done = [cluster.result(), role.result()]
+        if done[0]:
+            done.append(delete_wlm_parameter_group(config, redshift))
+
+    print("Cleanup finished in {:.1f}s".format(time.time() - start))
+    if all(done):
+        print("All done, exit script.")
+    return all(done)
 
-    print("All done, exit script.")
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["mode="])
+    except getopt.GetoptError:
+        print("USAGE: cleanup_redshift.py [--mode create|pause|snapshot]")
+        sys.exit(2)
+    if not cleanup_redshift_cluster(dict(opts).get('--mode')):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    cleanup_redshift_cluster()
+    main(sys.argv[1:])
@@ -0,0 +1,317 @@
+"""
+Profiles the loaded data to right-size the character columns and pick a
+compression encoding for every column.
+
+Each table is scanned once for the row count and, per column, the widest
+value in bytes and the (approximate) number of distinct values. From those:
+
+    - TEXT and VARCHAR columns get a VARCHAR of the next power of two above
+      their widest value plus `WIDTH_HEADROOM`. Staging columns are never
+      made narrower than declared in `sql_queries.py`: their COPYs use
+      `TRUNCATECOLUMNS`, so a longer value than the profile saw would be
+      silently cut rather than rejected. Columns of the star-schema
+      tables are never made narrower than the staging column they are
+      loaded from, so an insert can not fail on a value staging accepted,
+      and rollup columns never narrower than the column they group by.
+    - integers, decimals, dates and timestamps are encoded AZ64
+    - character columns with at most `BYTEDICT_MAX_DISTINCT` values are
+      encoded BYTEDICT, other character and floating point columns ZSTD
+    - the first sort key column is left RAW, so range-restricted scans can
+      skip blocks without decompressing them
+
+The results are written as `COLUMNS` overrides into `TABLES` in the config,
+from which the CREATE TABLE statements are built. The profile can run on
+the cluster's loaded tables, or offline on a local sample of the input data
+loaded into a throwaway DuckDB database.
+
+Typical Usage example:
+    $ python3 -m scripts.column_profiler [--sample <data_dir>]
+        [-o columns.json] [--apply]
+"""
+import os
+import re
+import sys
+import copy
+import json
+import getopt
+import tempfile
+from scripts.db import connect
+from scripts.table_layout import create_table, column_types, split_columns
+from scripts.rollups import group_by
+
+CFG_FILE = 'dwh_config.json'
+
+# Character columns are sized at least this much wider than the widest value
+WIDTH_HEADROOM = 1.25
+MIN_VARCHAR_WIDTH = 16
+MAX_VARCHAR_WIDTH = 65535
+# Width of TEXT, and of VARCHAR without one, on Redshift
+DEFAULT_VARCHAR_WIDTH = 256
+# Tables loaded by COPY with TRUNCATECOLUMNS
+STAGING_TABLES = ('staging_events', 'staging_songs')
+# BYTEDICT keeps a dictionary of up to 256 values per block
+BYTEDICT_MAX_DISTINCT = 256
+# Tables whose contents grow without bound, so a profile says little
+SKIP_TABLES = {'load_state', 'load_version'}
+
+AZ64_TYPES = ('SMALLINT', 'INTEGER', 'INT', 'BIGINT', 'DECIMAL', 'NUMERIC',
+              'DATE', 'TIMESTAMP', 'TIMESTAMPTZ')
+CHARACTER_TYPES = ('TEXT', 'VARCHAR', 'CHAR', 'CHARACTER')
+
+# The staging column each star-schema character column is loaded from
+COLUMN_SOURCES = {
+    'songplays': {'level': ('staging_events', 'level'),
+                  'song_id': ('staging_songs', 'song_id'),
+                  'artist_id': ('staging_songs', 'artist_id'),
+                  'location': ('staging_events', 'location'),
+                  'user_agent': ('staging_events', 'user_agent')},
+    'users': {'first_name': ('staging_events', 'first_name'),
+              'last_name': ('staging_events', 'last_name'),
+              'gender': ('staging_events', 'gender'),
+              'level': ('staging_events', 'level')},
+    'songs': {'song_id': ('staging_songs', 'song_id'),
+              'title': ('staging_songs', 'title'),
+              'artist_id': ('staging_songs', 'artist_id')},
+    'artists': {'artist_id': ('staging_songs', 'artist_id'),
+                'name': ('staging_songs', 'artist_name'),
+                'location': ('staging_songs', 'artist_location')},
+    'staging_events_keyed': {'level': ('staging_events', 'level'),
+                             'location': ('staging_events', 'location'),
+                             'user_agent': ('staging_events', 'user_agent')},
+    'staging_songs_keyed': {'song_id': ('staging_songs', 'song_id'),
+                            'artist_id': ('staging_songs', 'artist_id')},
+}
+
+
+def column_sources(rollups=None):
+    """ Returns `COLUMN_SOURCES` plus the column each rollup column is
+    aggregated from """
+    sources = dict(COLUMN_SOURCES)
+    for name, spec in (rollups or {}).items():
+        sources[name] = {column: (table, column)
+                         for table, column in group_by(spec)}
+    return sources
+
+
+def base_type(data_type):
+    """ Strips the width off a type, e.g. `VARCHAR(30)` -> `VARCHAR` """
+    return data_type.split('(')[0]
+
+
+def profile_query(table, types):
+    """ Builds the statement that profiles every column of a table at once
+
+    Args:
+        table: String, the table name
+        types: dict of column name to type, as from `column_types`
+
+    Returns:
+        String SQL statement
+    """
+    selects = ['COUNT(*)']
+    for column, data_type in types.items():
+        if base_type(data_type) in CHARACTER_TYPES:
+            selects.append('MAX(OCTET_LENGTH({}))'.format(column))
+        else:
+            selects.append('NULL')
+        selects.append('APPROXIMATE COUNT(DISTINCT {})'.format(column))
+    return 'SELECT {} FROM {};'.format(', '.join(selects), table)
+
+
+def profile_table(cur, table, types):
+    """ Profiles the columns of a table
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        table: String, the table name
+        types: dict of column name to type, as from `column_types`
+
+    Returns:
+        dict with the table's `rows` and, per column in `columns`, its
+        `type`, `max_bytes` and `distinct` count
+    """
+    cur.execute(profile_query(table, types))
+    row = cur.fetchone()
+    profile = {'rows': row[0], 'columns': {}}
+    for i, (column, data_type) in enumerate(types.items()):
+        profile['columns'][column] = {
+            'type': data_type,
+            'max_bytes': row[1 + 2 * i],
+            'distinct': row[2 + 2 * i],
+        }
+    return profile
+
+
+def varchar_width(max_bytes):
+    """ Sizes a VARCHAR for values of up to `max_bytes` bytes """
+    width = MIN_VARCHAR_WIDTH
+    while width < max_bytes * WIDTH_HEADROOM and width < MAX_VARCHAR_WIDTH:
+        width *= 2
+    return min(width, MAX_VARCHAR_WIDTH)
+
+
+def declared_width(data_type):
+    """ Returns the width of a declared character type, e.g. 30 for
+    `VARCHAR(30)` and 256 for `TEXT` """
+    match = re.match(r'\w+\s*\((\d+)\)', data_type)
+    if match:
+        return int(match.group(1))
+    if base_type(data_type) in ('TEXT', 'VARCHAR'):
+        return DEFAULT_VARCHAR_WIDTH
+    return 1
+
+
+def choose_encoding(data_type, stats, sort_key=False):
+    """ Picks the compression encoding of a column
+
+    Args:
+        data_type: String, the column type
+        stats: dict of the column's profile
+        sort_key: Bool, the column is the table's first sort key column
+
+    Returns:
+        String encoding name
+    """
+    if sort_key:
+        return 'RAW'
+    data_type = base_type(data_type)
+    if data_type in AZ64_TYPES:
+        return 'AZ64'
+    if data_type in CHARACTER_TYPES and stats['distinct'] is not None and \
+            stats['distinct'] <= BYTEDICT_MAX_DISTINCT:
+        return 'BYTEDICT'
+    return 'ZSTD'
+
+
+def recommend_columns(profiles, specs, rollups=None):
+    """ Works out the column overrides of every profiled table
+
+    Args:
+        profiles: dict of table name to its `profile_table` result
+        specs: dict of the current `TABLES` config
+        rollups: dict of the `ROLLUPS` config
+
+    Returns:
+        dict of table name to its `TABLES` entry with new `COLUMNS`
+    """
+    specs = copy.deepcopy(specs)
+    sources = column_sources(rollups)
+    widths = {}
+    # Staging tables first, so the tables loaded from them can match widths.
+    # Rollups come after the tables they aggregate in `table_columns`.
+    for table in sorted(profiles, key=lambda t: t not in STAGING_TABLES):
+        spec = specs.setdefault(table, {})
+        sort_keys = split_columns(spec.get('SORTKEY', ''))
+        overrides = {}
+        for column, stats in profiles[table]['columns'].items():
+            override = {'ENCODE': choose_encoding(
+                stats['type'], stats,
+                sort_keys[:1] == [column])}
+            if base_type(stats['type']) in CHARACTER_TYPES and \
+                    stats['max_bytes'] is not None:
+                width = varchar_width(stats['max_bytes'])
+                source = sources.get(table, {}).get(column)
+                width = max(width, widths.get(source, 0))
+                if table in STAGING_TABLES:
+                    width = max(width, declared_width(stats['type']))
+                widths[(table, column)] = width
+                override['TYPE'] = 'VARCHAR({})'.format(width)
+            overrides[column] = override
+        spec['COLUMNS'] = overrides
+    return specs
+
+
+def profile_tables(cur, table_columns):
+    """ Profiles every table that has rows
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        table_columns: dict of table name to its column definitions
+
+    Returns:
+        dict of table name to its `profile_table` result
+    """
+    profiles = {}
+    for table, columns in table_columns.items():
+        if table in SKIP_TABLES:
+            continue
+        profile = profile_table(cur, table, column_types(columns))
+        if profile['rows']:
+            profiles[table] = profile
+            print("Profiled {} ({} rows)".format(table, profile['rows']))
+    return profiles
+
+
+def profile_sample(config, data_dir, table_columns):
+    """ Loads a local sample of the input data into a throwaway DuckDB
+    database with the pipeline, and profiles it
+
+    Args:
+        config: a dict of the loaded json config
+        data_dir: String, directory laid out like the S3 bucket
+        table_columns: dict of table name to its column definitions
+
+    Returns:
+        dict of table name to its `profile_table` result
+    """
+    from scripts.create_tables import create_db_tables
+    from scripts.etl import etl
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = copy.deepcopy(config)
+        config['ETL']['BACKEND'] = 'local'
+        config['ETL']['SONG_MANIFESTS'] = 'false'
+        config['COMPACTION']['ENABLED'] = 'false'
+        config['PARQUET']['ENABLED'] = 'false'
+        config['LOCAL']['DATA_DIR'] = data_dir
+        config['LOCAL']['DB_PATH'] = os.path.join(tmp, 'sample.duckdb')
+        config['METRICS']['REPORT_DIR'] = os.path.join(tmp, 'reports')
+        create_db_tables(True, config)
+        etl(True, config)
+
+        conn = connect(config)
+        profiles = profile_tables(conn.cursor(), table_columns)
+        conn.close()
+    return profiles
+
+
+def main(argv):
+    from scripts.sql_queries import table_columns
+
+    try:
+        opts, args = getopt.getopt(argv, "o:", ["sample=", "apply"])
+    except getopt.GetoptError:
+        print("USAGE: column_profiler.py [--sample <data_dir>] "
+              "[-o <columns.json>] [--apply]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    if '--sample' in opts:
+        profiles = profile_sample(config, opts['--sample'], table_columns)
+    else:
+        conn = connect(config)
+        profiles = profile_tables(conn.cursor(), table_columns)
+        conn.close()
+
+    specs = recommend_columns(profiles, config['TABLES'],
+                              config['ROLLUPS'])
+    for table in profiles:
+        print(create_table(table, table_columns[table], specs[table]))
+
+    if '-o' in opts:
+        with open(opts['-o'], 'w') as f:
+            json.dump(profiles, f, indent=2)
+    if '--apply' in opts:
+        config['TABLES'] = specs
+        with open(CFG_FILE, 'w') as f:
+            json.dump(config, f, indent=2)
+        print("Updated TABLES in {}; run a full refresh to rebuild the "
+              "tables".format(CFG_FILE))
+    return specs
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,248 @@
+"""
+Compacts the small song & log JSON files into a few large gzip files.
+
+COPY is slow on many tiny files, so this optional stage rewrites every
+partition of `S3.SONG_DATA` and `S3.LOG_DATA` (e.g. `song_data/A` or
+`log_data/2018/11`) as gzip-compressed newline-delimited JSON objects of
+roughly `COMPACTION.TARGET_SIZE_MB` under `COMPACTION.STAGING_PREFIX`. Inputs
+are streamed line by line into multipart uploads, so memory use stays at
+about one upload part per worker however large a partition is.
+
+The ETags of each partition's inputs are kept in a state file next to the
+compacted data, and partitions whose inputs are unchanged are skipped.
+
+Typical Usage example:
+    $ python3 -m scripts.compact
+"""
+import io
+import json
+import gzip
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from scripts.manifests import split_s3_url
+
+CFG_FILE = 'dwh_config.json'
+STATE_FILE = '_compaction_state.json'
+PART_SIZE = 8 * 1024 ** 2   # S3 parts must be at least 5MB, except the last
+
+
+class CompactedObjectWriter:
+    """ Streams lines into gzip multipart uploads, starting a new object
+    whenever the current one reaches the target size.
+
+    Attributes:
+        keys: list of String keys of the objects written so far
+    """
+
+    def __init__(self, s3, bucket, key_prefix, target_size):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.target_size = target_size
+        self.keys = []
+        self.gzip = None
+
+    def _open(self):
+        self.key = "{}-{:05d}.json.gz".format(self.key_prefix, len(self.keys))
+        self.upload_id = self.s3.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key)['UploadId']
+        self.parts = []
+        self.size = 0
+        self.buffer = io.BytesIO()
+        self.gzip = gzip.GzipFile(fileobj=self.buffer, mode='wb')
+
+    def _upload_part(self):
+        body = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=len(self.parts) + 1, Body=body)
+        self.parts.append({'ETag': response['ETag'],
+                           'PartNumber': len(self.parts) + 1})
+        self.size += len(body)
+
+    def _close(self):
+        self.gzip.close()
+        self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+        self.keys.append(self.key)
+        self.gzip = None
+
+    def write(self, line):
+        if self.gzip is None:
+            self._open()
+        self.gzip.write(line.rstrip(b'\r\n') + b'\n')
+        if self.buffer.tell() >= PART_SIZE:
+            self._upload_part()
+        if self.size + self.buffer.tell() >= self.target_size:
+            self._close()
+
+    def close(self):
+        if self.gzip is not None:
+            self._close()
+
+    def abort(self):
+        if self.gzip is not None:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.gzip = None
+
+
+def list_etags(s3, url):
+    """ Lists every object under an S3 prefix along with its ETag
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        url: String, `s3://bucket/prefix` to list
+
+    Returns:
+        dict of object key to ETag
+    """
+    bucket, prefix = split_s3_url(url)
+    etags = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                etags[obj['Key']] = obj['ETag']
+    return etags
+
+
+def partition_inputs(etags, prefix, depth):
+    """ Groups input objects by the first `depth` path levels below a prefix
+
+    Args:
+        etags: dict of object key to ETag
+        prefix: String, the key prefix the inputs were listed under
+        depth: Int, how many path levels make up a partition
+
+    Returns:
+        dict of partition name (e.g. `log_data/2018/11`) to a dict of its
+        object keys to ETags
+    """
+    base = prefix.rstrip('/')
+    partitions = {}
+    for key, etag in etags.items():
+        levels = key[len(base):].lstrip('/').split('/')[:-1]
+        name = '/'.join([base.split('/')[-1]] + levels[:depth])
+        partitions.setdefault(name, {})[key] = etag
+    return partitions
+
+
+def compact_partition(s3, bucket, inputs, out_bucket, key_prefix,
+                      target_size):
+    """ Streams a partition's inputs into compacted gzip objects
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        bucket: String, the bucket the inputs are in
+        inputs: list of String input object keys
+        out_bucket: String, the bucket to write the compacted objects to
+        key_prefix: String, the compacted objects' keys start with this
+        target_size: Int, approximate size in bytes of each compacted object
+
+    Returns:
+        list of String keys of the compacted objects
+    """
+    writer = CompactedObjectWriter(s3, out_bucket, key_prefix, target_size)
+    try:
+        for key in sorted(inputs):
+            body = s3.get_object(Bucket=bucket, Key=key)['Body']
+            for line in body.iter_lines():
+                if line.strip():
+                    writer.write(line)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer.keys
+
+
+def read_state(s3, bucket, key):
+    """ Reads the compaction state file, or an empty state if there is none
+    """
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return {'partitions': {}}
+    return json.loads(body)
+
+
+def compact_inputs(s3, config):
+    """ Compacts every changed partition of the song & log data
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        config: a dict of the loaded json config
+
+    Returns:
+        dict with the number of partitions `compacted`, `skipped` and
+        `removed`
+    """
+    settings = config['COMPACTION']
+    out_bucket, out_prefix = split_s3_url(settings['STAGING_PREFIX'])
+    out_prefix = out_prefix.rstrip('/')
+    state_key = '{}/{}'.format(out_prefix, STATE_FILE).lstrip('/')
+    state = read_state(s3, out_bucket, state_key)
+    run = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    target_size = int(float(settings['TARGET_SIZE_MB']) * 1024 ** 2)
+
+    tasks = []
+    seen = set()
+    for url, depth in [(config['S3']['SONG_DATA'],
+                        int(settings['SONG_PARTITION_DEPTH'])),
+                       (config['S3']['LOG_DATA'],
+                        int(settings['LOG_PARTITION_DEPTH']))]:
+        bucket, prefix = split_s3_url(url)
+        partitions = partition_inputs(list_etags(s3, url), prefix, depth)
+        for name, inputs in partitions.items():
+            seen.add(name)
+            previous = state['partitions'].get(name, {})
+            if previous.get('inputs') != inputs:
+                tasks.append((name, bucket, inputs))
+
+    lock = threading.Lock()
+    stale = []
+
+    def compact(task):
+        name, bucket, inputs = task
+        key_prefix = '{}/{}/part-{}'.format(out_prefix, name, run).lstrip('/')
+        outputs = compact_partition(s3, bucket, inputs, out_bucket,
+                                    key_prefix, target_size)
+        with lock:
+            stale.extend(key for key in
+                         state['partitions'].get(name, {}).get('outputs', [])
+                         if key not in outputs)
+            state['partitions'][name] = {'inputs': inputs, 'outputs': outputs}
+        print("Compacted {} files of {} into {} objects".format(
+            len(inputs), name, len(outputs)))
+
+    try:
+        with ThreadPoolExecutor(
+                max_workers=int(settings['WORKERS'])) as executor:
+            list(executor.map(compact, tasks))
+    finally:
+        removed = [name for name in state['partitions'] if name not in seen]
+        for name in removed:
+            stale.extend(state['partitions'].pop(name)['outputs'])
+        s3.put_object(Bucket=out_bucket, Key=state_key,
+                      Body=json.dumps(state).encode('utf-8'))
+        for key in stale:
+            s3.delete_object(Bucket=out_bucket, Key=key)
+
+    summary = {'compacted': len(tasks), 'skipped': len(seen) - len(tasks),
+               'removed': len(removed)}
+    print("Compaction done: ", summary)
+    return summary
+
+
+if __name__ == "__main__":
+    from scripts.db import get_object_store
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+    compact_inputs(get_object_store(config), config)
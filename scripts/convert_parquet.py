@@ -0,0 +1,306 @@
+"""
+Converts the song & log JSON data into typed, columnar Parquet files.
+
+Redshift parses JSON row by row during COPY, and for the log data it also
+applies the jsonpaths file and converts `ts` from epoch milliseconds. This
+module does that work once, up front: records are read in streaming batches,
+coerced to the column types of `staging_events` and `staging_songs` (with
+`ts` already a timestamp) and written as Parquet, which the staging tables
+can then load with `FORMAT AS PARQUET`.
+
+The inputs are converted a partition at a time, e.g. `song_data/A` or
+`log_data/2018/11`, `PARQUET.SONG_PARTITION_DEPTH` and `LOG_PARTITION_DEPTH`
+levels below the dataset's prefix. Like the compaction stage, the ETags of
+each partition's inputs are kept in a state file under `PARQUET.PREFIX`, and
+partitions whose inputs are unchanged are skipped.
+
+Typical Usage example:
+    $ python3 -m scripts.convert_parquet
+"""
+import os
+import json
+import tempfile
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scripts.manifests import split_s3_url
+from scripts.compact import list_etags, partition_inputs, read_state
+
+CFG_FILE = 'dwh_config.json'
+STATE_FILE = '_conversion_state.json'
+
+# Columns of staging_events, in table order, and the log JSON field each is
+# loaded from (the same order as the LOG_JSONPATH jsonpaths file)
+STAGING_EVENTS_SCHEMA = pa.schema([
+    ('artist_name', pa.string()),
+    ('auth', pa.string()),
+    ('first_name', pa.string()),
+    ('gender', pa.string()),
+    ('item_in_session', pa.int32()),
+    ('last_name', pa.string()),
+    ('length', pa.float32()),
+    ('level', pa.string()),
+    ('location', pa.string()),
+    ('method', pa.string()),
+    ('page', pa.string()),
+    ('registration', pa.float64()),
+    ('session_id', pa.int32()),
+    ('song_title', pa.string()),
+    ('status', pa.int32()),
+    ('ts', pa.timestamp('us')),
+    ('user_agent', pa.string()),
+    ('user_id', pa.int32()),
+])
+EVENT_FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession',
+                'lastName', 'length', 'level', 'location', 'method', 'page',
+                'registration', 'sessionId', 'song', 'status', 'ts',
+                'userAgent', 'userId']
+
+# Columns of staging_songs, in table order; the song JSON fields share their
+# names
+STAGING_SONGS_SCHEMA = pa.schema([
+    ('artist_id', pa.string()),
+    ('artist_latitude', pa.float64()),
+    ('artist_location', pa.string()),
+    ('artist_longitude', pa.float64()),
+    ('artist_name', pa.string()),
+    ('duration', pa.float32()),
+    ('num_songs', pa.int32()),
+    ('song_id', pa.string()),
+    ('title', pa.string()),
+    ('year', pa.int32()),
+])
+SONG_FIELDS = STAGING_SONGS_SCHEMA.names
+
+DATASETS = {
+    'log_data': (STAGING_EVENTS_SCHEMA, EVENT_FIELDS),
+    'song_data': (STAGING_SONGS_SCHEMA, SONG_FIELDS),
+}
+# Config of the S3 prefix and partition depth of each dataset's inputs
+DATASET_INPUTS = {
+    'log_data': ('LOG_DATA', 'LOG_PARTITION_DEPTH'),
+    'song_data': ('SONG_DATA', 'SONG_PARTITION_DEPTH'),
+}
+
+
+def coerce(value, pa_type):
+    """ Converts a JSON value to the Python value of a Parquet column type
+
+    Blank strings become nulls, like COPY's BLANKSASNULL & EMPTYASNULL, and
+    timestamps are read as epoch milliseconds, like its
+    `TIMEFORMAT 'epochmillisecs'`.
+
+    Args:
+        value: a value parsed from JSON
+        pa_type: a pyarrow DataType
+
+    Returns:
+        the converted value, or None
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if pa.types.is_timestamp(pa_type):
+        return datetime.utcfromtimestamp(float(value) / 1000)
+    if pa.types.is_integer(pa_type):
+        return int(value)
+    if pa.types.is_floating(pa_type):
+        return float(value)
+    return str(value)
+
+
+def records_to_batch(records, schema, fields):
+    """ Builds a typed Arrow record batch from parsed JSON records
+
+    Args:
+        records: list of dicts parsed from JSON
+        schema: a pyarrow Schema of the target table
+        fields: list of JSON field names, one per schema column
+
+    Returns:
+        a pyarrow RecordBatch
+    """
+    arrays = [
+        pa.array([coerce(record.get(field_name), field.type)
+                  for record in records], type=field.type)
+        for field, field_name in zip(schema, fields)
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_local_lines(path):
+    """ Yields the lines of every .json file under a local directory """
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.json'):
+                with open(os.path.join(root, name), 'rb') as f:
+                    for line in f:
+                        yield line
+
+
+def iter_s3_lines(s3, bucket, keys):
+    """ Yields the lines of S3 objects, streamed, in key order """
+    for key in sorted(keys):
+        body = s3.get_object(Bucket=bucket, Key=key)['Body']
+        for line in body.iter_lines():
+            yield line
+
+
+def convert_lines(lines, dataset, out_dir, batch_rows=10000,
+                  rows_per_file=1000000):
+    """ Streams JSON lines into Parquet files, one batch at a time
+
+    Args:
+        lines: iterable of newline-delimited JSON records, as bytes
+        dataset: String, `log_data` or `song_data`
+        out_dir: String, local directory to write the Parquet files to
+        batch_rows: Int, number of records converted at a time
+        rows_per_file: Int, max number of records in one Parquet file
+
+    Returns:
+        list of String paths of the written Parquet files
+    """
+    schema, fields = DATASETS[dataset]
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    writer = None
+    file_rows = 0
+    records = []
+
+    def flush():
+        nonlocal writer, file_rows
+        if not records:
+            return
+        if writer is None or file_rows >= rows_per_file:
+            if writer is not None:
+                writer.close()
+            paths.append(os.path.join(
+                out_dir, 'part-{:05d}.parquet'.format(len(paths))))
+            writer = pq.ParquetWriter(paths[-1], schema,
+                                      compression='snappy')
+            file_rows = 0
+        writer.write_table(pa.Table.from_batches(
+            [records_to_batch(records, schema, fields)]))
+        file_rows += len(records)
+        records.clear()
+
+    for line in lines:
+        if line.strip():
+            records.append(json.loads(line))
+            if len(records) >= batch_rows:
+                flush()
+    flush()
+    if writer is not None:
+        writer.close()
+    return paths
+
+
+def convert_partition(s3, bucket, inputs, dataset, out_bucket, key_prefix,
+                      settings):
+    """ Converts a partition's inputs and uploads the Parquet files
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        bucket: String, the bucket the inputs are in
+        inputs: list of String input object keys
+        dataset: String, `log_data` or `song_data`
+        out_bucket: String, the bucket to write the Parquet files to
+        key_prefix: String, the Parquet files' keys start with this
+        settings: dict of the `PARQUET` config
+
+    Returns:
+        list of String keys of the uploaded Parquet files
+    """
+    keys = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = convert_lines(iter_s3_lines(s3, bucket, inputs), dataset,
+                              tmp, int(settings['BATCH_ROWS']),
+                              int(settings['ROWS_PER_FILE']))
+        for path in paths:
+            keys.append('{}-{}'.format(key_prefix, os.path.basename(path)))
+            s3.upload_file(path, out_bucket, keys[-1])
+    return keys
+
+
+def convert_to_s3(s3, config, datasets=None):
+    """ Converts the changed partitions of the song & log data in S3 and
+    uploads the Parquet files under `PARQUET.PREFIX`
+
+    Parquet files under a dataset's prefix that no partition's state lists,
+    e.g. from a partition whose inputs are gone or a conversion that
+    failed, are deleted, so the COPYs never load a record twice.
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        config: a dict of the loaded json config
+        datasets: list of the datasets to convert, defaults to both
+            `log_data` and `song_data`
+
+    Returns:
+        dict of dataset name to the number of partitions `converted` and
+        `skipped`
+    """
+    settings = config['PARQUET']
+    out_bucket, out_prefix = split_s3_url(settings['PREFIX'])
+    out_prefix = out_prefix.rstrip('/')
+    state_key = '{}/{}'.format(out_prefix, STATE_FILE).lstrip('/')
+    state = read_state(s3, out_bucket, state_key)
+    run = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    summary = {}
+
+    try:
+        for dataset in datasets or list(DATASET_INPUTS):
+            url_key, depth_key = DATASET_INPUTS[dataset]
+            bucket, prefix = split_s3_url(config['S3'][url_key])
+            etags = {key: etag for key, etag in
+                     list_etags(s3, config['S3'][url_key]).items()
+                     if key.endswith('.json')}
+            partitions = partition_inputs(etags, prefix,
+                                          int(settings[depth_key]))
+            seen = set()
+            converted = 0
+            for name, inputs in sorted(partitions.items()):
+                # Named after the dataset rather than its input prefix, as
+                # the Parquet COPYs read `<PREFIX>/<dataset>/`
+                name = dataset + name[len(name.split('/')[0]):]
+                seen.add(name)
+                if state['partitions'].get(name, {}).get('inputs') == inputs:
+                    continue
+                key_prefix = '{}/{}/part-{}'.format(out_prefix, name,
+                                                    run).lstrip('/')
+                outputs = convert_partition(s3, bucket, inputs, dataset,
+                                            out_bucket, key_prefix, settings)
+                state['partitions'][name] = {'inputs': inputs,
+                                             'outputs': outputs}
+                converted += 1
+                print("Converted {} files of {} into {} Parquet files".format(
+                    len(inputs), name, len(outputs)))
+            for name in list(state['partitions']):
+                if name.split('/')[0] == dataset and name not in seen:
+                    del state['partitions'][name]
+            summary[dataset] = {'converted': converted,
+                                'skipped': len(seen) - converted}
+    finally:
+        s3.put_object(Bucket=out_bucket, Key=state_key,
+                      Body=json.dumps(state).encode('utf-8'))
+        outputs = {key for partition in state['partitions'].values()
+                   for key in partition['outputs']}
+        for dataset in datasets or list(DATASET_INPUTS):
+            dataset_prefix = '{}/{}/'.format(out_prefix, dataset).lstrip('/')
+            listing = s3.get_paginator('list_objects_v2').paginate(
+                Bucket=out_bucket, Prefix=dataset_prefix)
+            for page in listing:
+                for obj in page.get('Contents', []):
+                    if obj['Key'] not in outputs:
+                        s3.delete_object(Bucket=out_bucket, Key=obj['Key'])
+
+    print("Parquet conversion done: ", summary)
+    return summary
+
+
+if __name__ == "__main__":
+    from scripts.db import get_object_store
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+    convert_to_s3(get_object_store(config), config)
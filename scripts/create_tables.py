@@ -3,66 +3,101 @@ Drops the following tables in Redshift Cluster in the Sparkify DB and creates
 them again.
 
 Tables:
-    staging_events, staging_songs, songplays,users, songs, artists, time
+    staging_events, staging_songs, songplays,users, songs, artists, time,
+    load_state, load_version, staging_events_keyed, staging_songs_keyed,
+    and the rollup tables in `ROLLUPS`
 """
 import json
-import psycopg2
+from scripts.db import connect, single_transaction
 from scripts.sql_queries import create_table_queries, drop_table_queries
+from scripts.metrics import execute, statement_name
+from scripts.checkpoints import skip, PhaseCommits
 
 CFG_FILE = 'dwh_config.json'
 
 
-def drop_tables(cur, conn):
+def run_statements(cur, conn, queries, report=None, checkpoints=None,
+                   single=False):
+    """ Runs and commits the statements, one by one or all at once, skipping
+    those a resumed run has already finished """
+    phase = PhaseCommits(conn, checkpoints, single)
+    for query in queries:
+        step = 'create_tables/' + statement_name(query)
+        if skip(checkpoints, step):
+            continue
+        execute(cur, query, 'create_tables', report)
+        phase.step_done(cur, step)
+    phase.commit_phase()
+
+
+def drop_tables(cur, conn, report=None, checkpoints=None, single=False):
     """ Drops all the tables in Redshift Cluster
 
     Args:
         cur: Psycopg2 DB cursor object
         conn: psycopg2 DB connection object
+        report: a metrics.RunReport to record each statement in
+        checkpoints: a checkpoints.Checkpoints to record each statement in
+        single: Bool, commit all the statements at once rather than one by
+            one
 
     Returns:
         None
     """
-    for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+    run_statements(cur, conn, drop_table_queries, report, checkpoints,
+                   single)
     print("All tables dropped")
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, report=None, checkpoints=None, single=False):
     """ Creates the tables for Redshift cluster
 
     staging_events, staging_songs, songplays,
-    users, songs, artists, times
+    users, songs, artists, times, load_state, load_version,
+    staging_events_keyed, staging_songs_keyed and the rollup tables
 
     Args:
         cur: Psycopg2 DB cursor object
         conn: psycopg2 DB connection object
+        report: a metrics.RunReport to record each statement in
+        checkpoints: a checkpoints.Checkpoints to record each statement in
+        single: Bool, commit all the statements at once rather than one by
+            one
 
     Returns:
         None
     """
-    for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+    run_statements(cur, conn, create_table_queries, report, checkpoints,
+                   single)
     print("All tables created")
 
 
-def create_db_tables():
-    with open(CFG_FILE) as f:
-        config = json.load(f)
+def create_db_tables(full_refresh=True, config=None, report=None,
+                     checkpoints=None):
+    """ Creates any missing tables, dropping all of them first on a full
+    refresh
 
-    db_conn_str = "host={} dbname={} user={} password={} port={}".format(
-        config['CLUSTER']['HOST'],
-        config['CLUSTER']['DB_NAME'],
-        config['CLUSTER']['DB_USER'],
-        config['CLUSTER']['DB_PASSWORD'],
-        config['CLUSTER']['DB_PORT'],
-    )
+    Args:
+        full_refresh: Bool, drop the existing tables and their data
+        config: a dict of the loaded json config, read from `CFG_FILE` if
+            not given
+        report: a metrics.RunReport to record each statement in
+        checkpoints: a checkpoints.Checkpoints of the run; statements a
+            resumed run has already finished are skipped
+
+    The drops and the creates are each committed in one transaction, unless
+    `create_tables` is left out of `CONNECTIONS.SINGLE_TRANSACTION_PHASES`.
+    """
+    if config is None:
+        with open(CFG_FILE) as f:
+            config = json.load(f)
 
-    conn = psycopg2.connect(db_conn_str)
+    single = single_transaction(config, 'create_tables')
+    conn = connect(config, 'create_tables')
     cur = conn.cursor()
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    if full_refresh:
+        drop_tables(cur, conn, report, checkpoints, single)
+    create_tables(cur, conn, report, checkpoints, single)
 
     conn.close()
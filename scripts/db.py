@@ -0,0 +1,304 @@
+"""
+Opens connections to the warehouse DB for the configured backend.
+
+`ETL.BACKEND` in `dwh_config.json` selects either the Redshift cluster
+(`redshift`) or a local DuckDB stand-in (`local`, see `local_backend.py`).
+Both return DB-API style connections, so the rest of the pipeline does not
+need to know which one it is talking to.
+
+With `BLUE_GREEN.ENABLED`, the warehouse tables live in `BLUE_GREEN.SCHEMA`
+rather than the backend's default schema, and every connection has its
+search_path set to it, see `blue_green.py`.
+
+Connections are pooled: closing one hands it back to a process wide pool,
+and the next `connect()` with the same settings reuses it rather than
+logging in to the cluster again, so `create_db_tables()`, `etl()` and their
+parallel workers share a few connections for the whole run. Up to
+`CONNECTIONS.POOL_SIZE` idle connections are kept. Redshift connections
+send TCP keepalives, so long COPYs and idle pooled connections are not cut
+off by NAT gateways or load balancers.
+
+With `WLM.ENABLED`, every connection is set up for the pipeline phase it
+is used for, e.g. `staging` or `dashboard`, from the phase's `WLM.PHASES`
+settings: its WLM query group, the number of query slots its statements
+take, its statement timeout and whether it uses the result cache. So the
+loads and the dashboard run in their own WLM queues, see
+`setup_redshift.create_wlm_parameter_group`.
+"""
+import threading
+import psycopg2
+
+schema_create = "CREATE SCHEMA IF NOT EXISTS {};"
+search_path_set = "SET search_path TO {};"
+
+# Session settings of a phase in `WLM.PHASES`, reset before each phase so
+# it does not inherit those of the phase that used the connection before
+session_settings = {
+    'QUERY_GROUP': "SET query_group TO '{}';",
+    'SLOT_COUNT': "SET wlm_query_slot_count TO {};",
+    'STATEMENT_TIMEOUT': "SET statement_timeout TO {};",
+    'RESULT_CACHE': "SET enable_result_cache_for_session TO {};",
+}
+session_reset = ("RESET query_group; RESET wlm_query_slot_count; "
+                 "RESET statement_timeout; "
+                 "RESET enable_result_cache_for_session;")
+
+
+def is_local(config):
+    """ Returns True if the pipeline runs on the local backend """
+    return config['ETL']['BACKEND'] == 'local'
+
+
+def warehouse_schema(config):
+    """ Returns the schema the warehouse tables live in, or None for the
+    backend's default schema """
+    settings = config['BLUE_GREEN']
+    if settings['ENABLED'].lower() != 'true':
+        return None
+    return settings['SCHEMA']
+
+
+def wlm_enabled(config):
+    """ Returns True if connections get the session settings of their
+    phase """
+    return config['WLM']['ENABLED'].lower() == 'true' and \
+        not is_local(config)
+
+
+def session_statements(settings):
+    """ Builds the SET statements of a phase's session settings
+
+    Args:
+        settings: dict of a phase's `WLM.PHASES` entry, whose empty values
+            are left at the cluster's defaults
+
+    Returns:
+        list of String statements
+    """
+    return [statement.format(settings[key])
+            for key, statement in session_settings.items()
+            if settings.get(key)]
+
+
+def set_phase(conn, config, phase):
+    """ Applies the session settings of a phase to a connection, and commits
+
+    The settings are committed, so rolling back the phase's work keeps them.
+    Does nothing unless `WLM.ENABLED`.
+
+    Args:
+        conn: psycopg2 DB connection object, with nothing left uncommitted
+        config: a dict of the loaded json config
+        phase: String, e.g. `staging`, or None for the cluster's defaults
+    """
+    if not wlm_enabled(config):
+        return
+    settings = config['WLM']['PHASES'].get(phase, {}) if phase else {}
+    conn.cursor().execute(
+        ' '.join([session_reset] + session_statements(settings)))
+    conn.commit()
+
+
+def single_transaction(config, phase):
+    """ Returns True if the statements of a phase are committed together
+    rather than one by one, see `CONNECTIONS.SINGLE_TRANSACTION_PHASES` """
+    phases = config['CONNECTIONS']['SINGLE_TRANSACTION_PHASES']
+    return phase in [name.strip() for name in phases.split(',')]
+
+
+def dsn(config):
+    """ Returns the libpq connection string of the Redshift cluster """
+    return ("host={} dbname={} user={} password={} port={} keepalives=1 "
+            "keepalives_idle={} keepalives_interval={} "
+            "keepalives_count={}".format(
+                config['CLUSTER']['HOST'],
+                config['CLUSTER']['DB_NAME'],
+                config['CLUSTER']['DB_USER'],
+                config['CLUSTER']['DB_PASSWORD'],
+                config['CLUSTER']['DB_PORT'],
+                config['CONNECTIONS']['KEEPALIVES_IDLE'],
+                config['CONNECTIONS']['KEEPALIVES_INTERVAL'],
+                config['CONNECTIONS']['KEEPALIVES_COUNT'],
+            ))
+
+
+class PooledConnection:
+    """ A connection borrowed from a ConnectionPool.
+
+    It behaves like the connection it wraps, except that `close()` rolls
+    back anything uncommitted and hands it back to the pool.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already closed")
+        return getattr(self._conn, name)
+
+    @property
+    def autocommit(self):
+        return self._conn.autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._conn.autocommit = value
+
+    def commit(self):
+        self._pool.commits += 1
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+
+class ConnectionPool:
+    """ Idle connections to the warehouse DB, handed out by `connect()`
+
+    Attributes:
+        size: Int, max number of idle connections kept
+        opened: Int, connections opened so far
+        reused: Int, connections handed out again
+        commits: Int, commits made on the pool's connections
+    """
+
+    def __init__(self, config, size):
+        self.config = config
+        self.size = size
+        self.idle = []
+        self.opened = 0
+        self.reused = 0
+        self.commits = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Returns an idle connection, or a new one if there is none """
+        with self._lock:
+            while self.idle:
+                conn = self.idle.pop()
+                if not getattr(conn, 'closed', False):
+                    self.reused += 1
+                    return PooledConnection(self, conn)
+            self.opened += 1
+        return PooledConnection(self, open_connection(self.config))
+
+    def release(self, conn):
+        """ Takes back a connection, closing it if it is broken or the pool
+        is full """
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except (psycopg2.Error, AttributeError):
+            conn.close()
+            return
+        with self._lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        """ Closes the idle connections """
+        with self._lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(config):
+    """ Returns the pool of connections with the config's settings
+
+    Args:
+        config: a dict of the loaded json config
+
+    Returns:
+        a ConnectionPool object, shared by every config with the same
+        backend, database and schema
+    """
+    key = (config['LOCAL']['DB_PATH'] if is_local(config) else dsn(config),
+           warehouse_schema(config))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                config, int(config['CONNECTIONS']['POOL_SIZE']))
+        return _pools[key]
+
+
+def close_pools():
+    """ Closes every idle pooled connection, e.g. at the end of a run """
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
+def connect(config, phase=None):
+    """ Returns a connection to the warehouse DB, reusing an idle pooled one
+    if there is one
+
+    Args:
+        config: a dict of the loaded json config
+        phase: String, the phase whose session settings the connection gets,
+            see `set_phase`
+
+    Returns:
+        a PooledConnection object, or an unpooled psycopg2 DB connection
+        or LocalConnection object if `CONNECTIONS.POOL_SIZE` is 0
+    """
+    if int(config['CONNECTIONS']['POOL_SIZE']) <= 0:
+        conn = open_connection(config)
+    else:
+        conn = get_pool(config).acquire()
+    set_phase(conn, config, phase)
+    return conn
+
+
+def open_connection(config):
+    """ Opens a new connection to the warehouse DB
+
+    Args:
+        config: a dict of the loaded json config
+
+    Returns:
+        psycopg2 DB connection object, or a LocalConnection object for the
+        local backend
+    """
+    if is_local(config):
+        from scripts.local_backend import connect as connect_local
+        conn = connect_local(config)
+    else:
+        conn = psycopg2.connect(dsn(config))
+
+    schema = warehouse_schema(config)
+    if schema:
+        cur = conn.cursor()
+        cur.execute(schema_create.format(schema))
+        cur.execute(search_path_set.format(schema))
+        conn.commit()
+    return conn
+
+
+def get_object_store(config):
+    """ Returns the client used to list and read the input files
+
+    Args:
+        config: a dict of the loaded json config
+
+    Returns:
+        a boto3 client object for the AWS S3 service, or a LocalObjectStore
+        over `LOCAL.DATA_DIR` for the local backend
+    """
+    if is_local(config):
+        from scripts.local_backend import LocalObjectStore
+        return LocalObjectStore(config['LOCAL']['DATA_DIR'])
+
+    from scripts.helpers import get_s3_client
+    return get_s3_client(config)
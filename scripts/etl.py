@@ -2,65 +2,572 @@
 This module defines an ETL pipeline that imports data song and log
 data from .json files in AWS S3 buckets into a Redshift cluster DB.
 """
-import configparser
-import psycopg2
+import re
+import time
 import json
-from scripts.sql_queries import copy_table_queries, insert_table_queries
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from scripts.sql_queries import copy_table_queries, insert_table_queries, \
+    insert_table_steps, insert_table_dependencies, \
+    incremental_insert_table_steps, incremental_insert_table_dependencies, \
+    staging_events_clear, staging_songs_clear, staging_events_manifest_copy, \
+    staging_songs_copy, staging_events_copy, staging_songs_manifest_copy, \
+    staging_events_compacted_copy, staging_songs_compacted_copy, \
+    staging_events_parquet_copy, staging_songs_parquet_copy, \
+    load_version_bump, songplay_staging_insert, songplay_table_insert, \
+    songplay_table_append_staged, songplay_table_unrecorded_select, \
+    rollup_table_rebuilds
+from scripts.scheduler import run_dag, print_timeline, topological_order
+from scripts.create_tables import create_tables
+from scripts.db import connect, get_object_store, is_local, \
+    warehouse_schema, single_transaction, set_phase
+from scripts.manifests import list_objects, build_manifest, upload_manifest, \
+    split_s3_url, list_objects_parallel, cluster_slices, \
+    build_slice_manifests, print_slice_report
+from scripts.load_state import pending_objects, record_loaded_keys
+from scripts.compact import compact_inputs
+from scripts.convert_parquet import convert_to_s3
+from scripts.metrics import RunReport, execute, publish, statement_name
+from scripts.checkpoints import skip, commit, PhaseCommits
+from scripts.load_errors import LoadErrors
+from scripts.time_dimension import extend_time_dimension
+from scripts.maintenance import maintain
+from scripts.plan_audit import preflight
+from scripts.resize import scale_up, scale_down
 
 CFG_FILE = 'dwh_config.json'
 
 
-def load_staging_tables(cur, conn):
+def copy_target(query):
+    """ Returns the name of the table a COPY statement loads into """
+    return re.search(r'COPY\s+(\w+)', query, re.IGNORECASE).group(1)
+
+
+def outside_transaction(query):
+    """ Returns True for statements that can not run inside a transaction
+    block, i.e. ALTER TABLE APPEND """
+    return re.match(r'\s*ALTER\s+TABLE\s+\w+\s+APPEND\b', query,
+                    re.IGNORECASE) is not None
+
+
+def append_songplays(steps, dependencies):
+    """ Splits the songplays step into building the new songplays in
+    staging_songplays, and moving them into songplays with ALTER TABLE
+    APPEND. The APPEND moves the staged blocks rather than copying the rows,
+    and only locks songplays for as long as that takes.
+
+    Statements the songplays step runs ahead of its insert, e.g. deleting
+    the songplays of an unrecorded load, move with it to the new step.
+
+    Args:
+        steps: dict of step name to insert statement
+        dependencies: dict of step name to the steps it needs
+
+    Returns:
+        steps: dict, with a `songplays_staged` step added
+        dependencies: dict
+    """
+    staged = steps['songplays'].replace(songplay_table_insert,
+                                        songplay_staging_insert)
+    steps = dict(steps, songplays_staged=staged,
+                 songplays=songplay_table_append_staged)
+    dependencies = dict(dependencies,
+                        songplays_staged=dependencies['songplays'],
+                        songplays=['songplays_staged'])
+    return steps, dependencies
+
+
+def recover_unrecorded_load(cur, steps):
+    """ Checks for songplays left behind by an incremental run that failed
+    after committing some of its inserts, but before recording its log files
+
+    The rerun loads the same log files again and its songplays step deletes
+    the old rows first, see `sql_queries.songplay_table_reload`. The rollups
+    may or may not have merged those rows in already, so rather than being
+    merged into, they are rebuilt from all of songplays.
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        steps: dict of step name to insert statement of an incremental run
+
+    Returns:
+        dict of step name to insert statement
+    """
+    cur.execute(songplay_table_unrecorded_select)
+    rows = cur.fetchone()[0]
+    if not rows:
+        return steps
+    print("Found {} songplays of a load that was never recorded; replacing "
+          "them and rebuilding the rollups".format(rows))
+    return dict(steps, **rollup_table_rebuilds)
+
+
+def copy_names(queries):
+    """ Names each COPY after the table it loads into, naming repeated COPYs
+    into a table `table[n]` """
+    counts = {}
+    names = []
+    for query in queries:
+        table = copy_target(query)
+        i = counts.get(table, 0)
+        names.append(table if i == 0 else "{}[{}]".format(table, i))
+        counts[table] = i + 1
+    return names
+
+
+def load_staging_tables(cur, conn, queries=None, report=None,
+                        checkpoints=None, single=False, load_errors=None):
     """ Loads song and log data from Udacity S3 buckets
     into the staging tables.
 
     Args:
         cur: Psycopg2 DB cursor object
         conn: psycopg2 DB connection object
+        queries: list of COPY statements, defaults to `copy_table_queries`
+        report: a metrics.RunReport to record each COPY in
+        checkpoints: a checkpoints.Checkpoints to record each COPY in
+        single: Bool, commit all the COPYs at once rather than one by one
+        load_errors: a load_errors.LoadErrors to quarantine the records each
+            COPY rejects in
 
     Returns:
         None
     """
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+    queries = copy_table_queries if queries is None else queries
+    phase = PhaseCommits(conn, checkpoints, single)
+    for name, query in zip(copy_names(queries), queries):
+        step = 'staging/COPY ' + name
+        if skip(checkpoints, step):
+            continue
+        execute(cur, query, 'staging', report, 'COPY ' + name)
+        if load_errors is not None:
+            load_errors.triage(cur, name, copy_target(query), report)
+        phase.step_done(cur, step)
+    phase.commit_phase()
     print("Loaded the staging tables")
 
 
-def insert_tables(cur, conn):
+def load_staging_tables_parallel(connect_db, workers, queries=None,
+                                 report=None, checkpoints=None,
+                                 load_errors=None):
+    """ Runs the staging COPYs of each table on its own connection,
+    concurrently.
+
+    COPYs into the same table run one after the other on that table's
+    connection, since they would otherwise wait on each other's locks. At
+    most `workers` tables are loaded at once. Nothing is committed until
+    every COPY has succeeded; if any COPY fails, the in-flight ones are
+    cancelled, all of them are rolled back and the first error is re-raised,
+    so the staging tables are never left half loaded.
+
+    Args:
+        connect_db: a function returning a new DB connection object
+        workers: Int, max number of tables to load at the same time
+        queries: list of COPY statements, defaults to `copy_table_queries`
+        report: a metrics.RunReport to record each COPY in
+        checkpoints: a checkpoints.Checkpoints to record each COPY in. COPYs
+            a resumed run has already finished are skipped.
+        load_errors: a load_errors.LoadErrors to quarantine the records each
+            COPY rejects in. A table going over its error budget fails the
+            staging like a failed COPY.
+
+    Returns:
+        dict of COPY name to the wall-clock seconds it took. Repeated COPYs
+        into a table are named `table[n]`.
+    """
+    queries = copy_table_queries if queries is None else queries
+    groups = {}
+    for name, query in zip(copy_names(queries), queries):
+        if not skip(checkpoints, 'staging/COPY ' + name):
+            groups.setdefault(copy_target(query), []).append((name, query))
+
+    conns = {}
+    timings = {}
+    failed = threading.Event()
+
+    def run_copies(table, table_queries):
+        conn = connect_db()
+        conns[table] = conn
+        cur = conn.cursor()
+        for name, query in table_queries:
+            if failed.is_set():
+                raise RuntimeError(
+                    "COPY {} skipped, staging failed".format(name))
+            start = time.time()
+            execute(cur, query, 'staging', report, 'COPY ' + name)
+            if load_errors is not None:
+                load_errors.triage(cur, name, table, report)
+            timings[name] = time.time() - start
+            if checkpoints is not None:
+                checkpoints.mark(cur, 'staging/COPY ' + name)
+            print("COPY {} finished in {:.1f}s".format(name, timings[name]))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = [executor.submit(run_copies, table, table_queries)
+                   for table, table_queries in groups.items()]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        errors = [f.exception() for f in done if f.exception() is not None]
+        if errors:
+            failed.set()
+            for future in not_done:
+                future.cancel()
+            for conn in list(conns.values()):
+                conn.cancel()
+            wait(not_done)
+            for conn in conns.values():
+                conn.rollback()
+            print("Staging failed, rolled back all COPYs: ", errors[0])
+            raise errors[0]
+
+        for conn in conns.values():
+            conn.commit()
+        if checkpoints is not None:
+            checkpoints.finish(['staging/COPY ' + name for name in timings])
+    finally:
+        executor.shutdown(wait=True)
+        for conn in conns.values():
+            conn.close()
+
+    print("Loaded the staging tables in parallel")
+    return timings
+
+
+def insert_tables(cur, conn, queries=None, report=None, checkpoints=None,
+                  names=None, single=False):
     """ Inserts data from staging tables into the
     final star-schema fact & dimension tables
 
     Args:
         cur: Psycopg2 DB cursor object
         conn: psycopg2 DB connection object
+        queries: list of insert statements, defaults to
+            `insert_table_queries`
+        report: a metrics.RunReport to record each insert in
+        checkpoints: a checkpoints.Checkpoints to record each insert in
+        names: list of the String step names of the queries, defaults to
+            their `statement_name`
+        single: Bool, commit all the inserts at once rather than one by one.
+            Statements that can not run in a transaction still run on their
+            own, after committing the inserts before them.
 
     Returns:
         None
     """
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+    queries = insert_table_queries if queries is None else queries
+    names = names or [statement_name(query) for query in queries]
+    phase = PhaseCommits(conn, checkpoints, single)
+    for name, query in zip(names, queries):
+        step = 'insert/' + name
+        if skip(checkpoints, step):
+            continue
+        if outside_transaction(query):
+            phase.commit_phase()
+            conn.autocommit = True
+            execute(cur, query, 'insert', report)
+            commit(conn, cur, checkpoints, step)
+            conn.autocommit = False
+            continue
+        execute(cur, query, 'insert', report)
+        phase.step_done(cur, step)
+    phase.commit_phase()
     print("Loaded the production tables")
 
 
-def etl():
-    with open(CFG_FILE) as f:
-        config = json.load(f)
+def insert_tables_parallel(connect_db, workers, steps=None,
+                           dependencies=None, report=None, checkpoints=None):
+    """ Runs the insert steps concurrently in dependency order
+
+    Each step runs and commits on its own connection as soon as the steps it
+    depends on have finished.
+
+    Args:
+        connect_db: a function returning a new DB connection object
+        workers: Int, max number of inserts to run at the same time
+        steps: dict of step name to insert statement, defaults to
+            `insert_table_steps`
+        dependencies: dict of step name to the steps it needs, defaults to
+            `insert_table_dependencies`
+        report: a metrics.RunReport to record each insert in
+        checkpoints: a checkpoints.Checkpoints to record each step in. Steps
+            a resumed run has already finished count as done right away.
+
+    Returns:
+        list of timeline dicts, as returned by `scheduler.run_dag`
+    """
+    steps = insert_table_steps if steps is None else steps
+    dependencies = (insert_table_dependencies if dependencies is None
+                    else dependencies)
+
+    def run_insert(step, query):
+        if skip(checkpoints, 'insert/' + step):
+            return
+        conn = connect_db()
+        try:
+            conn.autocommit = outside_transaction(query)
+            cur = conn.cursor()
+            execute(cur, query, 'insert', report, step)
+            commit(conn, cur, checkpoints, 'insert/' + step)
+        finally:
+            conn.close()
 
-    conn = psycopg2.connect(
-        "host={} dbname={} user={} password={} port={}".format(
-            config['CLUSTER']['HOST'],
-            config['CLUSTER']['DB_NAME'],
-            config['CLUSTER']['DB_USER'],
-            config['CLUSTER']['DB_PASSWORD'],
-            config['CLUSTER']['DB_PORT'],
-        )
-    )
+    timeline = run_dag(steps, dependencies, run_insert, workers)
+    print_timeline(timeline, dependencies)
+    print("Loaded the production tables in parallel")
+    return timeline
 
+
+def plan_song_copies(s3, config):
+    """ Plans the COPYs of the song data
+
+    If the inputs have been converted to Parquet or compacted, the converted
+    or compacted song data is COPYed.
+    With `ETL.SONG_MANIFESTS` enabled, the song_data prefix is listed in
+    parallel and split into manifests sized to the cluster's slice count,
+    each loaded by its own COPY. Otherwise the whole prefix is COPYed at once.
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service, or its local
+            stand-in
+        config: a dict of the loaded json config
+
+    Returns:
+        list of COPY statements
+    """
+    if config['PARQUET']['ENABLED'].lower() == 'true':
+        return [staging_songs_parquet_copy]
+    if config['COMPACTION']['ENABLED'].lower() == 'true':
+        return [staging_songs_compacted_copy]
+    if config['ETL']['SONG_MANIFESTS'].lower() != 'true':
+        return [staging_songs_copy]
+
+    song_objects = list_objects_parallel(s3, config['S3']['SONG_DATA'],
+                                         int(config['ETL']['LIST_WORKERS']))
+    bucket, prefix = split_s3_url(config['S3']['SONG_DATA'])
+    manifests, report = build_slice_manifests(
+        bucket, song_objects, cluster_slices(config),
+        int(config['ETL']['MAX_FILES_PER_MANIFEST']))
+    print_slice_report(report)
+
+    return [
+        staging_songs_manifest_copy.format(upload_manifest(
+            s3, manifest, config['S3']['MANIFEST_PREFIX'],
+            'song_data-{}'.format(i)))
+        for i, manifest in enumerate(manifests)
+    ]
+
+
+def prepare_inputs(s3, config, full_refresh=True):
+    """ Converts the inputs to Parquet or compacts them, if enabled
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        config: a dict of the loaded json config
+        full_refresh: Bool, the log data is loaded from the converted files.
+            Otherwise only the song data is converted, since incremental runs
+            COPY the new raw log files.
+
+    Returns:
+        String, the COPY statement that loads all of the log data
+    """
+    if config['PARQUET']['ENABLED'].lower() == 'true':
+        convert_to_s3(s3, config, None if full_refresh else ['song_data'])
+        return staging_events_parquet_copy
+    if config['COMPACTION']['ENABLED'].lower() == 'true':
+        compact_inputs(s3, config)
+        return staging_events_compacted_copy
+    return staging_events_copy
+
+
+def plan_staging(cur, config, full_refresh):
+    """ Works out which COPYs to run and which log files they will load
+
+    A full refresh COPYs everything under the log and song prefixes. An
+    incremental run writes a manifest of the log files missing from
+    `load_state` and COPYs only those, into emptied staging tables.
+
+    With `PARQUET.ENABLED` or `COMPACTION.ENABLED`, the inputs are
+    converted to Parquet or compacted first, and the song data, plus the log
+    data on a full refresh, is COPYed from the converted files. Incremental
+    runs still COPY the new raw log files, since the converted files also
+    hold log events that were loaded before.
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        config: a dict of the loaded json config
+        full_refresh: Bool, load all of the log data
+
+    Returns:
+        copy_queries: list of COPY statements, empty if there is nothing new
+        log_keys: list of String keys of the log files being loaded
+    """
+    s3 = get_object_store(config)
+    if full_refresh:
+        events_copy = prepare_inputs(s3, config)
+        log_objects = list_objects(s3, config['S3']['LOG_DATA'])
+        song_copies = plan_song_copies(s3, config)
+        return [events_copy] + song_copies, \
+            [key for key, size in log_objects]
+
+    log_objects = pending_objects(cur, s3, config['S3']['LOG_DATA'])
+    log_keys = [key for key, size in log_objects]
+    if not log_keys:
+        return [], []
+
+    bucket, prefix = split_s3_url(config['S3']['LOG_DATA'])
+    manifest_url = upload_manifest(s3, build_manifest(bucket, log_keys),
+                                   config['S3']['MANIFEST_PREFIX'], 'log_data')
+    print("Loading {} new log files ({:.1f} MB) from {}".format(
+        len(log_keys), sum(size for key, size in log_objects) / 1024 ** 2,
+        manifest_url))
+    prepare_inputs(s3, config, full_refresh=False)
+    song_copies = plan_song_copies(s3, config)
+    if song_copies:
+        song_copies[0] = staging_songs_clear + song_copies[0]
+    return [
+        staging_events_clear + staging_events_manifest_copy.format(
+            manifest_url),
+    ] + song_copies, log_keys
+
+
+def etl(full_refresh=True, config=None, report=None, checkpoints=None):
+    """ Runs the ETL pipeline
+
+    Args:
+        full_refresh: Bool, reload all of the log data. Otherwise only the
+            log files that have not been loaded yet are COPYed, and their
+            rows appended to the existing tables. If a previous incremental
+            run failed before recording its log files, the rows it already
+            committed are replaced, see `recover_unrecorded_load`. Tables
+            left unsorted or with stale statistics are vacuumed and analyzed
+            at the end, see `maintenance.py`. With `RESIZE.ENABLED`, the
+            cluster is resized up for a heavy load first and back down at
+            the end, see `resize.py`. With `BLUE_GREEN.ENABLED`, new
+            songplays are moved into songplays with ALTER TABLE APPEND. With
+            `PLAN_AUDIT.ENABLED`, an incremental run first checks the plans
+            of its inserts, see `plan_audit.py`. The time dimension is
+            extended to the staged log events before the inserts run, see
+            `time_dimension.py`.
+        config: a dict of the loaded json config, read from `CFG_FILE` if
+            not given
+        report: a metrics.RunReport to record the run in. If not given, a
+            new report is made and published when the run finishes.
+        checkpoints: a checkpoints.Checkpoints to record each finished step
+            in. A resumed run skips the steps it has already finished and
+            reuses its staging plan.
+
+    The phases listed in `CONNECTIONS.SINGLE_TRANSACTION_PHASES` commit all
+    of their statements at once. This applies to phases run on the main
+    connection; parallel staging commits each table's COPYs once on its own
+    connection, and parallel inserts commit each step as it finishes.
+
+    Returns:
+        the metrics.RunReport of the run
+    """
+    if config is None:
+        with open(CFG_FILE) as f:
+            config = json.load(f)
+    owns_report = report is None
+    if owns_report:
+        report = RunReport(redshift_stats=not is_local(config))
+
+    conn = connect(config)
     cur = conn.cursor()
 
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    if full_refresh:
+        steps = insert_table_steps
+        dependencies = insert_table_dependencies
+    else:
+        set_phase(conn, config, 'create_tables')
+        create_tables(cur, conn, report, checkpoints,
+                      single_transaction(config, 'create_tables'))
+        set_phase(conn, config, None)
+        steps = recover_unrecorded_load(cur, incremental_insert_table_steps)
+        dependencies = incremental_insert_table_dependencies
+    if warehouse_schema(config):
+        steps, dependencies = append_songplays(steps, dependencies)
+    if not full_refresh:
+        preflight(cur, config, steps, report)
+
+    resized = scale_up(cur, config, full_refresh, report)
+    try:
+        # Song manifests are split to the slices of the resized cluster
+        load_config = config if resized is None else dict(
+            config, CLUSTER=dict(config['CLUSTER'], NUM_NODES=str(resized)))
+        start = time.time()
+        if skip(checkpoints, 'staging/plan'):
+            plan = checkpoints.load_document('plan')
+            copy_queries, log_keys = plan['copy_queries'], plan['log_keys']
+        else:
+            copy_queries, log_keys = plan_staging(cur, load_config,
+                                                  full_refresh)
+            if checkpoints is not None:
+                checkpoints.save_document('plan', {
+                    'copy_queries': copy_queries, 'log_keys': log_keys})
+                checkpoints.finish(['staging/plan'])
+        report.record_event('staging', 'plan', time.time() - start,
+                            copies=len(copy_queries), log_files=len(log_keys))
+        if not copy_queries:
+            print("No new log data to load")
+            if owns_report:
+                publish(report, config)
+            return report
+
+        load_errors = LoadErrors(config, report.run_id)
+        try:
+            if config['ETL']['PARALLEL_STAGING'].lower() == 'true':
+                load_staging_tables_parallel(
+                    lambda: connect(config, 'staging'),
+                    int(config['ETL']['STAGING_WORKERS']), copy_queries,
+                    report, checkpoints, load_errors)
+            else:
+                set_phase(conn, config, 'staging')
+                load_staging_tables(cur, conn, copy_queries, report,
+                                    checkpoints,
+                                    single_transaction(config, 'staging'),
+                                    load_errors)
+        finally:
+            path = load_errors.write_report()
+            if path:
+                print("Rejected records written to ", path)
+
+        if not skip(checkpoints, 'insert/times'):
+            # Ends the transaction the staging plan was read in, so the
+            # COPYs committed on other connections are seen
+            conn.commit()
+            set_phase(conn, config, 'insert')
+            extend_time_dimension(cur, config, report)
+            commit(conn, cur, checkpoints, 'insert/times')
+
+        if config['ETL']['PARALLEL_INSERTS'].lower() == 'true':
+            insert_tables_parallel(lambda: connect(config, 'insert'),
+                                   int(config['ETL']['INSERT_WORKERS']),
+                                   steps, dependencies, report, checkpoints)
+        else:
+            order = topological_order(dependencies)
+            set_phase(conn, config, 'insert')
+            insert_tables(cur, conn, [steps[step] for step in order], report,
+                          checkpoints, order,
+                          single_transaction(config, 'insert'))
+
+        if not skip(checkpoints, 'load_state/record'):
+            start = time.time()
+            set_phase(conn, config, 'load_state')
+            record_loaded_keys(cur, log_keys, replace=full_refresh)
+            execute(cur, load_version_bump, 'load_state', report)
+            commit(conn, cur, checkpoints, 'load_state/record')
+            report.record_event('load_state', 'record', time.time() - start,
+                                log_files=len(log_keys))
+            print("Recorded {} loaded log files".format(len(log_keys)))
 
-    conn.close()
+        conn.close()
+        if not skip(checkpoints, 'maintenance/maintain'):
+            maintain(config, report)
+            if checkpoints is not None:
+                checkpoints.finish(['maintenance/maintain'])
+    finally:
+        conn.close()
+        scale_down(config, resized, report)
+    if owns_report:
+        publish(report, config)
+    return report
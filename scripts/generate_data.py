@@ -0,0 +1,246 @@
+"""
+Generates synthetic song & log data shaped like the Udacity datasets.
+
+Songs are written one per file under `song_data/`, partitioned by the
+letters of their track ID, and app events are written one file per day
+under `log_data/<year>/<month>/`, like the Million Song Dataset subset and
+the eventsim logs in the README. A `log_json_path.json` matching
+`S3.LOG_JSONPATH` is written alongside them. The same seed always produces
+the same files.
+
+Typical Usage example:
+    $ python3 -m scripts.generate_data -o data --songs 5000 --events 20000
+"""
+import os
+import sys
+import json
+import getopt
+import random
+import string
+from datetime import datetime, timedelta
+
+LOG_FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession',
+              'lastName', 'length', 'level', 'location', 'method', 'page',
+              'registration', 'sessionId', 'song', 'status', 'ts',
+              'userAgent', 'userId']
+FIRST_NAMES = ['Kaylee', 'Lily', 'Jacob', 'Tegan', 'Chloe', 'Aleena',
+               'Ryan', 'Jayden', 'Mohammad', 'Matthew', 'Sara', 'Wyatt']
+LAST_NAMES = ['Summers', 'Koch', 'Klein', 'Levine', 'Cuevas', 'Kirby',
+              'Smith', 'Graves', 'Rodriguez', 'Jones', 'Johnson', 'Scott']
+LOCATIONS = ['Phoenix-Mesa-Scottsdale, AZ', 'Chicago-Naperville-Elgin, IL-IN-WI',
+             'San Francisco-Oakland-Hayward, CA', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Portland-South Portland, ME', 'Lansing-East Lansing, MI',
+             'New York-Newark-Jersey City, NY-NJ-PA', 'Tampa-St. Petersburg-Clearwater, FL']
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like '
+    'Gecko) Chrome/35.0.1916.153 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0',
+]
+OTHER_PAGES = ['Home', 'Settings', 'About', 'Help', 'Upgrade', 'Logout']
+
+
+def random_id(rng, prefix, length=16):
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits)
+                            for _ in range(length))
+
+
+def generate_songs(rng, n_songs, n_artists):
+    """ Builds song records in the Million Song Dataset shape
+
+    Args:
+        rng: a random.Random object
+        n_songs: Int, number of songs
+        n_artists: Int, number of distinct artists
+
+    Returns:
+        list of song dicts
+    """
+    artists = []
+    for i in range(n_artists):
+        located = rng.random() < 0.4
+        artists.append({
+            'artist_id': random_id(rng, 'AR'),
+            'artist_latitude': round(rng.uniform(-60, 70), 5)
+            if located else None,
+            'artist_longitude': round(rng.uniform(-150, 150), 5)
+            if located else None,
+            'artist_location': rng.choice(LOCATIONS) if located else '',
+            'artist_name': 'Artist {}'.format(i),
+        })
+
+    songs = []
+    for i in range(n_songs):
+        song = dict(rng.choice(artists))
+        song.update({
+            'num_songs': 1,
+            'song_id': random_id(rng, 'SO'),
+            'title': 'Song {}'.format(i),
+            'duration': round(rng.uniform(60, 600), 5),
+            'year': rng.choice([0] * 4 + list(range(1960, 2019))),
+        })
+        songs.append(song)
+    return songs
+
+
+def generate_users(rng, n_users):
+    """ Builds the app's users, each with a fixed name, location & agent """
+    return [{
+        'userId': str(i + 1),
+        'firstName': rng.choice(FIRST_NAMES),
+        'lastName': rng.choice(LAST_NAMES),
+        'gender': rng.choice('MF'),
+        'level': rng.choice(['free', 'free', 'paid']),
+        'location': rng.choice(LOCATIONS),
+        'userAgent': rng.choice(USER_AGENTS),
+        'registration': float(rng.randint(1530000000000, 1540000000000)),
+    } for i in range(n_users)]
+
+
+def generate_events(rng, day, n_events, users, songs, weights, session_ids):
+    """ Builds one day of eventsim-style app events
+
+    Args:
+        rng: a random.Random object
+        day: a datetime of the start of the day
+        n_events: Int, number of events on the day
+        users: list of user dicts
+        songs: list of song dicts
+        weights: list of cumulative song popularity weights
+        session_ids: an itertools-style counter of session IDs
+
+    Returns:
+        list of event dicts, ordered by timestamp
+    """
+    start_ms = int((day - datetime(1970, 1, 1)).total_seconds() * 1000)
+    times = sorted(rng.randrange(86400000) for _ in range(n_events))
+    sessions = {}
+    events = []
+    for offset in times:
+        user = rng.choice(users)
+        session = sessions.get(user['userId'])
+        if session is None or rng.random() < 0.02:
+            session = sessions[user['userId']] = [next(session_ids), 0]
+        session[1] += 1
+
+        event = {
+            'artist': None, 'auth': 'Logged In',
+            'firstName': user['firstName'], 'gender': user['gender'],
+            'itemInSession': session[1] - 1, 'lastName': user['lastName'],
+            'length': None, 'level': user['level'],
+            'location': user['location'], 'method': 'GET', 'page': 'Home',
+            'registration': user['registration'], 'sessionId': session[0],
+            'song': None, 'status': 200, 'ts': start_ms + offset,
+            'userAgent': user['userAgent'], 'userId': user['userId'],
+        }
+        if rng.random() < 0.8:
+            song = rng.choices(songs, cum_weights=weights)[0]
+            event.update({'artist': song['artist_name'],
+                          'song': song['title'], 'length': song['duration'],
+                          'method': 'PUT', 'page': 'NextSong'})
+        else:
+            event['page'] = rng.choice(OTHER_PAGES)
+            if rng.random() < 0.1:
+                event.update({'auth': 'Logged Out', 'firstName': None,
+                              'gender': None, 'lastName': None,
+                              'location': None, 'registration': None,
+                              'userAgent': None, 'userId': '',
+                              'page': 'Login'})
+        events.append(event)
+    return events
+
+
+def song_path(out_dir, song):
+    track = random_id(random.Random(song['song_id']), 'TR')
+    return os.path.join(out_dir, 'song_data', track[2], track[3], track[4],
+                        track + '.json')
+
+
+def generate(out_dir, seed=0, n_songs=1000, n_artists=None, n_users=100,
+             n_events=10000, start='2018-11-01', days=30, skew=1.0):
+    """ Writes a synthetic song & log dataset to a local directory
+
+    Args:
+        out_dir: String, directory to write `song_data/`, `log_data/` and
+            `log_json_path.json` to
+        seed: Int, random seed; the same seed gives the same files
+        n_songs: Int, number of songs
+        n_artists: Int, number of artists, defaults to a third of the songs
+        n_users: Int, number of app users
+        n_events: Int, total number of log events over the date range
+        start: String, first day of the logs as YYYY-MM-DD
+        days: Int, number of days of logs
+        skew: Float, Zipf exponent of song popularity; 0 plays every song
+            equally often
+
+    Returns:
+        dict with the number of `songs`, `events` and `files` written
+    """
+    rng = random.Random(seed)
+    songs = generate_songs(rng, n_songs, n_artists or max(1, n_songs // 3))
+    users = generate_users(rng, n_users)
+
+    weights = []
+    total = 0.0
+    for rank in range(1, n_songs + 1):
+        total += 1.0 / rank ** skew
+        weights.append(total)
+
+    files = 0
+    for song in songs:
+        path = song_path(out_dir, song)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(song, f)
+        files += 1
+
+    session_ids = iter(range(1, sys.maxsize))
+    first_day = datetime.strptime(start, '%Y-%m-%d')
+    per_day = [n_events // days + (1 if i < n_events % days else 0)
+               for i in range(days)]
+    for i, day_events in enumerate(per_day):
+        day = first_day + timedelta(days=i)
+        path = os.path.join(out_dir, 'log_data', day.strftime('%Y'),
+                            day.strftime('%m'),
+                            day.strftime('%Y-%m-%d-events.json'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        events = generate_events(rng, day, day_events, users, songs, weights,
+                                 session_ids)
+        with open(path, 'w') as f:
+            f.write('\n'.join(json.dumps(event) for event in events))
+        files += 1
+
+    with open(os.path.join(out_dir, 'log_json_path.json'), 'w') as f:
+        json.dump({'jsonpaths': ["$['{}']".format(field)
+                                 for field in LOG_FIELDS]}, f, indent=4)
+
+    return {'songs': n_songs, 'events': n_events, 'files': files}
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "o:s:", [
+            "songs=", "artists=", "users=", "events=", "start=", "days=",
+            "skew="])
+    except getopt.GetoptError:
+        print("USAGE: generate_data.py -o <out_dir> [-s <seed>] [--songs N] "
+              "[--artists N] [--users N] [--events N] [--start YYYY-MM-DD] "
+              "[--days N] [--skew S]")
+        sys.exit(2)
+    opts = dict(opts)
+    summary = generate(
+        opts['-o'], seed=int(opts.get('-s', 0)),
+        n_songs=int(opts.get('--songs', 1000)),
+        n_artists=int(opts['--artists']) if '--artists' in opts else None,
+        n_users=int(opts.get('--users', 100)),
+        n_events=int(opts.get('--events', 10000)),
+        start=opts.get('--start', '2018-11-01'),
+        days=int(opts.get('--days', 30)),
+        skew=float(opts.get('--skew', 1.0)))
+    print("Generated {songs} songs and {events} events in {files} files"
+          .format(**summary))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
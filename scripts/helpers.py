@@ -1,8 +1,9 @@
 import os
+import time
 import boto3
 
-AWS_ACCESS_KEY = os.environ['AWS_ACCESS_KEY_ID']
-AWS_SECRET = os.environ['AWS_SECRET_ACCESS_KEY']
+AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY_ID')
+AWS_SECRET = os.environ.get('AWS_SECRET_ACCESS_KEY')
 CFG_FILE = 'dwh_config.json'
 
 
@@ -29,3 +30,48 @@ def get_aws_clients(config):
                             aws_secret_access_key=AWS_SECRET
                             )
     return iam, redshift
+
+
+def get_s3_client(config):
+    """Retrieves an AWS client for the s3 service
+
+    Args:
+        config: a ConfigParser object
+
+    Returns:
+        s3: AWS client object for s3 service
+    """
+    return boto3.client("s3",
+                        region_name=config['AWS']['REGION'],
+                        aws_access_key_id=AWS_ACCESS_KEY,
+                        aws_secret_access_key=AWS_SECRET
+                        )
+
+
+def poll(check, deadline_seconds, initial_delay=5, max_delay=60, backoff=2):
+    """ Calls `check` until it returns a truthy value or the deadline passes
+
+    The delay between calls starts at `initial_delay` and is multiplied by
+    `backoff` after every call, up to `max_delay`, so fast operations are
+    noticed quickly without polling slow ones every few seconds. The last
+    sleep is cut short at the deadline.
+
+    Args:
+        check: a function taking no arguments
+        deadline_seconds: Float, how long to keep polling for
+        initial_delay: Float, seconds to wait after the first call
+        max_delay: Float, longest wait between calls
+        backoff: Float, factor the delay grows by
+
+    Returns:
+        the last value returned by `check`
+    """
+    deadline = time.time() + deadline_seconds
+    delay = initial_delay
+    while True:
+        result = check()
+        remaining = deadline - time.time()
+        if result or remaining <= 0:
+            return result
+        time.sleep(min(delay, remaining))
+        delay = min(delay * backoff, max_delay)
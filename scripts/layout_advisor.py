@@ -0,0 +1,342 @@
+"""
+Recommends distribution and sort keys for the star-schema tables from the
+queries that are actually run against them.
+
+The workload is read either from the cluster's query history (`STL_QUERY`,
+weighted by the scans in `STL_SCAN`) or from a captured log of queries, such
+as the dashboard's. Each query's joins and filters are parsed, and together
+with the table sizes from `SVV_TABLE_INFO` they decide:
+
+    - the fact table's DISTKEY: the column it joins on to its largest
+      dimension, which is distributed on the same column so the join is
+      collocated instead of redistributed
+    - DISTSTYLE ALL for the other dimensions small enough to copy to every
+      node, so joining them never needs a broadcast
+    - each table's SORTKEY: its most filtered column, or else the join
+      column it is most often merged on, preferring timestamps
+
+The recommendation is printed as a `TABLES` config block and the DDL it
+produces.
+
+Typical Usage example:
+    $ python3 -m scripts.layout_advisor [-w workload.sql] [--days 7]
+        [-o tables.json] [--apply]
+"""
+import re
+import sys
+import json
+import getopt
+from collections import Counter
+from scripts.db import connect, is_local
+from scripts.table_layout import create_table, column_types
+
+CFG_FILE = 'dwh_config.json'
+
+# Tables with at most this many rows are copied to every node
+ALL_MAX_ROWS = 3000000
+# Tables loaded or maintained by the pipeline itself, whose layout is not
+# driven by the query workload
+PIPELINE_TABLES = {'staging_events', 'staging_songs', 'staging_events_keyed',
+                   'staging_songs_keyed', 'staging_songplays', 'load_state',
+                   'load_version'}
+
+# The keys of a `TABLES` entry the advisor recommends; the others, such as
+# `COLUMNS`, are kept as they are
+LAYOUT_KEYS = {'DISTSTYLE', 'DISTKEY', 'SORTKEY'}
+
+SQL_KEYWORDS = {'on', 'where', 'join', 'left', 'right', 'inner', 'outer',
+                'full', 'cross', 'group', 'order', 'limit', 'using', 'as',
+                'having', 'union', 'natural'}
+TABLE_REF = re.compile(
+    r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(?!(?:{})\b)(\w+))?'.format(
+        '|'.join(SQL_KEYWORDS)), re.IGNORECASE)
+JOIN_CONDITION = re.compile(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)')
+FILTER_CONDITION = re.compile(
+    r'(?:\b(\w+)\.)?\b(\w+)\s*(?:=|<>|!=|>=|<=|<|>|\bBETWEEN\b|\bIN\b|'
+    r'\bLIKE\b|\bILIKE\b)\s*(?![\w]+\.\w)', re.IGNORECASE)
+
+history_select = ("""
+SELECT TRIM(querytxt)
+FROM stl_query
+WHERE starttime > DATEADD(day, -%s, GETDATE())
+    AND userid > 1
+    AND querytxt ILIKE 'select%%';
+""")
+scan_count_select = ("""
+SELECT TRIM(info."table"), COUNT(DISTINCT scan.query)
+FROM stl_scan scan
+    JOIN svv_table_info info ON info.table_id = scan.tbl
+WHERE scan.starttime > DATEADD(day, -%s, GETDATE())
+GROUP BY 1;
+""")
+table_info_select = ("""
+SELECT TRIM("table"), tbl_rows, size, TRIM(diststyle), TRIM(sortkey1)
+FROM svv_table_info
+WHERE schema = current_schema();
+""")
+
+
+def parse_query(query, known_tables):
+    """ Finds the tables a query reads, the columns it joins them on and the
+    columns it filters them on
+
+    Args:
+        query: String, a SELECT statement
+        known_tables: set of String table names to look for
+
+    Returns:
+        tables: set of String table names
+        joins: list of ((table, column), (table, column)) pairs
+        filters: list of (table, column) pairs
+    """
+    aliases = {}
+    for table, alias in TABLE_REF.findall(query):
+        table = table.lower()
+        if table not in known_tables:
+            continue
+        aliases[table] = table
+        if alias:
+            aliases[alias.lower()] = table
+    tables = set(aliases.values())
+
+    joins = []
+    for a, a_column, b, b_column in JOIN_CONDITION.findall(query):
+        a, b = aliases.get(a.lower()), aliases.get(b.lower())
+        if a and b and a != b:
+            joins.append(((a, a_column.lower()), (b, b_column.lower())))
+
+    filters = []
+    where = re.search(r'\bWHERE\b(.*?)(?:\bGROUP\s+BY\b|\bORDER\s+BY\b|'
+                      r'\bLIMIT\b|$)', query, re.IGNORECASE | re.DOTALL)
+    if where:
+        for alias, column in FILTER_CONDITION.findall(where.group(1)):
+            if alias:
+                table = aliases.get(alias.lower())
+            else:
+                table = next(iter(tables)) if len(tables) == 1 else None
+            if table and column.lower() not in SQL_KEYWORDS:
+                filters.append((table, column.lower()))
+    return tables, joins, filters
+
+
+def analyze_workload(queries, known_tables, weights=None):
+    """ Counts how often each table is read, joined and filtered on
+
+    Args:
+        queries: list of String SELECT statements
+        known_tables: set of String table names to look for
+        weights: optional dict of table name to extra scan counts, e.g. from
+            STL_SCAN
+
+    Returns:
+        dict of Counters of `scans` per table, `joins` per pair of
+        (table, column) and `filters` per (table, column)
+    """
+    workload = {'scans': Counter(weights or {}), 'joins': Counter(),
+                'filters': Counter()}
+    for query in queries:
+        tables, joins, filters = parse_query(query, known_tables)
+        workload['scans'].update(tables)
+        workload['joins'].update(tuple(sorted(pair)) for pair in joins)
+        workload['filters'].update(filters)
+    return workload
+
+
+def pick_sort_key(candidates, types):
+    """ Picks the most used of a table's candidate columns, preferring
+    timestamps on a tie """
+    if not candidates:
+        return None
+    return max(candidates, key=lambda column: (
+        candidates[column], types.get(column) in ('TIMESTAMP', 'DATE')))
+
+
+def recommend(table_rows, workload, current, all_max_rows=ALL_MAX_ROWS,
+              columns=None):
+    """ Recommends a layout for each table the workload reads
+
+    Args:
+        table_rows: dict of table name to row count
+        workload: dict returned by `analyze_workload`
+        current: dict of the current `TABLES` config
+        all_max_rows: Int, max rows of a table distributed ALL
+        columns: dict of table name to its column definitions
+
+    Returns:
+        specs: dict of table name to its recommended `TABLES` entry
+        reasons: list of Strings explaining each choice
+    """
+    columns = columns or {}
+    specs = {table: dict(spec) for table, spec in current.items()}
+    reasons = []
+    queried = [table for table in workload['scans']
+               if table not in PIPELINE_TABLES and table in table_rows]
+    if not queried:
+        return specs, ["No queries on the star-schema tables found"]
+
+    joined = {}
+    for ((a, a_column), (b, b_column)), count in workload['joins'].items():
+        joined.setdefault(a, Counter())[(a_column, b, b_column)] += count
+        joined.setdefault(b, Counter())[(b_column, a, a_column)] += count
+
+    fact = max(queried, key=lambda table: (table in joined,
+                                           table_rows[table]))
+    layout = {fact: {}}
+    if fact in joined:
+        # Collocate the fact table with the dimension that would cost the
+        # most to move: the largest one, weighted by how often it is joined
+        column, dim, dim_column = max(
+            joined[fact], key=lambda join: joined[fact][join] *
+            max(table_rows.get(join[1], 0), 1))
+        layout[fact]['DISTKEY'] = column
+        layout[dim] = {'DISTKEY': dim_column}
+        reasons.append(
+            "{}: DISTKEY {}, collocated with {}.{} ({} rows) so their join "
+            "is not redistributed".format(fact, column, dim, dim_column,
+                                          table_rows.get(dim, 0)))
+
+    for table in queried:
+        if table in layout:
+            continue
+        if table_rows[table] <= all_max_rows:
+            layout[table] = {'DISTSTYLE': 'ALL'}
+            reasons.append("{}: DISTSTYLE ALL, {} rows is small enough to "
+                           "copy to every node".format(table,
+                                                       table_rows[table]))
+        else:
+            layout[table] = {'DISTSTYLE': 'EVEN'}
+            reasons.append("{}: DISTSTYLE EVEN, {} rows is too large for ALL "
+                           "and joins to it will be redistributed".format(
+                               table, table_rows[table]))
+
+    for table, spec in layout.items():
+        types = column_types(columns.get(table, ''))
+        filtered = Counter({column: count for (t, column), count
+                            in workload['filters'].items() if t == table})
+        sort_key = pick_sort_key(filtered, types)
+        why = 'most filtered column'
+        if sort_key is None:
+            merged = Counter()
+            for (column, other, other_column), count in \
+                    joined.get(table, {}).items():
+                if column != spec.get('DISTKEY') or len(joined[table]) == 1:
+                    merged[column] += count
+            sort_key = pick_sort_key(merged, types)
+            why = 'join column'
+        if sort_key is None and spec.get('DISTKEY'):
+            sort_key, why = spec['DISTKEY'], 'distribution key'
+        if sort_key:
+            spec['SORTKEY'] = sort_key
+            reasons.append("{}: SORTKEY {}, its {}".format(table, sort_key,
+                                                           why))
+        # Keeps the table's other settings, e.g. the profiler's `COLUMNS`
+        specs[table] = {key: value for key, value
+                        in specs.get(table, {}).items()
+                        if key not in LAYOUT_KEYS}
+        specs[table].update(spec)
+    return specs, reasons
+
+
+def render_ddl(specs, columns):
+    """ Builds the CREATE TABLE statements of a recommended layout
+
+    Args:
+        specs: dict of table name to its `TABLES` entry
+        columns: dict of table name to its column definitions
+
+    Returns:
+        list of String SQL statements
+    """
+    return [create_table(table, columns[table], specs.get(table))
+            for table in columns]
+
+
+def read_workload_file(path):
+    """ Reads a captured log of SQL queries separated by semicolons """
+    with open(path) as f:
+        return [query.strip() for query in f.read().split(';')
+                if query.strip()]
+
+
+def query_history(cur, days):
+    """ Reads the SELECTs run on the cluster and the scans per table
+
+    Returns:
+        queries: list of String SELECT statements
+        scans: dict of table name to the number of queries scanning it
+    """
+    cur.execute(history_select, (days,))
+    queries = [row[0] for row in cur.fetchall()]
+    cur.execute(scan_count_select, (days,))
+    return queries, dict(cur.fetchall())
+
+
+def table_sizes(cur, config, tables):
+    """ Looks up the row count of each table
+
+    On Redshift the counts come from `SVV_TABLE_INFO`; on the local backend
+    each table is counted.
+
+    Returns:
+        dict of table name to row count
+    """
+    if is_local(config):
+        rows = {}
+        for table in tables:
+            cur.execute("SELECT COUNT(*) FROM {};".format(table))
+            rows[table] = cur.fetchone()[0]
+        return rows
+
+    cur.execute(table_info_select)
+    return {table: table_rows for table, table_rows, size, diststyle,
+            sortkey in cur.fetchall()}
+
+
+def main(argv):
+    from scripts.sql_queries import table_columns
+
+    try:
+        opts, args = getopt.getopt(argv, "w:o:", ["days=", "apply"])
+    except getopt.GetoptError:
+        print("USAGE: layout_advisor.py [-w <workload.sql>] [--days 7] "
+              "[-o <tables.json>] [--apply]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    conn = connect(config)
+    cur = conn.cursor()
+    if '-w' in opts:
+        queries, scans = read_workload_file(opts['-w']), {}
+    else:
+        queries, scans = query_history(cur, int(opts.get('--days', 7)))
+    table_rows = table_sizes(cur, config, table_columns)
+    conn.close()
+
+    workload = analyze_workload(queries, set(table_columns), scans)
+    specs, reasons = recommend(table_rows, workload, config['TABLES'],
+                               columns=table_columns)
+
+    print("Analyzed {} queries".format(len(queries)))
+    for reason in reasons:
+        print("    " + reason)
+    print(json.dumps({'TABLES': specs}, indent=2))
+    for query in render_ddl(specs, table_columns):
+        print(query)
+
+    if '-o' in opts:
+        with open(opts['-o'], 'w') as f:
+            json.dump(specs, f, indent=2)
+    if '--apply' in opts:
+        config['TABLES'] = specs
+        with open(CFG_FILE, 'w') as f:
+            json.dump(config, f, indent=2)
+        print("Updated TABLES in {}; run a full refresh to rebuild the "
+              "tables".format(CFG_FILE))
+    return specs
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,181 @@
+"""
+Triages the records COPY rejects within its error budget.
+
+Each JSON COPY runs with `MAXERROR` set to the budget of its staging table in
+`LOAD_ERRORS.MAXERROR`, so a few malformed records no longer abort a whole
+load. After every COPY, the rows it added to STL_LOAD_ERRORS are:
+
+    1. copied into the `public.load_errors` quarantine table, tagged with
+       the run and the COPY
+    2. collected, with file, line, column and reason, into
+       `LOAD_ERRORS.REPORT_DIR/load-errors-<run_id>.json`
+
+The budget is per table, summed over all of the COPYs into it, so song data
+split into several manifests shares one budget. MAXERROR keeps any single
+COPY within it; if the COPYs of a table reject more than the budget between
+them, staging fails. A COPY that goes over MAXERROR on its own fails as it
+always did, and its rejects are left in STL_LOAD_ERRORS.
+
+The local backend has no STL_LOAD_ERRORS, so nothing is triaged there.
+"""
+import os
+import json
+import threading
+from scripts.db import connect, is_local
+from scripts.sql_queries import load_errors_table_create, last_copy_select, \
+    stl_load_errors_select, load_errors_quarantine
+
+ERROR_FIELDS = ['filename', 'line_number', 'colname', 'type', 'position',
+                'raw_field_value', 'err_code', 'err_reason', 'raw_line']
+
+
+def parse_load_errors(rows):
+    """ Turns STL_LOAD_ERRORS rows into dicts
+
+    Args:
+        rows: list of tuples in the column order of `stl_load_errors_select`
+
+    Returns:
+        list of dicts keyed by `ERROR_FIELDS`, with the padding of Redshift's
+        CHAR columns stripped
+    """
+    return [{field: value.strip() if isinstance(value, str) else value
+             for field, value in zip(ERROR_FIELDS, row)}
+            for row in rows]
+
+
+def summarize(errors):
+    """ Counts rejected records by reason and by file
+
+    Args:
+        errors: list of dicts, as returned by `parse_load_errors`
+
+    Returns:
+        dict with the `rejected` count and the counts `by_reason` and
+        `by_file`
+    """
+    by_reason = {}
+    by_file = {}
+    for error in errors:
+        by_reason[error['err_reason']] = \
+            by_reason.get(error['err_reason'], 0) + 1
+        by_file[error['filename']] = by_file.get(error['filename'], 0) + 1
+    return {'rejected': len(errors), 'by_reason': by_reason,
+            'by_file': by_file}
+
+
+class LoadErrors:
+    """ The records rejected by the COPYs of one run
+
+    Attributes:
+        run_id: String, the run the COPYs belong to
+        budgets: dict of staging table name to the Int number of records
+            its COPYs may reject
+        copies: dict of COPY name to its table, budget and rejected records
+    """
+
+    def __init__(self, config, run_id):
+        """
+        Args:
+            config: a dict of the loaded json config
+            run_id: String, the `run_id` of the run's metrics.RunReport
+        """
+        settings = config['LOAD_ERRORS']
+        self.run_id = run_id
+        self.local = is_local(config)
+        self.report_dir = settings['REPORT_DIR']
+        self.budgets = {table: int(budget)
+                        for table, budget in settings['MAXERROR'].items()}
+        self.copies = {}
+        self._lock = threading.Lock()
+
+        if not self.local:
+            conn = connect(config)
+            cur = conn.cursor()
+            cur.execute(load_errors_table_create)
+            conn.commit()
+            conn.close()
+
+    def rejected(self, table):
+        """ Returns the number of records the COPYs into a table rejected """
+        with self._lock:
+            return sum(len(copy['errors']) for copy in self.copies.values()
+                       if copy['table'] == table)
+
+    def triage(self, cur, name, table, report=None):
+        """ Quarantines the records the COPY just run on the cursor rejected
+
+        The quarantine rows are written in the COPY's transaction.
+
+        Args:
+            cur: Psycopg2 DB cursor object the COPY ran on
+            name: String, the COPY's name, e.g. `staging_songs[1]`
+            table: String, the staging table it loaded
+            report: a metrics.RunReport to record the rejects in
+
+        Returns:
+            list of the rejected records, as returned by `parse_load_errors`
+
+        Raises:
+            RuntimeError: if the COPYs into the table have rejected more
+                records than its budget
+        """
+        if self.local:
+            return []
+        cur.execute(last_copy_select)
+        query_id = cur.fetchone()[0]
+        cur.execute(stl_load_errors_select, (query_id,))
+        errors = parse_load_errors(cur.fetchall())
+        if errors:
+            cur.execute(load_errors_quarantine,
+                        (self.run_id, name, query_id))
+        budget = self.budgets.get(table, 0)
+        with self._lock:
+            self.copies[name] = {'table': table, 'query': query_id,
+                                 'budget': budget, 'errors': errors}
+        if report is not None:
+            report.record_event('staging', 'load_errors ' + name, 0,
+                                rejected=len(errors), budget=budget)
+
+        if errors:
+            print("COPY {} rejected {} records, e.g. {} line {}: {}".format(
+                name, len(errors), errors[0]['filename'],
+                errors[0]['line_number'], errors[0]['err_reason']))
+        rejected = self.rejected(table)
+        if rejected > budget:
+            self.write_report()
+            raise RuntimeError(
+                "The COPYs into {} rejected {} records, over its budget of "
+                "{}, see {}".format(table, rejected, budget,
+                                    self.report_path()))
+        return errors
+
+    def report_path(self):
+        """ Returns `REPORT_DIR/load-errors-<run_id>.json` """
+        return os.path.join(self.report_dir,
+                            'load-errors-{}.json'.format(self.run_id))
+
+    def to_dict(self):
+        with self._lock:
+            copies = {name: dict(copy, summary=summarize(copy['errors']))
+                      for name, copy in self.copies.items()}
+        tables = {}
+        for copy in copies.values():
+            totals = tables.setdefault(copy['table'], {
+                'budget': copy['budget'], 'rejected': 0})
+            totals['rejected'] += len(copy['errors'])
+        return {'run_id': self.run_id, 'tables': tables, 'copies': copies}
+
+    def write_report(self):
+        """ Writes the rejected records of the run to `report_path()`
+
+        Returns:
+            String, the path written to, or None if no COPY was triaged
+        """
+        report = self.to_dict()
+        if not report['copies']:
+            return None
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(self.report_path(), 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        return self.report_path()
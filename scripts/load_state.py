@@ -0,0 +1,70 @@
+"""
+Tracks which log_data files have already been loaded into the warehouse.
+
+The keys of the S3 objects loaded by each run are recorded in the
+`load_state` table, so an incremental run only needs to COPY the log files
+that arrived since the last one.
+"""
+from datetime import datetime
+from scripts.manifests import list_objects
+from scripts.sql_queries import load_state_select, load_state_delete
+
+INSERT_BATCH_SIZE = 500
+
+
+def loaded_keys(cur):
+    """ Fetches the keys of every S3 object that has already been loaded
+
+    Args:
+        cur: Psycopg2 DB cursor object
+
+    Returns:
+        set of String object keys
+    """
+    cur.execute(load_state_select)
+    return {row[0] for row in cur.fetchall()}
+
+
+def pending_objects(cur, s3, url):
+    """ Lists the S3 objects under a prefix that have not been loaded yet
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        s3: a boto3 client object for the AWS S3 service
+        url: String, `s3://bucket/prefix` to look for new objects under
+
+    Returns:
+        list of (key, size in bytes) tuples, sorted by key
+    """
+    done = loaded_keys(cur)
+    return [obj for obj in list_objects(s3, url) if obj[0] not in done]
+
+
+def record_loaded_keys(cur, keys, replace=False):
+    """ Records S3 object keys as loaded
+
+    Does not commit, so the keys can be recorded in the same transaction as
+    the load version bump. The inserts of the data they hold may have
+    committed already, on their own connections; a run that fails before
+    recording its keys is undone by the rerun, see
+    `etl.recover_unrecorded_load`.
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        keys: list of String object keys
+        replace: Bool, forget every previously recorded key first
+
+    Returns:
+        None
+    """
+    if replace:
+        cur.execute(load_state_delete)
+
+    loaded_at = datetime.utcnow()
+    for i in range(0, len(keys), INSERT_BATCH_SIZE):
+        batch = keys[i:i + INSERT_BATCH_SIZE]
+        cur.execute(
+            "INSERT INTO load_state (s3_key, loaded_at) VALUES "
+            + ", ".join(["(%s, %s)"] * len(batch)),
+            [value for key in batch for value in (key, loaded_at)]
+        )
@@ -0,0 +1,427 @@
+"""
+A local execution backend that runs the pipeline on DuckDB instead of
+Redshift.
+
+The S3 inputs are read from a local directory laid out like the bucket
+(`s3://udacity-dend/log_data/...` is looked up as `<DATA_DIR>/log_data/...`),
+and the same SQL from `sql_queries.py` is run against a DuckDB database file.
+Redshift-only syntax is translated by a small dialect layer rather than kept
+in a second copy of the queries:
+
+    - DISTKEY, SORTKEY, DISTSTYLE and ENCODE clauses are dropped
+    - IDENTITY columns become DEFAULTs drawn from a sequence
+    - FNV_HASH is a macro over DuckDB's own 64-bit hash()
+    - OCTET_LENGTH and APPROXIMATE COUNT(DISTINCT ...) become strlen and
+      approx_count_distinct
+    - COPY statements are run as vectorized batch loads of the local files,
+      honouring FORMAT AS JSON (with 'auto' or a jsonpaths file),
+      FORMAT AS PARQUET, MANIFEST, GZIP, TIMEFORMAT 'epochmillisecs' and
+      BLANKSASNULL/EMPTYASNULL
+    - `%s` query parameters become `?`
+
+Select it by setting `ETL.BACKEND` to `local` in `dwh_config.json`.
+"""
+import io
+import os
+import re
+import json
+import shutil
+import hashlib
+import duckdb
+from scripts.manifests import split_s3_url
+
+COPY_BATCH_FILES = 1000
+
+
+class LocalObjectStore:
+    """ A local directory standing in for S3, with the subset of the boto3
+    S3 client API the pipeline uses. The bucket name is ignored; every
+    key is a path relative to the data directory.
+    """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    class _Paginator:
+        def __init__(self, store):
+            self.store = store
+
+        def paginate(self, Bucket, Prefix='', Delimiter=None):
+            yield self.store.list_objects_v2(Bucket, Prefix, Delimiter)
+
+    class _Body(io.BytesIO):
+        def iter_lines(self):
+            for line in self:
+                yield line.rstrip(b'\r\n')
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.uploads = {}
+
+    def path(self, key):
+        return os.path.join(self.data_dir, *key.split('/'))
+
+    def key(self, path):
+        return os.path.relpath(path, self.data_dir).replace(os.sep, '/')
+
+    def get_paginator(self, operation):
+        return self._Paginator(self)
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None):
+        contents = []
+        prefixes = set()
+        for root, dirs, files in os.walk(self.data_dir):
+            for name in files:
+                key = self.key(os.path.join(root, name))
+                if not key.startswith(Prefix):
+                    continue
+                rest = key[len(Prefix):]
+                if Delimiter and Delimiter in rest:
+                    prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                contents.append({
+                    'Key': key,
+                    'Size': stat.st_size,
+                    'ETag': '"{}-{}"'.format(stat.st_size, stat.st_mtime_ns),
+                })
+        page = {'Contents': sorted(contents, key=lambda obj: obj['Key'])}
+        if Delimiter:
+            page['CommonPrefixes'] = [{'Prefix': p} for p in sorted(prefixes)]
+        return page
+
+    def get_object(self, Bucket, Key):
+        try:
+            with open(self.path(Key), 'rb') as f:
+                return {'Body': self._Body(f.read())}
+        except FileNotFoundError:
+            raise self.exceptions.NoSuchKey(Key)
+
+    def put_object(self, Bucket, Key, Body):
+        os.makedirs(os.path.dirname(self.path(Key)), exist_ok=True)
+        with open(self.path(Key), 'wb') as f:
+            f.write(Body)
+
+    def upload_file(self, Filename, Bucket, Key):
+        os.makedirs(os.path.dirname(self.path(Key)), exist_ok=True)
+        shutil.copyfile(Filename, self.path(Key))
+
+    def delete_object(self, Bucket, Key):
+        if os.path.exists(self.path(Key)):
+            os.remove(self.path(Key))
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = hashlib.md5(Key.encode('utf-8')).hexdigest()
+        self.uploads[upload_id] = []
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId].append(Body)
+        return {'ETag': str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        self.put_object(Bucket, Key, b''.join(self.uploads.pop(UploadId)))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+def split_statements(sql):
+    """ Splits a string of SQL statements on the semicolons outside quotes
+
+    Args:
+        sql: String
+
+    Returns:
+        list of non-empty String statements
+    """
+    statements = []
+    current = []
+    quoted = False
+    for char in sql:
+        if char == "'":
+            quoted = not quoted
+        if char == ';' and not quoted:
+            statements.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    statements.append(''.join(current))
+    return [s.strip() for s in statements if s.strip()]
+
+
+def translate(sql):
+    """ Translates a Redshift statement into DuckDB's dialect
+
+    Args:
+        sql: String, a single SQL statement
+
+    Returns:
+        list of String statements to run in its place
+    """
+    statements = []
+    table = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)',
+                      sql, re.IGNORECASE)
+    identity = re.search(r'IDENTITY\s*\(\s*(-?\d+)\s*,\s*(-?\d+)\s*\)', sql,
+                         re.IGNORECASE)
+    if table and identity:
+        sequence = '{}_identity_seq'.format(table.group(1))
+        statements.append(
+            "CREATE SEQUENCE IF NOT EXISTS {} START {} INCREMENT {} "
+            "MINVALUE {}".format(sequence, identity.group(1),
+                                 identity.group(2), identity.group(1)))
+        sql = sql.replace(identity.group(0),
+                          "DEFAULT nextval('{}')".format(sequence))
+
+    dropped = re.match(r'\s*DROP\s+TABLE\s+IF\s+EXISTS\s+(\w+)', sql,
+                       re.IGNORECASE)
+
+    # DuckDB has no ALTER TABLE APPEND, so the rows are moved by copying
+    append = re.match(r'\s*ALTER\s+TABLE\s+(\w+)\s+APPEND\s+FROM\s+(\w+)',
+                      sql, re.IGNORECASE)
+    if append:
+        return ["INSERT INTO {} BY NAME SELECT * FROM {}".format(
+            *append.groups()), "DELETE FROM {}".format(append.group(2))]
+    search_path = re.match(r'\s*SET\s+search_path\s+TO\s+(\w+)', sql,
+                           re.IGNORECASE)
+    if search_path:
+        return ["SET search_path = '{}'".format(search_path.group(1))]
+
+    sql = re.sub(r'\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', '',
+                 sql, flags=re.IGNORECASE)
+    sql = re.sub(r'\bDISTKEY\s*\([^)]*\)', '', sql, flags=re.IGNORECASE)
+    sql = re.sub(r'\b(?:SORTKEY|DISTKEY)\b', '', sql, flags=re.IGNORECASE)
+    sql = re.sub(r'\bDISTSTYLE\s+\w+', '', sql, flags=re.IGNORECASE)
+    sql = re.sub(r'\bENCODE\s+\w+', '', sql, flags=re.IGNORECASE)
+    sql = re.sub(r'\bGETDATE\(\)', 'CURRENT_TIMESTAMP', sql,
+                 flags=re.IGNORECASE)
+    sql = re.sub(r'\bOCTET_LENGTH\s*\(', 'strlen(', sql, flags=re.IGNORECASE)
+    sql = re.sub(r'\bAPPROXIMATE\s+COUNT\s*\(\s*DISTINCT\s+',
+                 'approx_count_distinct(', sql, flags=re.IGNORECASE)
+    statements.append(sql.replace('%s', '?'))
+
+    if dropped:
+        statements.append("DROP SEQUENCE IF EXISTS {}_identity_seq".format(
+            dropped.group(1)))
+    return statements
+
+
+def parse_copy(sql):
+    """ Parses the options of a Redshift COPY statement
+
+    Args:
+        sql: String, a single COPY statement
+
+    Returns:
+        dict with the `table`, `source` url, `format` ('json' or 'parquet'),
+        `jsonpaths` url or 'auto', and `manifest`, `epochmillisecs` and
+        `blanks_as_null` flags
+    """
+    match = re.match(r"\s*COPY\s+(\w+)\s+FROM\s+'([^']+)'", sql,
+                     re.IGNORECASE)
+    json_format = re.search(r"FORMAT\s+AS\s+JSON\s+'([^']+)'", sql,
+                            re.IGNORECASE)
+    return {
+        'table': match.group(1),
+        'source': match.group(2),
+        'format': 'json' if json_format else 'parquet',
+        'jsonpaths': json_format.group(1) if json_format else None,
+        'manifest': re.search(r'\bMANIFEST\b', sql, re.IGNORECASE)
+        is not None,
+        'epochmillisecs': re.search(r"TIMEFORMAT\s+'epochmillisecs'", sql,
+                                    re.IGNORECASE) is not None,
+        'blanks_as_null': re.search(r'\b(?:BLANKSASNULL|EMPTYASNULL)\b', sql,
+                                    re.IGNORECASE) is not None,
+    }
+
+
+class LocalCursor:
+    """ A DB-API style cursor that translates Redshift SQL for DuckDB.
+
+    Statements run on the connection's own DuckDB handle, so they take part
+    in its transaction.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.db
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, query, params=None):
+        for statement in split_statements(query):
+            self.conn.begin()
+            if re.match(r'\s*COPY\b', statement, re.IGNORECASE):
+                self.rowcount = self.copy(parse_copy(statement))
+                self.description = None
+                continue
+            rename = re.match(r'\s*ALTER\s+SCHEMA\s+(\w+)\s+RENAME\s+TO\s+'
+                              r'(\w+)', statement, re.IGNORECASE)
+            if rename:
+                self.rename_schema(*rename.groups())
+                continue
+            for translated in translate(statement):
+                self.cur.execute(translated, params)
+            self.description = self.cur.description
+            self.rowcount = -1
+            if re.match(r'\s*(INSERT|UPDATE|DELETE)\b', statement,
+                        re.IGNORECASE):
+                self.rowcount = self.cur.fetchone()[0]
+                self.description = None
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def close(self):
+        pass
+
+    def rename_schema(self, old, new):
+        """ Renames a schema, which DuckDB can not do, by recreating its
+        sequences and tables in a new schema and dropping the old one
+
+        DuckDB can not drop tables created in the same transaction, so a
+        schema renamed to earlier in the transaction is committed first.
+        """
+        if old in self.conn.renamed_schemas:
+            self.conn.commit()
+            self.conn.begin()
+        self.conn.renamed_schemas.add(new)
+        self.cur.execute("CREATE SCHEMA {}".format(new))
+        for name, start, increment, minimum, last in self.cur.execute(
+                "SELECT sequence_name, start_value, increment_by, min_value, "
+                "last_value FROM duckdb_sequences() WHERE schema_name = ?",
+                [old]).fetchall():
+            self.cur.execute(
+                "CREATE SEQUENCE {}.{} START {} INCREMENT {} MINVALUE {}"
+                .format(new, name, start if last is None else last + increment,
+                        increment, minimum))
+        for name, sql in self.cur.execute(
+                "SELECT table_name, sql FROM duckdb_tables() "
+                "WHERE schema_name = ?", [old]).fetchall():
+            self.cur.execute(re.sub(r'^CREATE TABLE {}\.'.format(old),
+                                    'CREATE TABLE {}.'.format(new), sql))
+            self.cur.execute("INSERT INTO {0}.{1} SELECT * FROM {2}.{1}"
+                             .format(new, name, old))
+        self.cur.execute("DROP SCHEMA {} CASCADE".format(old))
+
+    def copy(self, options):
+        """ Loads the files a COPY statement points at, in batches of files
+
+        Returns:
+            Int, the number of rows loaded
+        """
+        store = self.conn.store
+        if options['manifest']:
+            bucket, key = split_s3_url(options['source'])
+            manifest = json.loads(store.get_object(bucket, key)['Body'].read())
+            keys = [split_s3_url(entry['url'])[1]
+                    for entry in manifest['entries']]
+        else:
+            bucket, prefix = split_s3_url(options['source'])
+            keys = [obj['Key'] for obj in
+                    store.list_objects_v2(bucket, prefix)['Contents']]
+
+        columns = self.cur.execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_name = ? AND table_schema = current_schema() "
+            "ORDER BY ordinal_position",
+            [options['table']]).fetchall()
+        if options['format'] == 'parquet':
+            fields = [name for name, data_type in columns]
+        elif options['jsonpaths'] == 'auto':
+            fields = [name for name, data_type in columns]
+        else:
+            bucket, key = split_s3_url(options['jsonpaths'])
+            jsonpaths = json.loads(store.get_object(bucket, key)['Body'].read())
+            fields = [re.search(r"\$\[?'?\.?([\w]+)", path).group(1)
+                      for path in jsonpaths['jsonpaths']]
+
+        selects = []
+        for (name, data_type), field in zip(columns, fields):
+            value = '"{}"'.format(field)
+            if options['format'] == 'json':
+                if options['blanks_as_null']:
+                    value = "NULLIF(TRIM({}), '')".format(value)
+                if data_type.startswith('TIMESTAMP') and \
+                        options['epochmillisecs']:
+                    value = "epoch_ms(CAST({} AS BIGINT))".format(value)
+            selects.append("TRY_CAST({} AS {})".format(value, data_type))
+
+        loaded = 0
+        paths = [store.path(key) for key in keys]
+        for i in range(0, len(paths), COPY_BATCH_FILES):
+            batch = paths[i:i + COPY_BATCH_FILES]
+            if options['format'] == 'parquet':
+                source = "read_parquet({})".format(batch)
+            else:
+                source = ("read_json({}, format='newline_delimited', "
+                          "columns={{{}}})".format(batch, ', '.join(
+                              "'{}': 'VARCHAR'".format(f) for f in fields)))
+            loaded += self.cur.execute(
+                "INSERT INTO {} ({}) SELECT {} FROM {}".format(
+                    options['table'],
+                    ', '.join(name for name, data_type in columns),
+                    ', '.join(selects), source)).fetchone()[0]
+        return loaded
+
+
+class LocalConnection:
+    """ A DB-API style connection to a local DuckDB database.
+
+    Like psycopg2, a transaction is opened by the first statement after a
+    commit or rollback, so the pipeline's commit points behave the same. With
+    `autocommit` set, every statement commits on its own.
+    """
+
+    def __init__(self, db_path, data_dir):
+        self.db = duckdb.connect(db_path)
+        self.db.execute("CREATE OR REPLACE TEMP MACRO fnv_hash(value) AS "
+                        "CAST(hash(value) >> 1 AS BIGINT)")
+        self.store = LocalObjectStore(data_dir)
+        self.in_transaction = False
+        self.autocommit = False
+        self.renamed_schemas = set()
+
+    def begin(self):
+        if not self.in_transaction and not self.autocommit:
+            self.db.execute("BEGIN TRANSACTION")
+            self.in_transaction = True
+
+    def cursor(self):
+        return LocalCursor(self)
+
+    def commit(self):
+        if self.in_transaction:
+            self.db.execute("COMMIT")
+            self.in_transaction = False
+        self.renamed_schemas.clear()
+
+    def rollback(self):
+        if self.in_transaction:
+            self.db.execute("ROLLBACK")
+            self.in_transaction = False
+        self.renamed_schemas.clear()
+
+    def cancel(self):
+        self.db.interrupt()
+
+    def close(self):
+        self.db.close()
+
+
+def connect(config):
+    """ Opens a new connection to the local DuckDB database
+
+    Args:
+        config: a dict of the loaded json config
+
+    Returns:
+        a LocalConnection object
+    """
+    return LocalConnection(config['LOCAL']['DB_PATH'],
+                           config['LOCAL']['DATA_DIR'])
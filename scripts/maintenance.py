@@ -0,0 +1,173 @@
+"""
+Runs VACUUM and ANALYZE after a load, only on the tables that need it.
+
+`SVV_TABLE_INFO` reports, for every table, how much of it is unsorted, how
+stale its statistics are and, from its total and visible row counts, how
+many deleted rows it still holds. Tables over the thresholds in
+`MAINTENANCE` get:
+
+    - VACUUM DELETE ONLY, to reclaim the space of deleted rows
+    - VACUUM SORT ONLY, to re-sort rows appended out of sort key order
+    - ANALYZE PREDICATE COLUMNS, to refresh the statistics the planner uses
+
+The actions run in order of how far each table is over its threshold,
+within `MAINTENANCE.TIME_BUDGET_SECONDS`. Every statement gets a timeout of
+the budget left, and once it is used up the remaining actions are skipped,
+so a nightly run can not overrun. VACUUM can not run inside a transaction,
+so the stage uses its own autocommit connection. The local backend has no
+SVV_TABLE_INFO and needs no vacuuming, so the stage is skipped there.
+
+Typical Usage example:
+    $ python3 -m scripts.maintenance
+"""
+import json
+import time
+import psycopg2
+from scripts.db import connect, is_local
+from scripts.metrics import execute
+
+CFG_FILE = 'dwh_config.json'
+
+table_health_select = ("""
+SELECT
+    TRIM("table"),
+    COALESCE(unsorted, 0),
+    COALESCE(stats_off, 0),
+    COALESCE(tbl_rows, 0),
+    COALESCE(estimated_visible_rows, tbl_rows, 0)
+FROM svv_table_info
+WHERE schema = current_schema();
+""")
+
+
+def table_health(cur):
+    """ Reads how unsorted, stale and bloated each table is
+
+    Args:
+        cur: Psycopg2 DB cursor object
+
+    Returns:
+        list of dicts with each table's `table`, `unsorted`, `stats_off`
+        and `deleted` percentages
+    """
+    cur.execute(table_health_select)
+    health = []
+    for table, unsorted, stats_off, rows, visible in cur.fetchall():
+        deleted = 100.0 * (rows - visible) / rows if rows else 0.0
+        health.append({'table': table, 'unsorted': float(unsorted),
+                       'stats_off': float(stats_off),
+                       'deleted': max(deleted, 0.0)})
+    return health
+
+
+def plan_maintenance(health, settings):
+    """ Picks the maintenance actions of the tables over the thresholds
+
+    Args:
+        health: list of dicts returned by `table_health`
+        settings: dict of the `MAINTENANCE` config
+
+    Returns:
+        list of dicts with each action's `table`, `statement` and `reason`,
+        the furthest over its threshold first
+    """
+    checks = [
+        ('deleted', float(settings['DELETED_PCT']), 'VACUUM DELETE ONLY {};'),
+        ('unsorted', float(settings['UNSORTED_PCT']), 'VACUUM SORT ONLY {};'),
+        ('stats_off', float(settings['STATS_OFF_PCT']),
+         'ANALYZE {} PREDICATE COLUMNS;'),
+    ]
+    actions = []
+    for table in health:
+        for metric, threshold, statement in checks:
+            if table[metric] > threshold:
+                actions.append({
+                    'table': table['table'],
+                    'statement': statement.format(table['table']),
+                    'reason': '{} {:.1f}% > {:.1f}%'.format(
+                        metric, table[metric], threshold),
+                    'excess': table[metric] - threshold,
+                })
+    actions.sort(key=lambda action: -action['excess'])
+    return actions
+
+
+def run_maintenance(cur, actions, budget_seconds, report=None):
+    """ Runs maintenance actions until the time budget is used up
+
+    Args:
+        cur: Psycopg2 DB cursor object of an autocommit connection
+        actions: list of dicts returned by `plan_maintenance`
+        budget_seconds: Float, total time the actions may take
+        report: a metrics.RunReport to record each action in
+
+    Returns:
+        list of the actions run, each with its `seconds`, and of those
+        skipped or cut short, with `skipped` set
+    """
+    start = time.time()
+    results = []
+    for action in actions:
+        remaining = budget_seconds - (time.time() - start)
+        if remaining <= 0:
+            action = dict(action, skipped='time budget used up')
+            results.append(action)
+            if report is not None:
+                report.record_event('maintenance', action['statement'], 0.0,
+                                    skipped=action['skipped'])
+            print("Skipped {} ({}): time budget used up".format(
+                action['statement'], action['reason']))
+            continue
+
+        cur.execute("SET statement_timeout TO %s;",
+                    (max(1, int(remaining * 1000)),))
+        action_start = time.time()
+        try:
+            execute(cur, action['statement'], 'maintenance', report)
+        except psycopg2.extensions.QueryCanceledError:
+            action = dict(action, skipped='cut short by the time budget')
+        action['seconds'] = time.time() - action_start
+        results.append(action)
+        print("{} ({}) in {:.1f}s{}".format(
+            action['statement'], action['reason'], action['seconds'],
+            ', ' + action['skipped'] if 'skipped' in action else ''))
+    cur.execute("SET statement_timeout TO 0;")
+    return results
+
+
+def maintain(config, report=None):
+    """ Runs the maintenance stage, if enabled
+
+    Args:
+        config: a dict of the loaded json config
+        report: a metrics.RunReport to record each action in
+
+    Returns:
+        list of the actions run or skipped, as from `run_maintenance`
+    """
+    settings = config['MAINTENANCE']
+    if settings['ENABLED'].lower() != 'true':
+        return []
+    if is_local(config):
+        print("Skipped maintenance, not needed on the local backend")
+        return []
+
+    conn = connect(config, 'maintenance')
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        actions = plan_maintenance(table_health(cur), settings)
+        if not actions:
+            print("No tables need maintenance")
+            return []
+        return run_maintenance(cur, actions,
+                               float(settings['TIME_BUDGET_SECONDS']),
+                               report)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+    maintain(config)
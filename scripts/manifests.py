@@ -0,0 +1,243 @@
+"""
+Lists input files in S3 and writes Redshift COPY manifests for them.
+
+A manifest is a JSON file listing the exact S3 objects a COPY should load,
+which lets the pipeline load a chosen subset of a prefix instead of
+everything under it.
+"""
+import json
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of slices per node of each Redshift node type
+SLICES_PER_NODE = {
+    'dc2.large': 2,
+    'dc2.8xlarge': 16,
+    'ds2.xlarge': 2,
+    'ds2.8xlarge': 16,
+    'ra3.xlplus': 2,
+    'ra3.4xlarge': 4,
+    'ra3.16xlarge': 16,
+}
+
+
+def split_s3_url(url):
+    """ Splits an `s3://bucket/prefix` url into its bucket and prefix
+
+    Args:
+        url: String
+
+    Returns:
+        bucket: String
+        prefix: String, without a leading slash
+    """
+    bucket, _, prefix = url.replace('s3://', '', 1).partition('/')
+    return bucket, prefix
+
+
+def list_objects(s3, url):
+    """ Lists every object under an S3 prefix, following pagination
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        url: String, `s3://bucket/prefix` to list
+
+    Returns:
+        list of (key, size in bytes) tuples, sorted by key
+    """
+    bucket, prefix = split_s3_url(url)
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                objects.append((obj['Key'], obj['Size']))
+    return sorted(objects)
+
+
+def list_prefixes(s3, bucket, prefix):
+    """ Lists the "directories" directly under a prefix
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        bucket: String
+        prefix: String, ending in `/`
+
+    Returns:
+        prefixes: list of String sub-prefixes, each ending in `/`
+        objects: list of (key, size in bytes) tuples directly under `prefix`
+    """
+    prefixes = []
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                   Delimiter='/'):
+        prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        objects.extend((obj['Key'], obj['Size'])
+                       for obj in page.get('Contents', [])
+                       if not obj['Key'].endswith('/'))
+    return prefixes, objects
+
+
+def list_objects_parallel(s3, url, workers, depth=2):
+    """ Lists every object under an S3 prefix using concurrent listings
+
+    The prefix is first split into its sub-prefixes `depth` levels down
+    (e.g. `song_data/A/B/`), then each of those is listed with its own
+    paginated request on a thread pool.
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        url: String, `s3://bucket/prefix` to list
+        workers: Int, max number of listings to run at the same time
+        depth: Int, how many levels of sub-prefixes to fan out over
+
+    Returns:
+        list of (key, size in bytes) tuples, sorted by key
+    """
+    bucket, prefix = split_s3_url(url)
+    prefixes = [prefix.rstrip('/') + '/']
+    objects = []
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for _ in range(depth):
+            next_prefixes = []
+            for sub_prefixes, sub_objects in executor.map(
+                    lambda p: list_prefixes(s3, bucket, p), prefixes):
+                next_prefixes.extend(sub_prefixes)
+                objects.extend(sub_objects)
+            prefixes = next_prefixes
+
+        urls = ['s3://{}/{}'.format(bucket, p) for p in prefixes]
+        for sub_objects in executor.map(lambda u: list_objects(s3, u), urls):
+            objects.extend(sub_objects)
+
+    return sorted(objects)
+
+
+def cluster_slices(config):
+    """ Works out the number of slices in the cluster described in config
+
+    Args:
+        config: a dict of the loaded json config
+
+    Returns:
+        Int
+    """
+    nodes = 1
+    if config['CLUSTER']['CLUSTER_TYPE'] == 'multi-node':
+        nodes = int(config['CLUSTER']['NUM_NODES'])
+    return SLICES_PER_NODE[config['CLUSTER']['NODE_TYPE']] * nodes
+
+
+def balance_across_slices(objects, slices):
+    """ Orders objects so each run of `slices` files is spread evenly
+
+    Files are assigned largest first to the slice with the fewest bytes so
+    far, then interleaved so every consecutive group of `slices` files holds
+    one file per slice.
+
+    Args:
+        objects: list of (key, size in bytes) tuples
+        slices: Int, number of slices in the cluster
+
+    Returns:
+        ordered: list of (key, size in bytes) tuples
+        slice_bytes: list of the bytes assigned to each slice
+    """
+    queues = [[] for _ in range(slices)]
+    slice_bytes = [0] * slices
+    for key, size in sorted(objects, key=lambda obj: (-obj[1], obj[0])):
+        target = slice_bytes.index(min(slice_bytes))
+        queues[target].append((key, size))
+        slice_bytes[target] += size
+
+    ordered = []
+    for i in range(max(len(queue) for queue in queues) if objects else 0):
+        ordered.extend(queue[i] for queue in queues if i < len(queue))
+    return ordered, slice_bytes
+
+
+def build_slice_manifests(bucket, objects, slices, max_files):
+    """ Splits objects into manifests whose file counts are multiples of the
+    cluster's slice count
+
+    All manifests but the last hold a multiple of `slices` files; the last
+    one takes whatever is left over.
+
+    Args:
+        bucket: String, the bucket the objects are in
+        objects: list of (key, size in bytes) tuples
+        slices: Int, number of slices in the cluster
+        max_files: Int, max number of files in one manifest
+
+    Returns:
+        manifests: list of dicts in the Redshift COPY manifest format
+        report: dict describing how the files are spread over the slices
+    """
+    ordered, slice_bytes = balance_across_slices(objects, slices)
+    chunk = max(slices, max_files // slices * slices)
+
+    manifests = []
+    for i in range(0, len(ordered), chunk):
+        manifests.append(build_manifest(
+            bucket, [key for key, size in ordered[i:i + chunk]]))
+
+    report = {
+        'files': len(ordered),
+        'bytes': sum(size for key, size in ordered),
+        'slices': slices,
+        'manifests': [len(m['entries']) for m in manifests],
+        'files_per_slice': len(ordered) / slices,
+        'min_slice_bytes': min(slice_bytes),
+        'max_slice_bytes': max(slice_bytes),
+    }
+    return manifests, report
+
+
+def print_slice_report(report):
+    """ Prints the expected spread of a COPY's files over the slices """
+    print("{} files ({:.1f} MB) over {} slices in {} manifest(s) {}".format(
+        report['files'], report['bytes'] / 1024 ** 2, report['slices'],
+        len(report['manifests']), report['manifests']))
+    print("Expected {:.1f} files per slice, {:.1f}-{:.1f} KB per slice".format(
+        report['files_per_slice'], report['min_slice_bytes'] / 1024,
+        report['max_slice_bytes'] / 1024))
+
+
+def build_manifest(bucket, keys):
+    """ Builds a COPY manifest that loads exactly the given keys
+
+    Args:
+        bucket: String, the bucket the keys are in
+        keys: list of String object keys
+
+    Returns:
+        dict in the Redshift COPY manifest format
+    """
+    return {
+        'entries': [
+            {'url': 's3://{}/{}'.format(bucket, key), 'mandatory': True}
+            for key in keys
+        ]
+    }
+
+
+def upload_manifest(s3, manifest, prefix_url, name):
+    """ Writes a manifest to S3 under a timestamped key
+
+    Args:
+        s3: a boto3 client object for the AWS S3 service
+        manifest: dict in the Redshift COPY manifest format
+        prefix_url: String, `s3://bucket/prefix` to write the manifest under
+        name: String, used as the start of the manifest's file name
+
+    Returns:
+        String, the `s3://` url of the uploaded manifest
+    """
+    bucket, prefix = split_s3_url(prefix_url)
+    key = "{}/{}-{}.manifest".format(
+        prefix.rstrip('/'), name, datetime.utcnow().strftime('%Y%m%dT%H%M%S'))
+    s3.put_object(Bucket=bucket, Key=key,
+                  Body=json.dumps(manifest).encode('utf-8'))
+    return 's3://{}/{}'.format(bucket, key)
@@ -0,0 +1,275 @@
+"""
+Times every statement the pipeline runs and builds a machine-readable report.
+
+Each statement is run through `RunReport.execute`, which records its wall
+time and `cur.rowcount` and, on Redshift, its query ID plus the matching
+rows of STL_QUERY and, for COPYs, STL_LOAD_COMMITS. At the end of a run the
+report is written as JSON and can also be sent to StatsD or written in the
+Prometheus text format.
+
+Every recorded entry is also passed to the report's sinks, so other outputs
+can be added with `register_sink` (for every report) or
+`RunReport.add_sink` (for one report):
+
+    def print_slow(entry):
+        if entry['seconds'] > 60:
+            print("Slow statement: ", entry['name'])
+
+    metrics.register_sink(print_slow)
+"""
+import os
+import re
+import json
+import time
+import socket
+import threading
+from datetime import datetime
+
+_default_sinks = []
+
+STATEMENT_PATTERN = re.compile(
+    r'\b(COPY|INSERT\s+INTO|DELETE\s+FROM|UPDATE|TRUNCATE|'
+    r'CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)'
+    r'\s+(\w+)', re.IGNORECASE)
+
+query_id_select = "SELECT pg_last_query_id();"
+query_stats_select = ("""
+SELECT TRIM(querytxt), starttime, endtime, aborted
+FROM stl_query
+WHERE query = %s;
+""")
+load_stats_select = ("""
+SELECT COUNT(*), SUM(lines_scanned), SUM(bytes_scanned)
+FROM stl_load_commits
+WHERE query = %s;
+""")
+
+
+def register_sink(sink):
+    """ Adds a sink that every new report passes its entries to
+
+    Args:
+        sink: a function called with each recorded entry dict
+    """
+    _default_sinks.append(sink)
+
+
+def statement_name(query):
+    """ Names a statement after what it does and the table it does it to,
+    e.g. `COPY staging_events` or `INSERT songplays`
+
+    Args:
+        query: String, one or more SQL statements
+
+    Returns:
+        String
+    """
+    matches = STATEMENT_PATTERN.findall(query)
+    if not matches:
+        return ' '.join(query.split())[:40]
+    verb, table = matches[-1]
+    return '{} {}'.format(verb.split()[0].upper(), table)
+
+
+class RunReport:
+    """ Collects timings and metrics for every statement of an ETL run.
+
+    Attributes:
+        run_id: String identifying the run
+        statements: list of dicts, one per executed statement
+        events: list of dicts, one per other recorded action
+    """
+
+    def __init__(self, run_id=None, redshift_stats=False, sinks=None):
+        """
+        Args:
+            run_id: String, defaults to the current UTC time
+            redshift_stats: Bool, look up each statement's query ID and
+                STL stats, only possible on Redshift
+            sinks: list of extra sink functions for this report
+        """
+        self.run_id = run_id or datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        self.redshift_stats = redshift_stats
+        self.sinks = list(_default_sinks) + list(sinks or [])
+        self.statements = []
+        self.events = []
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def execute(self, cur, query, phase, name=None, params=None):
+        """ Runs a statement and records how it went
+
+        Args:
+            cur: Psycopg2 DB cursor object
+            query: String, the statement to run
+            phase: String, the pipeline phase it belongs to
+            name: String, defaults to `statement_name(query)`
+            params: optional query parameters
+
+        Returns:
+            dict, the recorded entry
+        """
+        entry = {
+            'phase': phase,
+            'name': name or statement_name(query),
+            'started_at': time.time() - self.started_at,
+        }
+        start = time.time()
+        try:
+            if params is None:
+                cur.execute(query)
+            else:
+                cur.execute(query, params)
+        except Exception as e:
+            entry['seconds'] = time.time() - start
+            entry['error'] = str(e).strip()
+            self.record(entry, self.statements)
+            raise
+
+        entry['seconds'] = time.time() - start
+        entry['rowcount'] = cur.rowcount
+        if self.redshift_stats:
+            entry.update(self.redshift_query_stats(cur, query))
+        self.record(entry, self.statements)
+        return entry
+
+    def redshift_query_stats(self, cur, query):
+        """ Looks up the Redshift query ID and STL stats of the statement
+        the cursor just ran
+
+        Returns:
+            dict with `query_id`, `stl_query` and, for COPYs, `load_commits`
+        """
+        cur.execute(query_id_select)
+        query_id = cur.fetchone()[0]
+        stats = {'query_id': query_id}
+
+        cur.execute(query_stats_select, (query_id,))
+        row = cur.fetchone()
+        if row:
+            stats['stl_query'] = {
+                'starttime': str(row[1]), 'endtime': str(row[2]),
+                'aborted': row[3]}
+
+        if re.search(r'\bCOPY\b', query, re.IGNORECASE):
+            cur.execute(load_stats_select, (query_id,))
+            files, lines, scanned = cur.fetchone()
+            stats['load_commits'] = {'files': files, 'lines': lines,
+                                     'bytes': scanned}
+        return stats
+
+    def record_event(self, phase, name, seconds, **details):
+        """ Records a pipeline action other than a single statement
+
+        Args:
+            phase: String, the pipeline phase it belongs to
+            name: String, what was done
+            seconds: Float, how long it took
+            **details: any other values to keep with it
+        """
+        entry = dict(details, phase=phase, name=name, seconds=seconds,
+                     started_at=time.time() - self.started_at - seconds)
+        self.record(entry, self.events)
+        return entry
+
+    def record(self, entry, entries):
+        with self._lock:
+            entries.append(entry)
+        for sink in self.sinks:
+            sink(entry)
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        return {
+            'run_id': self.run_id,
+            'seconds': end - self.started_at,
+            'statements': self.statements,
+            'events': self.events,
+        }
+
+    def write_json(self, report_dir):
+        """ Writes the report as `<report_dir>/run-<run_id>.json`
+
+        Returns:
+            String, the path of the written file
+        """
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(report_dir, 'run-{}.json'.format(self.run_id))
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        return path
+
+    def to_prometheus(self, prefix='sparkify_etl'):
+        """ Formats the report in the Prometheus text exposition format
+
+        Returns:
+            String
+        """
+        lines = [
+            '# TYPE {}_run_seconds gauge'.format(prefix),
+            '{}_run_seconds {:.6f}'.format(prefix,
+                                           self.to_dict()['seconds']),
+            '# TYPE {}_statement_seconds gauge'.format(prefix),
+        ]
+        for entry in self.statements:
+            lines.append('{}_statement_seconds{{phase="{}",statement="{}"}} '
+                         '{:.6f}'.format(prefix, entry['phase'],
+                                         entry['name'], entry['seconds']))
+        lines.append('# TYPE {}_statement_rows gauge'.format(prefix))
+        for entry in self.statements:
+            if entry.get('rowcount', -1) >= 0:
+                lines.append('{}_statement_rows{{phase="{}",statement="{}"}} '
+                             '{}'.format(prefix, entry['phase'],
+                                         entry['name'], entry['rowcount']))
+        return '\n'.join(lines) + '\n'
+
+    def send_statsd(self, host, port, prefix='sparkify.etl'):
+        """ Sends each statement's time and row count to a StatsD server """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for entry in self.statements:
+                metric = '{}.{}.{}'.format(prefix, entry['phase'], re.sub(
+                    r'\W+', '_', entry['name'].lower()))
+                sock.sendto('{}.seconds:{}|ms'.format(
+                    metric, int(entry['seconds'] * 1000)).encode('utf-8'),
+                    (host, int(port)))
+                if entry.get('rowcount', -1) >= 0:
+                    sock.sendto('{}.rows:{}|g'.format(
+                        metric, entry['rowcount']).encode('utf-8'),
+                        (host, int(port)))
+        finally:
+            sock.close()
+
+
+def execute(cur, query, phase, report=None, name=None, params=None):
+    """ Runs a statement through a report, or directly if there is none """
+    if report is not None:
+        return report.execute(cur, query, phase, name, params)
+    if params is None:
+        cur.execute(query)
+    else:
+        cur.execute(query, params)
+
+
+def publish(report, config):
+    """ Writes a finished report to the outputs set in `METRICS`
+
+    Args:
+        report: a RunReport object
+        config: a dict of the loaded json config
+    """
+    settings = config['METRICS']
+    report.finish()
+    print("Run report written to ", report.write_json(settings['REPORT_DIR']))
+    if settings['PROMETHEUS_FILE']:
+        with open(settings['PROMETHEUS_FILE'], 'w') as f:
+            f.write(report.to_prometheus())
+    if settings['STATSD_HOST']:
+        report.send_statsd(settings['STATSD_HOST'], settings['STATSD_PORT'])
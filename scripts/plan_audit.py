@@ -0,0 +1,315 @@
+"""
+Captures the query plans of the transform and dashboard queries and flags
+plans that got worse.
+
+Every statement of the insert steps, and every query of the dashboard's
+workload in `PLAN_AUDIT.WORKLOAD`, is run through `EXPLAIN`. Each plan is
+parsed into its estimated cost, its joins and the data movement they need:
+the `DS_BCAST_*` and `DS_DIST_*` attributes Redshift puts on joins whose
+inputs are not collocated.
+
+Plans are stored under `PLAN_AUDIT.STORE_DIR`, one file per schema version,
+a hash of the tables' DDL. A new capture is compared with the plans stored
+for the same schema version, or after a layout change with the last stored
+version, and a regression is flagged for:
+
+    - each new redistribution step, e.g. songplays starting to broadcast
+      its inner table (`DS_BCAST_INNER`) or redistributing both sides
+      (`DS_DIST_BOTH`)
+    - an estimated cost more than `PLAN_AUDIT.COST_JUMP_RATIO` times the
+      stored one (`COST_JUMP`)
+
+`PLAN_AUDIT.SEVERITIES` gives each kind of regression a severity, `info`,
+`warning` (the default) or `error`. Incremental runs audit their inserts
+before loading anything, and fail at once on regressions at or over
+`PLAN_AUDIT.FAIL_ON`; a passing capture becomes the stored plans. Full
+refreshes are not audited, since their freshly created tables have no
+statistics to plan with. The audit is skipped on the local backend.
+
+Typical Usage example:
+    $ python3 -m scripts.plan_audit [--full-refresh] [--accept]
+"""
+import os
+import re
+import sys
+import json
+import time
+import getopt
+import hashlib
+from collections import Counter
+from datetime import datetime
+from scripts.db import connect, is_local
+from scripts.layout_advisor import read_workload_file
+from scripts.sql_queries import create_table_queries, insert_table_steps, \
+    incremental_insert_table_steps
+
+CFG_FILE = 'dwh_config.json'
+
+SEVERITY_LEVELS = ['info', 'warning', 'error']
+# Join attributes for inputs that are already collocated
+COLLOCATED = {'DS_DIST_NONE', 'DS_DIST_ALL_NONE'}
+PLAN_NODE = re.compile(
+    r'XN (?P<operator>[A-Za-z][\w .]*?)(?:\s+(?P<distribution>DS_\w+))?'
+    r'\s+\(cost=(?P<startup>[\d.]+)\.\.(?P<cost>[\d.]+)\s+rows=(?P<rows>\d+)')
+EXPLAINABLE = re.compile(r'\s*(?:--[^\n]*\n\s*)*(SELECT|INSERT|DELETE|'
+                         r'UPDATE|WITH)\b', re.IGNORECASE)
+
+
+def parse_plan(lines):
+    """ Parses the text of a Redshift EXPLAIN
+
+    Args:
+        lines: list of String lines of the plan, as EXPLAIN returns them
+
+    Returns:
+        dict with the plan's estimated `cost` and `rows`, its `joins` with
+        their operator, `distribution` attribute and cost, and the
+        `redistribution` attributes of the joins that move data
+    """
+    nodes = [match.groupdict() for match in map(PLAN_NODE.search, lines)
+             if match]
+    joins = [{'operator': node['operator'],
+              'distribution': node['distribution'],
+              'cost': float(node['cost'])}
+             for node in nodes if node['distribution'] or
+             re.search(r'Join|Nested Loop', node['operator'])]
+    return {
+        'cost': float(nodes[0]['cost']) if nodes else 0.0,
+        'rows': int(nodes[0]['rows']) if nodes else 0,
+        'joins': joins,
+        'redistribution': sorted(
+            join['distribution'] for join in joins
+            if join['distribution'] and
+            join['distribution'] not in COLLOCATED),
+    }
+
+
+def audited_statements(config, steps):
+    """ Lists the statements to audit by name
+
+    Insert steps made of several statements are named `step`, `step[1]`, ...
+    and the dashboard queries `dashboard[n]`. Statements EXPLAIN can not
+    plan, such as ALTER TABLE APPEND, are left out.
+
+    Args:
+        config: a dict of the loaded json config
+        steps: dict of insert step name to its statements
+
+    Returns:
+        dict of name to a single SQL statement
+    """
+    statements = {}
+    for step, query in steps.items():
+        parts = [part for part in query.split(';') if part.strip()]
+        for i, part in enumerate(parts):
+            if EXPLAINABLE.match(part):
+                statements[step if i == 0 else
+                           '{}[{}]'.format(step, i)] = part.strip()
+
+    workload = config['PLAN_AUDIT']['WORKLOAD']
+    if workload and os.path.exists(workload):
+        for i, query in enumerate(read_workload_file(workload)):
+            statements['dashboard[{}]'.format(i)] = query
+    return statements
+
+
+def capture_plans(cur, statements):
+    """ Runs EXPLAIN on each statement
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        statements: dict of name to SQL statement
+
+    Returns:
+        dict of name to the plan, as parsed by `parse_plan`
+    """
+    plans = {}
+    for name, statement in statements.items():
+        cur.execute("EXPLAIN " + statement)
+        plans[name] = parse_plan([row[0] for row in cur.fetchall()])
+    return plans
+
+
+def schema_version():
+    """ Returns a short hash of the tables' DDL, which changes with their
+    layout """
+    ddl = '\n'.join(create_table_queries)
+    return hashlib.sha1(ddl.encode('utf-8')).hexdigest()[:12]
+
+
+def load_plans(store_dir, version):
+    """ Loads the stored plans of a schema version, or of the last stored
+    version if there are none for it
+
+    Returns:
+        dict as written by `store_plans`, or None if no plans are stored
+    """
+    path = os.path.join(store_dir, 'plans-{}.json'.format(version))
+    if not os.path.exists(path):
+        if not os.path.isdir(store_dir):
+            return None
+        paths = [os.path.join(store_dir, name)
+                 for name in os.listdir(store_dir)
+                 if name.startswith('plans-') and name.endswith('.json')]
+        if not paths:
+            return None
+        path = max(paths, key=os.path.getmtime)
+    with open(path) as f:
+        return json.load(f)
+
+
+def store_plans(store_dir, version, plans):
+    """ Stores the plans of a schema version as
+    `<store_dir>/plans-<version>.json`
+
+    Returns:
+        String, the path written to
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, 'plans-{}.json'.format(version))
+    with open(path, 'w') as f:
+        json.dump({'schema_version': version,
+                   'captured_at': datetime.utcnow().isoformat(),
+                   'plans': plans}, f, indent=2)
+    return path
+
+
+def find_regressions(before, plans, severities, cost_jump_ratio):
+    """ Compares captured plans with stored ones
+
+    Args:
+        before: dict of name to the stored plan
+        plans: dict of name to the captured plan
+        severities: dict of regression kind to `info`, `warning` or `error`
+        cost_jump_ratio: Float, how many times its stored cost a plan may
+            cost before it counts as a regression
+
+    Returns:
+        list of dicts with the `statement`, `kind`, `severity` and `detail`
+        of each regression, worst first
+    """
+    regressions = []
+    for name, plan in plans.items():
+        if name not in before:
+            continue
+        added = Counter(plan['redistribution']) - \
+            Counter(before[name]['redistribution'])
+        for kind in sorted(added):
+            regressions.append({
+                'statement': name, 'kind': kind,
+                'severity': severities.get(kind, 'warning'),
+                'detail': "{} new {} step(s)".format(added[kind], kind)})
+
+        cost = before[name]['cost']
+        if cost > 0 and plan['cost'] > cost * cost_jump_ratio:
+            regressions.append({
+                'statement': name, 'kind': 'COST_JUMP',
+                'severity': severities.get('COST_JUMP', 'warning'),
+                'detail': "estimated cost went from {:.0f} to {:.0f}".format(
+                    cost, plan['cost'])})
+    return sorted(regressions,
+                  key=lambda r: -SEVERITY_LEVELS.index(r['severity']))
+
+
+def audit(cur, config, steps, report=None):
+    """ Captures the plans of the insert steps and dashboard queries, and
+    compares them with the stored ones
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        config: a dict of the loaded json config
+        steps: dict of insert step name to its statements
+        report: a metrics.RunReport to record the audit in
+
+    Returns:
+        plans: dict of name to the captured plan
+        regressions: list of dicts, as returned by `find_regressions`
+    """
+    settings = config['PLAN_AUDIT']
+    start = time.time()
+    plans = capture_plans(cur, audited_statements(config, steps))
+    stored = load_plans(settings['STORE_DIR'], schema_version())
+    regressions = find_regressions(
+        stored['plans'] if stored else {}, plans, settings['SEVERITIES'],
+        float(settings['COST_JUMP_RATIO']))
+    if report is not None:
+        report.record_event('plan_audit', 'audit', time.time() - start,
+                            statements=len(plans),
+                            regressions=len(regressions))
+    for r in regressions:
+        print("Plan regression ({severity}) in {statement}: "
+              "{detail}".format(**r))
+    return plans, regressions
+
+
+def failing(regressions, fail_on):
+    """ Returns the regressions at or over the `fail_on` severity """
+    level = SEVERITY_LEVELS.index(fail_on)
+    return [r for r in regressions
+            if SEVERITY_LEVELS.index(r['severity']) >= level]
+
+
+def preflight(cur, config, steps, report=None):
+    """ Audits the plans of a run's insert steps before it loads anything
+
+    A capture without failing regressions becomes the stored plans of the
+    current schema version.
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        config: a dict of the loaded json config
+        steps: dict of insert step name to its statements
+        report: a metrics.RunReport to record the audit in
+
+    Raises:
+        RuntimeError: if a regression is at or over `PLAN_AUDIT.FAIL_ON`
+    """
+    settings = config['PLAN_AUDIT']
+    if settings['ENABLED'].lower() != 'true':
+        return
+    if is_local(config):
+        print("Skipped the plan audit, not supported on the local backend")
+        return
+
+    plans, regressions = audit(cur, config, steps, report)
+    failed = failing(regressions, settings['FAIL_ON'])
+    if failed:
+        raise RuntimeError(
+            "{} query plans regressed, see above. Accept the new plans with "
+            "`python3 -m scripts.plan_audit --accept` if they are "
+            "expected".format(len(failed)))
+    store_plans(settings['STORE_DIR'], schema_version(), plans)
+    print("Audited {} query plans".format(len(plans)))
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["full-refresh", "accept"])
+    except getopt.GetoptError:
+        print("USAGE: plan_audit.py [--full-refresh] [--accept]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+    settings = config['PLAN_AUDIT']
+
+    steps = (insert_table_steps if '--full-refresh' in opts
+             else incremental_insert_table_steps)
+    conn = connect(config)
+    plans, regressions = audit(conn.cursor(), config, steps)
+    conn.close()
+
+    for name, plan in plans.items():
+        print("    {:<28}cost {:>14.0f}  {}".format(
+            name, plan['cost'], ' '.join(plan['redistribution'])))
+    if '--accept' in opts:
+        print("Stored plans in ", store_plans(
+            settings['STORE_DIR'], schema_version(), plans))
+    elif failing(regressions, settings['FAIL_ON']):
+        sys.exit(1)
+    return plans, regressions
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,241 @@
+"""
+Elastic-resizes the cluster up for a heavy load and back down afterwards.
+
+Before the staging COPYs, the input waiting to be loaded is measured from
+S3 listings. On an incremental run that is the log files not in
+`load_state` plus the song data, which is reloaded every run. A simple
+throughput model estimates how long the load takes on a number of nodes:
+
+    minutes = RESIZE.FIXED_MINUTES
+              + pending MB / (RESIZE.MB_PER_NODE_MINUTE * nodes)
+
+The smallest node count that brings the estimate within
+`RESIZE.TARGET_MINUTES` is picked, with these guardrails:
+
+    - never more than `RESIZE.MAX_NODES`, nor more than double the
+      configured `CLUSTER.NUM_NODES`, the most an elastic resize can add
+    - no resize unless it saves more time than resizing up and back down
+      takes, `RESIZE.RESIZE_MINUTES` each
+    - no more than `RESIZE.MAX_RESIZE_MINUTES` waiting for a resize to
+      finish; past that the load goes ahead on the cluster as it is
+
+The cluster is resized back to `CLUSTER.NUM_NODES` once the inserts and
+maintenance have finished, or failed.
+
+Typical Usage example:
+    $ python3 -m scripts.resize [--full-refresh]
+"""
+import sys
+import json
+import time
+import getopt
+from scripts.db import connect, get_object_store, is_local
+from scripts.helpers import get_aws_clients
+from scripts.load_state import pending_objects
+from scripts.manifests import list_objects, list_objects_parallel
+from scripts.setup_redshift import wait_for_cluster_status
+
+CFG_FILE = 'dwh_config.json'
+
+
+def pending_input_bytes(cur, s3, config, full_refresh):
+    """ Measures the input the next run will load
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        s3: a boto3 client object for the AWS S3 service
+        config: a dict of the loaded json config
+        full_refresh: Bool, all of the log data will be reloaded
+
+    Returns:
+        dict with the `log_bytes` and `song_bytes` to load
+    """
+    if full_refresh:
+        log_objects = list_objects(s3, config['S3']['LOG_DATA'])
+    else:
+        log_objects = pending_objects(cur, s3, config['S3']['LOG_DATA'])
+    song_objects = list_objects_parallel(s3, config['S3']['SONG_DATA'],
+                                         int(config['ETL']['LIST_WORKERS']))
+    return {'log_bytes': sum(size for key, size in log_objects),
+            'song_bytes': sum(size for key, size in song_objects)}
+
+
+def load_minutes(pending_bytes, nodes, settings):
+    """ Estimates how long loading the input takes on a number of nodes
+
+    Args:
+        pending_bytes: Int, size of the input
+        nodes: Int, number of nodes
+        settings: dict of the `RESIZE` config
+
+    Returns:
+        Float minutes
+    """
+    return float(settings['FIXED_MINUTES']) + pending_bytes / 1024 ** 2 / (
+        float(settings['MB_PER_NODE_MINUTE']) * nodes)
+
+
+def plan_resize(pending_bytes, base_nodes, settings):
+    """ Picks the number of nodes to run a load on
+
+    Args:
+        pending_bytes: Int, size of the input
+        base_nodes: Int, the cluster's usual node count
+        settings: dict of the `RESIZE` config
+
+    Returns:
+        dict with the picked `nodes`, the estimated `base_minutes` and
+        `minutes` of the load on the usual and the picked node count, and
+        the `reason` for the choice
+    """
+    max_nodes = max(base_nodes, min(int(settings['MAX_NODES']),
+                                    base_nodes * 2))
+    target = float(settings['TARGET_MINUTES'])
+    base_minutes = load_minutes(pending_bytes, base_nodes, settings)
+
+    nodes = base_nodes
+    while nodes < max_nodes and \
+            load_minutes(pending_bytes, nodes, settings) > target:
+        nodes += 1
+    minutes = load_minutes(pending_bytes, nodes, settings)
+    resize_minutes = 2 * float(settings['RESIZE_MINUTES'])
+
+    if nodes == base_nodes:
+        reason = "{:.1f} min on {} nodes is within the {:.0f} min " \
+                 "target".format(base_minutes, base_nodes, target)
+        if base_minutes > target:
+            reason = "{:.1f} min on {} nodes is over the {:.0f} min " \
+                     "target, but the cluster can not grow past {} " \
+                     "nodes".format(base_minutes, base_nodes, target,
+                                    max_nodes)
+    elif base_minutes - minutes <= resize_minutes:
+        reason = "{} nodes would save {:.1f} min, no more than the {:.0f} " \
+                 "min resizing up and down takes".format(
+                     nodes, base_minutes - minutes, resize_minutes)
+        nodes, minutes = base_nodes, base_minutes
+    else:
+        reason = "{} nodes cut the load from {:.1f} to {:.1f} min".format(
+            nodes, base_minutes, minutes)
+    return {'nodes': nodes, 'base_minutes': base_minutes,
+            'minutes': minutes, 'reason': reason}
+
+
+def resize_cluster(config, redshift, nodes):
+    """ Elastic-resizes the cluster and waits, for up to
+    `RESIZE.MAX_RESIZE_MINUTES`, until it is available again
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+        nodes: Int, the new node count
+
+    Returns:
+        Bool, True if the resize finished in time
+    """
+    print("Resizing Redshift Cluster {} to {} nodes".format(
+        config['CLUSTER']['IDENTIFIER'], nodes))
+    redshift.resize_cluster(
+        ClusterIdentifier=config['CLUSTER']['IDENTIFIER'],
+        NumberOfNodes=nodes,
+        Classic=False
+    )
+    deadline = float(config['RESIZE']['MAX_RESIZE_MINUTES']) * 60
+    return wait_for_cluster_status(config, redshift, 'available',
+                                   deadline) == 'available'
+
+
+def cluster_nodes(config, redshift):
+    """ Returns the cluster's current node count """
+    return redshift.describe_clusters(
+        ClusterIdentifier=config['CLUSTER']['IDENTIFIER']
+    )['Clusters'][0]['NumberOfNodes']
+
+
+def scale_up(cur, config, full_refresh, report=None):
+    """ Resizes the cluster up for the pending load, if that pays off
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        config: a dict of the loaded json config
+        full_refresh: Bool, all of the log data will be reloaded
+        report: a metrics.RunReport to record the decision in
+
+    Returns:
+        Int, the node count the cluster was resized to, or None if it was
+        not resized
+    """
+    settings = config['RESIZE']
+    if settings['ENABLED'].lower() != 'true' or is_local(config) or \
+            config['CLUSTER']['CLUSTER_TYPE'] != 'multi-node':
+        return None
+
+    start = time.time()
+    pending = pending_input_bytes(cur, get_object_store(config), config,
+                                  full_refresh)
+    iam, redshift = get_aws_clients(config)
+    base_nodes = int(config['CLUSTER']['NUM_NODES'])
+    plan = plan_resize(pending['log_bytes'] + pending['song_bytes'],
+                       base_nodes, settings)
+    print("Pending input {:.1f} MB: {}".format(
+        (pending['log_bytes'] + pending['song_bytes']) / 1024 ** 2,
+        plan['reason']))
+
+    # The cluster may still be scaled up if the last resize down failed
+    if plan['nodes'] != cluster_nodes(config, redshift):
+        if not resize_cluster(config, redshift, plan['nodes']):
+            print("Resize did not finish in time, loading anyway")
+    resized = plan['nodes'] if plan['nodes'] != base_nodes else None
+    if report is not None:
+        report.record_event('resize', 'scale_up', time.time() - start,
+                            nodes=plan['nodes'], reason=plan['reason'],
+                            **pending)
+    return resized
+
+
+def scale_down(config, resized, report=None):
+    """ Resizes the cluster back to `CLUSTER.NUM_NODES` after a load it was
+    scaled up for
+
+    Args:
+        config: a dict of the loaded json config
+        resized: Int, as returned by `scale_up`
+        report: a metrics.RunReport to record the resize in
+    """
+    if resized is None:
+        return
+    start = time.time()
+    iam, redshift = get_aws_clients(config)
+    finished = resize_cluster(config, redshift,
+                              int(config['CLUSTER']['NUM_NODES']))
+    if not finished:
+        print("Resize back to {} nodes is still running".format(
+            config['CLUSTER']['NUM_NODES']))
+    if report is not None:
+        report.record_event('resize', 'scale_down', time.time() - start,
+                            nodes=int(config['CLUSTER']['NUM_NODES']),
+                            finished=finished)
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["full-refresh"])
+    except getopt.GetoptError:
+        print("USAGE: resize.py [--full-refresh]")
+        sys.exit(2)
+    full_refresh = ('--full-refresh', '') in opts
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    conn = connect(config)
+    pending = pending_input_bytes(conn.cursor(), get_object_store(config),
+                                  config, full_refresh)
+    conn.close()
+    plan = plan_resize(pending['log_bytes'] + pending['song_bytes'],
+                       int(config['CLUSTER']['NUM_NODES']), config['RESIZE'])
+    print(json.dumps(dict(plan, **pending), indent=2))
+    return plan
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,335 @@
+"""
+Builds and checks the rollup tables: play counts of songplays pre-aggregated
+by the columns the dashboard usually groups on, so its queries read a few
+hundred rows instead of scanning and joining the fact table.
+
+Each entry of `ROLLUPS` in `dwh_config.json` declares a rollup table and the
+comma-separated `table.column` references it groups by, taken from songplays
+or the dimensions it joins to:
+
+    "plays_by_artist": {"GROUP_BY": "songplays.artist_id, artists.name"}
+
+The rollup gets a column of the same name and type for each reference, and
+the number of plays of each group in `plays`. A dimension can hold several
+rows per key, e.g. for an artist whose name is spelled differently across
+the song data, so each one is first collapsed to a row per key, taking the
+greatest value of every column grouped on, and each play counts once.
+
+A full refresh rebuilds the rollups from all of songplays. An incremental
+run only aggregates the new songplays, which are tagged with the load
+version of the run, and merges those deltas into the rollups: groups
+already present have their counts added to, and new groups are inserted.
+Since the counts add up, a merged rollup always equals a full
+recomputation, which `check_rollups` verifies, either on the warehouse or
+on a local sample loaded over several runs. It also checks that the plays
+of every rollup add up to the number of songplays.
+
+Typical Usage example:
+    $ python3 -m scripts.rollups [--sample <data_dir>] [--loads 3]
+"""
+import os
+import sys
+import copy
+import json
+import getopt
+import shutil
+import tempfile
+from scripts.table_layout import column_types, split_columns
+
+CFG_FILE = 'dwh_config.json'
+
+MEASURE = 'plays'
+# The dimensions a rollup can group by, and the key songplays joins each
+# one on
+ROLLUP_JOINS = {
+    'times': 'time_key',
+    'songs': 'song_id',
+    'artists': 'artist_id',
+}
+
+
+def group_by(spec):
+    """ Parses the `GROUP_BY` references of a rollup
+
+    Args:
+        spec: dict of the rollup's `ROLLUPS` entry
+
+    Returns:
+        list of (table, column) pairs
+    """
+    refs = []
+    for ref in split_columns(spec['GROUP_BY']):
+        table, _, column = ref.partition('.')
+        if not column or (table != 'songplays' and table not in ROLLUP_JOINS):
+            raise ValueError(
+                "Rollups group by columns of songplays, {}; not {}".format(
+                    ', '.join(ROLLUP_JOINS), ref))
+        refs.append((table, column))
+    names = [column for table, column in refs] + [MEASURE]
+    if len(set(names)) != len(names):
+        raise ValueError("Rollup column names must be unique: {}".format(
+            ', '.join(names)))
+    return refs
+
+
+def rollup_columns(spec, table_columns):
+    """ Builds the column definitions of a rollup table
+
+    Args:
+        spec: dict of the rollup's `ROLLUPS` entry
+        table_columns: dict of table name to its column definitions
+
+    Returns:
+        String, the column definitions, one per line
+    """
+    lines = []
+    for table, column in group_by(spec):
+        types = column_types(table_columns[table])
+        if column not in types:
+            raise ValueError("{} has no column {}".format(table, column))
+        lines.append('    {:<20}{}'.format(column, types[column]))
+    lines.append('    {:<20}BIGINT      NOT NULL'.format(MEASURE))
+    return '\n' + ',\n'.join(lines) + '\n'
+
+
+def rollup_dependencies(spec):
+    """ Returns the tables a rollup is aggregated from """
+    tables = ['songplays']
+    for table, column in group_by(spec):
+        if table not in tables:
+            tables.append(table)
+    return tables
+
+
+def dimension_join(table, columns):
+    """ Builds the join of songplays to one row per key of a dimension
+
+    Args:
+        table: String, the dimension table
+        columns: list of String columns of the dimension the rollup groups
+            by
+
+    Returns:
+        String SQL LEFT JOIN clause
+    """
+    key = ROLLUP_JOINS[table]
+    selects = [key] + ['MAX({0}) AS {0}'.format(column)
+                       for column in columns if column != key]
+    return ("\n    LEFT JOIN (\n        SELECT {select}\n        FROM {table}"
+            "\n        GROUP BY {key}\n    ) {table}"
+            "\n        ON {table}.{key} = songplays.{key}").format(
+        select=', '.join(selects), table=table, key=key)
+
+
+def aggregate_select(spec, load_version=None):
+    """ Builds the SELECT counting the plays of each group of a rollup
+
+    Args:
+        spec: dict of the rollup's `ROLLUPS` entry
+        load_version: String SQL expression; if given, only songplays of
+            that load version are counted
+
+    Returns:
+        String SQL statement, without a trailing semicolon
+    """
+    refs = group_by(spec)
+    joins = ''.join(
+        dimension_join(table, [column for ref_table, column in refs
+                               if ref_table == table])
+        for table in rollup_dependencies(spec)[1:])
+    return ("SELECT\n    {},\n    COUNT(*) AS {}\nFROM songplays{}{}\n"
+            "GROUP BY {}").format(
+        ',\n    '.join('{}.{}'.format(table, column)
+                       for table, column in refs),
+        MEASURE, joins,
+        '\nWHERE songplays.load_version = {}'.format(load_version)
+        if load_version is not None else '',
+        ', '.join(str(i + 1) for i in range(len(refs))))
+
+
+def rollup_rebuild(name, spec):
+    """ Builds the statements recomputing a rollup from all of songplays """
+    columns = [column for table, column in group_by(spec)] + [MEASURE]
+    return "DELETE FROM {0};\nINSERT INTO {0} ({1})\n{2};\n".format(
+        name, ', '.join(columns), aggregate_select(spec))
+
+
+def rollup_merge(name, spec, load_version):
+    """ Builds the statements merging the plays of one load into a rollup
+
+    The counts of the load's groups are added to the rows already in the
+    rollup, and groups seen for the first time are inserted. Group columns
+    are matched NULL-safely, so plays without e.g. a location are merged
+    too.
+
+    Args:
+        name: String, the rollup table
+        spec: dict of the rollup's `ROLLUPS` entry
+        load_version: String SQL expression of the load version the new
+            songplays are tagged with
+
+    Returns:
+        String SQL statements
+    """
+    columns = [column for table, column in group_by(spec)]
+    match = '\n    AND '.join(
+        '({0}.{1} = delta.{1} OR ({0}.{1} IS NULL AND delta.{1} IS NULL))'
+        .format(name, column) for column in columns)
+    delta = aggregate_select(spec, load_version).replace('\n', '\n    ')
+    return ("""
+UPDATE {name}
+SET {measure} = {name}.{measure} + delta.{measure}
+FROM (
+    {delta}
+) delta
+WHERE {match};
+INSERT INTO {name} ({columns}, {measure})
+SELECT {delta_columns}, delta.{measure}
+FROM (
+    {delta}
+) delta
+    LEFT JOIN {name}
+        ON {join_match}
+WHERE {name}.{measure} IS NULL;
+""").format(name=name, measure=MEASURE, delta=delta, match=match,
+            columns=', '.join(columns),
+            delta_columns=', '.join('delta.' + c for c in columns),
+            join_match=match.replace('\n    AND', '\n        AND'))
+
+
+def compare_rollup(cur, name, spec):
+    """ Compares a rollup with a full recomputation of it from songplays
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        name: String, the rollup table
+        spec: dict of the rollup's `ROLLUPS` entry
+
+    Returns:
+        list of (group, rollup plays, recomputed plays) tuples of the groups
+        that differ, with None for a group missing on one side. If the
+        rollup's plays do not add up to the number of songplays, the list
+        ends with a (None, rollup plays, songplays) tuple.
+    """
+    columns = [column for table, column in group_by(spec)]
+    cur.execute("SELECT {}, {} FROM {};".format(', '.join(columns), MEASURE,
+                                                name))
+    stored = {tuple(row[:-1]): row[-1] for row in cur.fetchall()}
+    cur.execute(aggregate_select(spec) + ';')
+    expected = {tuple(row[:-1]): row[-1] for row in cur.fetchall()}
+    mismatches = [(group, stored.get(group), expected.get(group))
+                  for group in sorted(set(stored) | set(expected), key=repr)
+                  if stored.get(group) != expected.get(group)]
+
+    cur.execute("SELECT COUNT(*) FROM songplays;")
+    plays = cur.fetchone()[0]
+    if sum(stored.values()) != plays:
+        mismatches.append((None, sum(stored.values()), plays))
+    return mismatches
+
+
+def check_rollups(cur, rollups):
+    """ Compares every rollup with a full recomputation of it
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        rollups: dict of the `ROLLUPS` config
+
+    Returns:
+        dict of rollup name to its differing groups, as from
+        `compare_rollup`; empty lists mean the rollup is consistent
+    """
+    mismatches = {}
+    for name, spec in rollups.items():
+        mismatches[name] = compare_rollup(cur, name, spec)
+        print("{}: {}".format(name, "consistent" if not mismatches[name]
+                              else "{} groups differ".format(
+                                  len(mismatches[name]))))
+    return mismatches
+
+
+def check_sample(config, data_dir, loads=3):
+    """ Loads a local sample of the input data into a throwaway DuckDB
+    database over several runs, so the rollups are built by a full refresh
+    and then merged into by incremental runs, and checks them
+
+    Args:
+        config: a dict of the loaded json config
+        data_dir: String, directory laid out like the S3 bucket
+        loads: Int, number of runs to split the log files over
+
+    Returns:
+        dict of rollup name to its differing groups, as from `check_rollups`
+    """
+    from scripts.create_tables import create_db_tables
+    from scripts.etl import etl
+    from scripts.db import connect
+
+    log_dir = os.path.join(data_dir, 'log_data')
+    log_files = sorted(os.path.relpath(os.path.join(root, name), data_dir)
+                       for root, dirs, names in os.walk(log_dir)
+                       for name in names)
+    batches = [log_files[i::loads] for i in range(loads)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = copy.deepcopy(config)
+        config['ETL']['BACKEND'] = 'local'
+        config['ETL']['SONG_MANIFESTS'] = 'false'
+        config['COMPACTION']['ENABLED'] = 'false'
+        config['PARQUET']['ENABLED'] = 'false'
+        config['MAINTENANCE']['ENABLED'] = 'false'
+        config['LOCAL']['DATA_DIR'] = os.path.join(tmp, 'data')
+        config['LOCAL']['DB_PATH'] = os.path.join(tmp, 'sample.duckdb')
+        config['METRICS']['REPORT_DIR'] = os.path.join(tmp, 'reports')
+        shutil.copytree(data_dir, config['LOCAL']['DATA_DIR'],
+                        ignore=lambda path, names: names
+                        if os.path.abspath(path) == os.path.abspath(log_dir)
+                        else [])
+
+        create_db_tables(True, config)
+        for i, batch in enumerate(batches):
+            for path in sorted(batch):
+                target = os.path.join(config['LOCAL']['DATA_DIR'], path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(data_dir, path), target)
+            etl(i == 0, config)
+
+        conn = connect(config)
+        mismatches = check_rollups(conn.cursor(), config['ROLLUPS'])
+        conn.close()
+    return mismatches
+
+
+def main(argv):
+    from scripts.db import connect
+
+    try:
+        opts, args = getopt.getopt(argv, "", ["sample=", "loads="])
+    except getopt.GetoptError:
+        print("USAGE: rollups.py [--sample <data_dir>] [--loads 3]")
+        sys.exit(2)
+    opts = dict(opts)
+
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    if '--sample' in opts:
+        mismatches = check_sample(config, opts['--sample'],
+                                  int(opts.get('--loads', 3)))
+    else:
+        conn = connect(config)
+        mismatches = check_rollups(conn.cursor(), config['ROLLUPS'])
+        conn.close()
+
+    for name, groups in mismatches.items():
+        for group, stored, expected in groups[:10]:
+            print("    {} {}: {} plays, recomputed {}".format(
+                name, 'total' if group is None else group, stored,
+                expected))
+    if any(mismatches.values()):
+        sys.exit(1)
+    return mismatches
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
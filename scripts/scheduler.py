@@ -0,0 +1,155 @@
+"""
+A small dependency-aware scheduler for running SQL steps concurrently.
+
+Steps are named, and each one declares the steps it depends on. A step is
+started as soon as all of its dependencies have finished, with at most
+`max_workers` steps running at once. Every run produces a timeline that
+records when each step became ready, started and ended, so the critical path
+of the run can be read off it.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def topological_order(dependencies):
+    """ Orders steps so that every step comes after its dependencies
+
+    Args:
+        dependencies: dict of step name to a list of step names it needs
+
+    Returns:
+        list of step names
+
+    Raises:
+        ValueError: if a dependency is not a known step or there is a cycle
+    """
+    order = []
+    state = {}
+
+    def visit(step, path):
+        if state.get(step) == 'done':
+            return
+        if state.get(step) == 'visiting':
+            raise ValueError("Dependency cycle: " + " -> ".join(path + [step]))
+        state[step] = 'visiting'
+        for dep in dependencies[step]:
+            if dep not in dependencies:
+                raise ValueError(
+                    "Step {} depends on unknown step {}".format(step, dep))
+            visit(dep, path + [step])
+        state[step] = 'done'
+        order.append(step)
+
+    for step in dependencies:
+        visit(step, [])
+    return order
+
+
+def run_dag(steps, dependencies, run_step, max_workers):
+    """ Runs steps concurrently, respecting their declared dependencies
+
+    If a step fails, no new steps are started, the running ones are allowed
+    to finish and the first error is re-raised.
+
+    Args:
+        steps: dict of step name to the payload passed to `run_step`
+        dependencies: dict of step name to a list of step names it needs,
+            steps missing from the dict have no dependencies
+        run_step: a function called as `run_step(name, payload)`
+        max_workers: Int, max number of steps to run at the same time
+
+    Returns:
+        list of timeline dicts, one per step, in order of start time, with
+        `step`, `ready`, `start` and `end` in seconds since the run started
+        plus the derived `wait` and `run` durations
+    """
+    dependencies = {step: list(dependencies.get(step, [])) for step in steps}
+    topological_order(dependencies)
+
+    remaining = {step: set(deps) for step, deps in dependencies.items()}
+    timeline = {}
+    running = {}
+    errors = []
+    origin = time.time()
+
+    def timed(step):
+        timeline[step]['start'] = time.time() - origin
+        try:
+            run_step(step, steps[step])
+        finally:
+            timeline[step]['end'] = time.time() - origin
+
+    def mark_ready(now):
+        for step, deps in list(remaining.items()):
+            if not deps:
+                del remaining[step]
+                timeline[step] = {'step': step, 'ready': now}
+
+    workers = max(1, max_workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        mark_ready(0.0)
+        while True:
+            if not errors:
+                # Only fill the free workers, so no step is left queued to
+                # start after another one has failed
+                queued = [step for step in timeline
+                          if 'start' not in timeline[step]
+                          and step not in running.values()]
+                for step in queued[:workers - len(running)]:
+                    running[executor.submit(timed, step)] = step
+            if not running:
+                break
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                for deps in remaining.values():
+                    deps.discard(step)
+            mark_ready(time.time() - origin)
+
+    if errors:
+        raise errors[0]
+
+    for entry in timeline.values():
+        entry['wait'] = entry['start'] - entry['ready']
+        entry['run'] = entry['end'] - entry['start']
+    return sorted(timeline.values(), key=lambda entry: entry['start'])
+
+
+def critical_path(timeline, dependencies):
+    """ Finds the chain of steps that determined the run's total duration
+
+    Starting from the step that ended last, repeatedly steps back to the
+    dependency that finished last.
+
+    Args:
+        timeline: list of timeline dicts as returned by `run_dag`
+        dependencies: dict of step name to a list of step names it needs
+
+    Returns:
+        list of step names, first to last
+    """
+    if not timeline:
+        return []
+    entries = {entry['step']: entry for entry in timeline}
+    step = max(timeline, key=lambda entry: entry['end'])['step']
+    path = [step]
+    while dependencies.get(step):
+        step = max(dependencies[step], key=lambda dep: entries[dep]['end'])
+        path.append(step)
+    return list(reversed(path))
+
+
+def print_timeline(timeline, dependencies):
+    """ Prints a run's timeline as a table, followed by its critical path """
+    print("{:<24}{:>9}{:>9}{:>9}{:>9}{:>9}".format(
+        "step", "ready", "start", "end", "wait", "run"))
+    for entry in timeline:
+        print("{:<24}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}".format(
+            entry['step'], entry['ready'], entry['start'], entry['end'],
+            entry['wait'], entry['run']))
+    print("Critical path: ", " -> ".join(critical_path(timeline,
+                                                       dependencies)))
@@ -3,13 +3,29 @@
 This will create:
     - 1x IAM Role with S3 readonly access & Redshift Service access to EC2
     - 1x Redshift Cluster
+    - with `WLM.ENABLED`, 1x cluster parameter group with the WLM queues in
+      `WLM.QUEUES`, which the cluster is created with
+
+The cluster is requested as soon as the role exists, and the role's policy is
+created and attached while the cluster is being provisioned. The cluster is
+then polled with a growing delay until it is available or
+`PROVISIONING.DEADLINE_SECONDS` have passed. Every step first checks whether
+its resource already exists, so rerunning the setup after a partial failure
+picks up where it stopped.
 """
 import json
 import time
-from scripts.helpers import get_aws_clients
+from concurrent.futures import ThreadPoolExecutor
+from scripts.helpers import get_aws_clients, poll
 
 CFG_FILE = 'dwh_config.json'
 
+# Cluster statuses that will never turn into `available` by waiting
+CLUSTER_FAILED_STATUSES = ('deleting', 'final-snapshot', 'hardware-failure',
+                           'incompatible-hsm', 'incompatible-network',
+                           'incompatible-parameters', 'incompatible-restore',
+                           'storage-full')
+
 
 def create_iam_role(config, iam):
     """Creates an AWS IAM Role for Redshift
@@ -19,17 +35,39 @@ def create_iam_role(config, iam):
         iam: a boto3 client object for the AWS IAM service
 
     Returns:
-        A dict of the created IAM role's attributes
+        A dict of the created IAM role's attributes, or of the existing
+        role's if it was created before
     """
     print("Creating IAM Role: ", config['IAM_ROLE']['NAME'])
-    return iam.create_role(
-        Path='/',
-        RoleName=config['IAM_ROLE']['NAME'],
-        AssumeRolePolicyDocument=json.dumps(
-            config['IAM_ROLE']['TRUST_POLICY']
-        ),
-        Description='Role for Accessing Redshift data warehouse'
-    )
+    try:
+        return iam.create_role(
+            Path='/',
+            RoleName=config['IAM_ROLE']['NAME'],
+            AssumeRolePolicyDocument=json.dumps(
+                config['IAM_ROLE']['TRUST_POLICY']
+            ),
+            Description='Role for Accessing Redshift data warehouse'
+        )
+    except iam.exceptions.EntityAlreadyExistsException:
+        print("IAM Role {} already exists".format(config['IAM_ROLE']['NAME']))
+        return iam.get_role(RoleName=config['IAM_ROLE']['NAME'])
+
+
+def find_policy_arn(config, iam):
+    """ Looks up the ARN of the managed policy by its name
+
+    Args:
+        config: a dict of the loaded json config
+        iam: a boto3 client object for the AWS IAM service
+
+    Returns:
+        String ARN, or None if the policy does not exist
+    """
+    for page in iam.get_paginator('list_policies').paginate(Scope='Local'):
+        for policy in page['Policies']:
+            if policy['PolicyName'] == config['IAM_ROLE']['POLICY_NAME']:
+                return policy['Arn']
+    return None
 
 
 def attach_iam_role_policy(config, iam):
@@ -48,10 +86,14 @@ def attach_iam_role_policy(config, iam):
     managed_policy_name = config['IAM_ROLE']['POLICY_NAME']
     print("Creating managed policy: ", managed_policy_name)
 
-    response = iam.create_policy(
-        PolicyName=managed_policy_name,
-        PolicyDocument=json.dumps(config['IAM_ROLE']['MANAGED_POLICY'])
-    )
+    try:
+        policy_arn = iam.create_policy(
+            PolicyName=managed_policy_name,
+            PolicyDocument=json.dumps(config['IAM_ROLE']['MANAGED_POLICY'])
+        )['Policy']['Arn']
+    except iam.exceptions.EntityAlreadyExistsException:
+        print("Policy {} already exists".format(managed_policy_name))
+        policy_arn = find_policy_arn(config, iam)
 
     print(
         "Attaching policy: {} to IAM Role {}".format(
@@ -59,12 +101,129 @@ def attach_iam_role_policy(config, iam):
             config['IAM_ROLE']['NAME']
         )
     )
+    # Attaching an already attached policy is a no-op
     return iam.attach_role_policy(
-        PolicyArn=response['Policy']['Arn'],
+        PolicyArn=policy_arn,
         RoleName=config['IAM_ROLE']['NAME']
     )
 
 
+def wlm_config_problems(config):
+    """ Checks that every phase in `WLM.PHASES` has a queue to run in
+
+    Args:
+        config: a dict of the loaded json config
+
+    Returns:
+        list of String problems, empty if the WLM settings fit together
+    """
+    queues = config['WLM']['QUEUES']
+    problems = []
+    for phase, settings in config['WLM']['PHASES'].items():
+        group = settings.get('QUERY_GROUP')
+        queue = next((queue for queue in queues
+                      if group and group in queue.get('query_group', [])),
+                     None)
+        if queue is None:
+            problems.append("No WLM queue has query group {!r} of phase "
+                            "{}".format(group, phase))
+        elif int(settings.get('SLOT_COUNT') or 1) > \
+                queue['query_concurrency']:
+            problems.append("Phase {} takes {} slots, more than the {} of "
+                            "its queue".format(phase, settings['SLOT_COUNT'],
+                                               queue['query_concurrency']))
+    return problems
+
+
+def current_wlm_configuration(config, redshift):
+    """ Returns the WLM queues set in the parameter group, or None """
+    paginator = redshift.get_paginator('describe_cluster_parameters')
+    for page in paginator.paginate(
+            ParameterGroupName=config['WLM']['PARAMETER_GROUP']):
+        for parameter in page['Parameters']:
+            if parameter['ParameterName'] == 'wlm_json_configuration':
+                return json.loads(parameter['ParameterValue'])
+    return None
+
+
+def create_wlm_parameter_group(config, redshift):
+    """ Creates the cluster parameter group with the WLM queues in
+    `WLM.QUEUES`, or updates an existing group whose queues differ
+
+    The queues give the ETL and the dashboard's query groups their own
+    slots and memory, so the loads do not hold up dashboard queries.
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+
+    Returns:
+        String, the parameter group's name
+    """
+    problems = wlm_config_problems(config)
+    if problems:
+        raise ValueError("Invalid WLM settings: " + '; '.join(problems))
+
+    name = config['WLM']['PARAMETER_GROUP']
+    print("Creating cluster parameter group: ", name)
+    try:
+        redshift.create_cluster_parameter_group(
+            ParameterGroupName=name,
+            ParameterGroupFamily='redshift-1.0',
+            Description='Sparkify WLM queues')
+    except redshift.exceptions.ClusterParameterGroupAlreadyExistsFault:
+        print("Cluster parameter group {} already exists".format(name))
+
+    if current_wlm_configuration(config, redshift) != config['WLM']['QUEUES']:
+        print("Setting the WLM queues of ", name)
+        redshift.modify_cluster_parameter_group(
+            ParameterGroupName=name,
+            Parameters=[{'ParameterName': 'wlm_json_configuration',
+                         'ParameterValue': json.dumps(
+                             config['WLM']['QUEUES']),
+                         'ApplyType': 'dynamic'}])
+    return name
+
+
+def check_cluster_wlm(config, redshift):
+    """ Puts the cluster in the WLM parameter group, if it is not already,
+    and warns if the group's settings wait on a reboot
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+
+    Returns:
+        String, the parameter group's apply status, e.g. `in-sync`
+    """
+    name = config['WLM']['PARAMETER_GROUP']
+    cluster = redshift.describe_clusters(
+        ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])['Clusters'][0]
+    groups = {group['ParameterGroupName']: group['ParameterApplyStatus']
+              for group in cluster.get('ClusterParameterGroups', [])}
+    if name not in groups:
+        print("Moving Redshift Cluster {} to parameter group {}".format(
+            config['CLUSTER']['IDENTIFIER'], name))
+        redshift.modify_cluster(
+            ClusterIdentifier=config['CLUSTER']['IDENTIFIER'],
+            ClusterParameterGroupName=name)
+        status = 'pending-reboot'
+    else:
+        status = groups[name]
+    if status == 'pending-reboot':
+        print("The WLM queues apply once cluster {} is rebooted".format(
+            config['CLUSTER']['IDENTIFIER']))
+    return status
+
+
+def parameter_group_args(config):
+    """ Returns the create or restore arguments that put the cluster in the
+    WLM parameter group, if `WLM.ENABLED` """
+    if config['WLM']['ENABLED'].lower() != 'true':
+        return {}
+    return {'ClusterParameterGroupName': config['WLM']['PARAMETER_GROUP']}
+
+
 def start_redshift_cluster(config, redshift, role_arn):
     """ Creates a Redshift cluster based on configs
 
@@ -74,50 +233,167 @@ def start_redshift_cluster(config, redshift, role_arn):
         role_arn: String
 
     Returns:
-        A dict with the AWS API response metadata of the create_cluster call
+        A dict with the AWS API response metadata of the create_cluster call,
+        or of describe_clusters if the cluster already exists
     """
     print("Creating Redshift Cluster: ", config['CLUSTER']['IDENTIFIER'])
-    return redshift.create_cluster(
-        DBName=config['CLUSTER']['DB_NAME'],
-        ClusterIdentifier=config['CLUSTER']['IDENTIFIER'],
-        ClusterType=config['CLUSTER']['CLUSTER_TYPE'],
-        NodeType=config['CLUSTER']['NODE_TYPE'],
-        MasterUsername=config['CLUSTER']['DB_USER'],
-        MasterUserPassword=config['CLUSTER']['DB_PASSWORD'],
-        Port=int(config['CLUSTER']['DB_PORT']),
-        NumberOfNodes=int(config['CLUSTER']['NUM_NODES']),
-        IamRoles=[role_arn]
-    )
+    try:
+        return redshift.create_cluster(
+            DBName=config['CLUSTER']['DB_NAME'],
+            ClusterIdentifier=config['CLUSTER']['IDENTIFIER'],
+            ClusterType=config['CLUSTER']['CLUSTER_TYPE'],
+            NodeType=config['CLUSTER']['NODE_TYPE'],
+            MasterUsername=config['CLUSTER']['DB_USER'],
+            MasterUserPassword=config['CLUSTER']['DB_PASSWORD'],
+            Port=int(config['CLUSTER']['DB_PORT']),
+            NumberOfNodes=int(config['CLUSTER']['NUM_NODES']),
+            IamRoles=[role_arn],
+            **parameter_group_args(config)
+        )
+    except redshift.exceptions.ClusterAlreadyExistsFault:
+        print("Redshift Cluster {} already exists".format(
+            config['CLUSTER']['IDENTIFIER']))
+        return redshift.describe_clusters(
+            ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])
+
+
+def cluster_status(config, redshift):
+    """ Returns the cluster's status, or None if it does not exist """
+    try:
+        return redshift.describe_clusters(
+            ClusterIdentifier=config['CLUSTER']['IDENTIFIER']
+        )['Clusters'][0]['ClusterStatus']
+    except redshift.exceptions.ClusterNotFoundFault:
+        return None
 
 
-def confirm_cluster_available(config, redshift):
-    """ Repeatedly polls a redshift cluster until its status is `available`
+def wait_for_cluster_status(config, redshift, wanted, deadline_seconds=None):
+    """ Polls a redshift cluster, with a growing delay, until it reaches a
+    status
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+        wanted: String, the status to wait for, e.g. `available`
+        deadline_seconds: Float, how long to wait, defaults to
+            `PROVISIONING.DEADLINE_SECONDS`
+
+    Returns:
+        String, the wanted status, or the last status seen if the cluster
+        failed or the deadline passed
+    """
+    settings = config['PROVISIONING']
+    if deadline_seconds is None:
+        deadline_seconds = float(settings['DEADLINE_SECONDS'])
+
+    status = {'cluster': 'not_available'}
+
+    def check():
+        print("...", end='', flush=True)    # loading "bar"
+        status['cluster'] = cluster_status(config, redshift) or 'not_found'
+        return status['cluster'] in (wanted,) + CLUSTER_FAILED_STATUSES
+
+    poll(check, deadline_seconds, float(settings['POLL_SECONDS']),
+         float(settings['MAX_POLL_SECONDS']))
+    if status['cluster'] != wanted:
+        print("Cluster is {} after waiting up to {:.0f}s. Rerun the setup to "
+              "keep waiting, or run cleanup_redshift.".format(
+                  status['cluster'], deadline_seconds))
+    return status['cluster']
+
+
+def confirm_cluster_available(config, redshift, deadline_seconds=None):
+    """ Polls a redshift cluster, with a growing delay, until its status is
+    `available`
 
     Args:
         config: a ConfigParser object
         redshift: a boto3 client object for the AWS Redshift service
+        deadline_seconds: Float, how long to wait, defaults to
+            `PROVISIONING.DEADLINE_SECONDS`
 
     Returns:
-         String describing cluster status: `available` or `not_available`
+         String describing cluster status: `available`, or the last status
+         seen if the cluster failed or the deadline passed
     """
     print("Waiting for cluster to become live:")
+    status = wait_for_cluster_status(config, redshift, 'available',
+                                     deadline_seconds)
+    if status == 'available':
+        print("Cluster {} is now live!".format(
+            config['CLUSTER']['IDENTIFIER']))
+    return status
 
-    timeout = time.time() + 60 * 6
-    cluster_status = "not_available"
-    while cluster_status != "available":
-        print("...", end='', flush=True)    # loading "bar"
-        if time.time() >= timeout:
-            print("Cluster response has timed out. Please run "
-                  "redshift_cleanup.")
-            return cluster_status
 
-        cluster_status = redshift.describe_clusters(
-            ClusterIdentifier=config['CLUSTER']['IDENTIFIER']
-        )['Clusters'][0]['ClusterStatus']
-        time.sleep(30)
+def resume_redshift_cluster(config, redshift):
+    """ Resumes the paused cluster, waiting for it to finish pausing first
+    if needed
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+
+    Returns:
+        A dict with the AWS API response metadata of the resume_cluster call
+    """
+    if cluster_status(config, redshift) == 'pausing':
+        wait_for_cluster_status(config, redshift, 'paused')
+    print("Resuming Redshift Cluster: ", config['CLUSTER']['IDENTIFIER'])
+    return redshift.resume_cluster(
+        ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])
 
-    print("Cluster {} is now live!".format(config['CLUSTER']['IDENTIFIER']))
-    return cluster_status
+
+def list_snapshots(config, redshift, available_only=True):
+    """ Lists the snapshots named with `LIFECYCLE.SNAPSHOT_PREFIX`, newest
+    first, leaving out those still being created if `available_only` """
+    prefix = config['LIFECYCLE']['SNAPSHOT_PREFIX'] + '-'
+    snapshots = []
+    paginator = redshift.get_paginator('describe_cluster_snapshots')
+    for page in paginator.paginate(SnapshotType='manual'):
+        snapshots.extend(
+            snapshot for snapshot in page['Snapshots']
+            if snapshot['SnapshotIdentifier'].startswith(prefix)
+            and (snapshot['Status'] == 'available' or not available_only))
+    return sorted(snapshots, reverse=True,
+                  key=lambda snapshot: snapshot['SnapshotCreateTime'])
+
+
+def latest_snapshot(config, redshift):
+    """ Finds the newest manual snapshot taken by the snapshot lifecycle
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+
+    Returns:
+        String snapshot identifier, or None if there is none
+    """
+    snapshots = list_snapshots(config, redshift)
+    return snapshots[0]['SnapshotIdentifier'] if snapshots else None
+
+
+def restore_redshift_cluster(config, redshift, role_arn, snapshot_id):
+    """ Restores the cluster from a snapshot
+
+    Args:
+        config: a dict of the loaded json config
+        redshift: a boto3 client object for the AWS Redshift service
+        role_arn: String
+        snapshot_id: String, the snapshot to restore
+
+    Returns:
+        A dict with the AWS API response metadata of the
+        restore_from_cluster_snapshot call
+    """
+    print("Restoring Redshift Cluster {} from snapshot {}".format(
+        config['CLUSTER']['IDENTIFIER'], snapshot_id))
+    return redshift.restore_from_cluster_snapshot(
+        ClusterIdentifier=config['CLUSTER']['IDENTIFIER'],
+        SnapshotIdentifier=snapshot_id,
+        Port=int(config['CLUSTER']['DB_PORT']),
+        IamRoles=[role_arn],
+        **parameter_group_args(config)
+    )
 
 
 def save_cluster_endpoint(config, redshift):
@@ -129,14 +405,59 @@ def save_cluster_endpoint(config, redshift):
         json.dump(config, f, indent=2)
 
 
-def setup_redshift_cluster():
+def setup_redshift_cluster(mode=None):
+    """ Creates the IAM role and policy and brings up the Redshift cluster,
+    and saves the cluster's endpoint to the config
+
+    How the cluster is brought up depends on the lifecycle mode:
+
+        create   - a new, empty cluster is created
+        pause    - the cluster paused after the last run is resumed
+        snapshot - the cluster is restored from the newest snapshot taken
+                   when it was last torn down
+
+    If there is nothing to resume or restore from, a new cluster is created.
+    With `WLM.ENABLED`, the WLM parameter group is created or updated first,
+    and a resumed cluster that is not in it is moved to it.
+
+    Args:
+        mode: String, one of the above, defaults to `LIFECYCLE.MODE`
+
+    Returns:
+        String, the cluster status, as from `confirm_cluster_available`
+    """
     with open(CFG_FILE) as f:
         config = json.load(f)
+    mode = mode or config['LIFECYCLE']['MODE']
 
+    start = time.time()
     iam, redshift = get_aws_clients(config)
-    create_iam_role(config, iam)
-    attach_iam_role_policy(config, iam)
-    role_arn = iam.get_role(RoleName=config['IAM_ROLE']['NAME'])['Role']['Arn']
-    start_redshift_cluster(config, redshift, role_arn)
-    confirm_cluster_available(config, redshift)
-    save_cluster_endpoint(config, redshift)
+    role_arn = create_iam_role(config, iam)['Role']['Arn']
+    wlm = config['WLM']['ENABLED'].lower() == 'true'
+    if wlm:
+        create_wlm_parameter_group(config, redshift)
+    status = cluster_status(config, redshift)
+    snapshot_id = latest_snapshot(config, redshift) \
+        if status is None and mode == 'snapshot' else None
+    if status in ('paused', 'pausing'):
+        resume_redshift_cluster(config, redshift)
+    elif snapshot_id:
+        restore_redshift_cluster(config, redshift, role_arn, snapshot_id)
+    else:
+        start_redshift_cluster(config, redshift, role_arn)
+
+    # The cluster only needs the policy once it loads data, so the policy is
+    # set up while the cluster is being provisioned
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        policy = executor.submit(attach_iam_role_policy, config, iam)
+        available = executor.submit(confirm_cluster_available, config,
+                                    redshift)
+        policy.result()
+        status = available.result()
+
+    if status == 'available':
+        save_cluster_endpoint(config, redshift)
+        if wlm:
+            check_cluster_wlm(config, redshift)
+    print("Setup finished in {:.1f}s".format(time.time() - start))
+    return status
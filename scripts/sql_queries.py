@@ -8,11 +8,17 @@ songplays   - records in log data associated with song plays
 users       - users in the app
 songs       - songs in music database
 artists     - artists in music database
-times       - timestamps of records in songplays broken down
-              into specific units
+times       - hours (or days) of the songplays broken down
+              into specific units, see `time_dimension.py`
+
+##################### ROLLUP TABLES:    #####################
+declared in `ROLLUPS` in the config, see `rollups.py`
 """
 
 import json
+from scripts.table_layout import create_table
+from scripts.rollups import rollup_columns, rollup_dependencies, \
+    rollup_rebuild, rollup_merge
 
 CFG_FILE = 'dwh_config.json'
 
@@ -30,12 +36,18 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS times;"
+load_state_table_drop = "DROP TABLE IF EXISTS load_state;"
+load_version_table_drop = "DROP TABLE IF EXISTS load_version;"
+staging_events_keyed_table_drop = "DROP TABLE IF EXISTS staging_events_keyed;"
+staging_songs_keyed_table_drop = "DROP TABLE IF EXISTS staging_songs_keyed;"
+staging_songplays_table_drop = "DROP TABLE IF EXISTS staging_songplays;"
 
 # CREATE TABLES
+# Columns of each table. Their distribution and sort keys come from `TABLES`
+# in the config, see `table_layout.py`.
 
-staging_events_table_create = ("""
-CREATE TABLE staging_events (
-    artist_name	        TEXT,
+staging_events_table_columns = ("""
+    artist_name         TEXT,
     auth                VARCHAR(30),
     first_name          TEXT,
     gender              VARCHAR(2),
@@ -53,11 +65,9 @@ CREATE TABLE staging_events (
     ts                  TIMESTAMP,
     user_agent          TEXT,
     user_id             INTEGER
-);
 """)
 
-staging_songs_table_create = ("""
-CREATE TABLE staging_songs (
+staging_songs_table_columns = ("""
     artist_id           VARCHAR(30) NOT NULL,
     artist_latitude     FLOAT8,
     artist_location     TEXT,
@@ -68,70 +78,236 @@ CREATE TABLE staging_songs (
     song_id             TEXT NOT NULL,
     title               TEXT,
     year                INTEGER
-);
 """)
 
-songplay_table_create = ("""
-CREATE TABLE songplays (
-    songplay_id         INTEGER IDENTITY(0,1)   PRIMARY KEY   SORTKEY DISTKEY,
+songplay_table_columns = ("""
+    songplay_id         INTEGER IDENTITY(0,1)   PRIMARY KEY,
     start_time          TIMESTAMP,
+    time_key            INTEGER,
     user_id             INTEGER,
     level               VARCHAR(15),
     song_id             TEXT,
     artist_id           VARCHAR(30),
     session_id          INTEGER,
     location            TEXT,
-    user_agent          TEXT
-);
+    user_agent          TEXT,
+    load_version        BIGINT
 """)
 
-user_table_create = ("""
-CREATE TABLE users (
-    user_id             INTEGER     NOT NULL    SORTKEY,
+user_table_columns = ("""
+    user_id             INTEGER     NOT NULL,
     first_name          TEXT,
     last_name           TEXT,
     gender              VARCHAR(2),
     level               VARCHAR(15)
-)
-diststyle all;
 """)
 
-song_table_create = ("""
-CREATE TABLE songs (
-    song_id             TEXT      NOT NULL    SORTKEY,
-    title               TEXT, 
-    artist_id           VARCHAR(30), 
-    year                INTEGER, 
+song_table_columns = ("""
+    song_id             TEXT        NOT NULL,
+    title               TEXT,
+    artist_id           VARCHAR(30),
+    year                INTEGER,
     duration            FLOAT4
-)
-diststyle all;
 """)
 
-artist_table_create = ("""
-CREATE TABLE artists (
-    artist_id           VARCHAR(30) NOT NULL    SORTKEY,
+artist_table_columns = ("""
+    artist_id           VARCHAR(30) NOT NULL,
     name                TEXT,
     location            TEXT,
     latitude            FLOAT8,
     longitude           FLOAT8
-)
-diststyle all;
 """)
 
-time_table_create = ("""
-CREATE TABLE times (
-    start_time          TIMESTAMP   NOT NULL    SORTKEY,
+time_table_columns = ("""
+    time_key            INTEGER     NOT NULL,
+    start_time          TIMESTAMP   NOT NULL,
     hour                INTEGER     NOT NULL,
     day                 INTEGER     NOT NULL,
     week                INTEGER     NOT NULL,
     month               INTEGER     NOT NULL,
     year                INTEGER     NOT NULL,
     weekday             INTEGER     NOT NULL
-)
-diststyle all;
+""")
+
+load_state_table_columns = ("""
+    s3_key              VARCHAR(1024)   NOT NULL,
+    loaded_at           TIMESTAMP       NOT NULL
+""")
+
+load_version_table_columns = ("""
+    version             BIGINT      NOT NULL,
+    loaded_at           TIMESTAMP   NOT NULL
+""")
+
+# Keyed copies of the staging tables used to build songplays. Both sides are
+# distributed and sorted on the same match key, so the join is collocated on
+# each slice and can run as a merge join.
+
+staging_events_keyed_table_columns = ("""
+    match_key           BIGINT      NOT NULL,
+    user_id             INTEGER,
+    ts                  TIMESTAMP,
+    level               VARCHAR(15),
+    session_id          INTEGER,
+    location            TEXT,
+    user_agent          TEXT
+""")
+
+staging_songs_keyed_table_columns = ("""
+    match_key           BIGINT      NOT NULL,
+    song_id             TEXT        NOT NULL,
+    artist_id           VARCHAR(30) NOT NULL
+""")
+
+# New songplays built off to the side, then moved into songplays with
+# ALTER TABLE APPEND, see `blue_green.py`. The same columns and layout as
+# songplays, bar the IDENTITY column, which the APPEND fills in.
+
+staging_songplays_table_columns = '\n'.join(
+    line for line in songplay_table_columns.split('\n')
+    if 'IDENTITY' not in line)
+
+table_columns = {
+    'staging_events': staging_events_table_columns,
+    'staging_songs': staging_songs_table_columns,
+    'songplays': songplay_table_columns,
+    'users': user_table_columns,
+    'songs': song_table_columns,
+    'artists': artist_table_columns,
+    'times': time_table_columns,
+    'load_state': load_state_table_columns,
+    'load_version': load_version_table_columns,
+    'staging_events_keyed': staging_events_keyed_table_columns,
+    'staging_songs_keyed': staging_songs_keyed_table_columns,
+    'staging_songplays': staging_songplays_table_columns,
+}
+rollups = config['ROLLUPS']
+rollup_table_columns = {name: rollup_columns(spec, table_columns)
+                        for name, spec in rollups.items()}
+table_columns.update(rollup_table_columns)
+table_specs = config['TABLES']
+
+staging_events_table_create = create_table(
+    'staging_events', staging_events_table_columns,
+    table_specs.get('staging_events'))
+staging_songs_table_create = create_table(
+    'staging_songs', staging_songs_table_columns,
+    table_specs.get('staging_songs'))
+songplay_table_create = create_table(
+    'songplays', songplay_table_columns, table_specs.get('songplays'))
+user_table_create = create_table(
+    'users', user_table_columns, table_specs.get('users'))
+song_table_create = create_table(
+    'songs', song_table_columns, table_specs.get('songs'))
+artist_table_create = create_table(
+    'artists', artist_table_columns, table_specs.get('artists'))
+time_table_create = create_table(
+    'times', time_table_columns, table_specs.get('times'))
+load_state_table_create = create_table(
+    'load_state', load_state_table_columns, table_specs.get('load_state'))
+load_version_table_create = create_table(
+    'load_version', load_version_table_columns,
+    table_specs.get('load_version'))
+staging_events_keyed_table_create = create_table(
+    'staging_events_keyed', staging_events_keyed_table_columns,
+    table_specs.get('staging_events_keyed'))
+staging_songs_keyed_table_create = create_table(
+    'staging_songs_keyed', staging_songs_keyed_table_columns,
+    table_specs.get('staging_songs_keyed'))
+staging_songplays_table_create = create_table(
+    'staging_songplays', staging_songplays_table_columns,
+    table_specs.get('songplays'))
+
+# LOAD STATE
+
+load_state_select = "SELECT s3_key FROM load_state;"
+load_state_delete = "DELETE FROM load_state;"
+
+# LOAD VERSION
+# Bumped by every run that loads data, in the same transaction, so cached
+# query results can tell whether the warehouse has changed since.
+
+load_version_select = "SELECT COALESCE(MAX(version), 0) FROM load_version;"
+# Versions start over at 1 whenever load_version is recreated, e.g. by a
+# full refresh with `-c` or a blue/green rebuild, so a version is only
+# identified by its number together with when it was loaded.
+load_version_latest_select = ("""
+SELECT version, loaded_at
+FROM load_version
+ORDER BY version DESC
+LIMIT 1;
+""")
+# The version the running load will be recorded as; the rows it adds to
+# songplays are tagged with it, so the rollups can pick out the new plays.
+load_version_next = "(SELECT COALESCE(MAX(version), 0) + 1 FROM load_version)"
+load_version_bump = ("""
+INSERT INTO load_version (version, loaded_at)
+SELECT COALESCE(MAX(version), 0) + 1, GETDATE()
+FROM load_version;
+""")
+
+# RUN STATE
+# The steps each run has finished, see `checkpoints.py`. Not one of the
+# pipeline's tables, so a full refresh does not drop it, and kept in public,
+# so swapping the warehouse schema does not move it.
+
+run_state_table_columns = ("""
+    run_id              VARCHAR(64)     NOT NULL,
+    step                VARCHAR(512)    NOT NULL,
+    finished_at         TIMESTAMP       NOT NULL
+""")
+run_state_table_create = create_table(
+    'public.run_state', run_state_table_columns, {'DISTSTYLE': 'ALL'})
+run_state_select = "SELECT step FROM public.run_state WHERE run_id = %s;"
+run_state_insert = ("""
+INSERT INTO public.run_state (run_id, step, finished_at)
+VALUES (%s, %s, GETDATE());
+""")
+
+# LOAD ERRORS
+# Records COPY rejected within its `LOAD_ERRORS.MAXERROR` budget, copied out
+# of STL_LOAD_ERRORS after each COPY, see `load_errors.py`. Kept across runs
+# and schema swaps like run_state.
+
+load_errors_table_columns = ("""
+    run_id              VARCHAR(64)     NOT NULL,
+    copy_name           VARCHAR(256)    NOT NULL,
+    query               INTEGER         NOT NULL,
+    filename            VARCHAR(256),
+    line_number         BIGINT,
+    colname             VARCHAR(127),
+    type                VARCHAR(10),
+    position            INTEGER,
+    raw_field_value     VARCHAR(1024),
+    err_code            INTEGER,
+    err_reason          VARCHAR(100),
+    raw_line            VARCHAR(1024),
+    quarantined_at      TIMESTAMP       NOT NULL
+""")
+load_errors_table_create = create_table(
+    'public.load_errors', load_errors_table_columns, {'DISTSTYLE': 'EVEN'})
+last_copy_select = "SELECT pg_last_copy_id();"
+stl_load_errors_select = ("""
+SELECT TRIM(filename), line_number, TRIM(colname), TRIM(type), position,
+    TRIM(raw_field_value), err_code, TRIM(err_reason), TRIM(raw_line)
+FROM stl_load_errors
+WHERE query = %s
+ORDER BY filename, line_number;
+""")
+load_errors_quarantine = ("""
+INSERT INTO public.load_errors
+SELECT %s, %s, query, TRIM(filename), line_number, TRIM(colname), TRIM(type),
+    position, TRIM(raw_field_value), err_code, TRIM(err_reason),
+    TRIM(raw_line), GETDATE()
+FROM stl_load_errors
+WHERE query = %s;
 """)
 
 # STAGING TABLES
+# The staging tables are emptied and reloaded on every run, so COPY skips
+# sampling them for compression encodings and statistics; their encodings
+# are set in `TABLES` instead. Each JSON COPY may skip up to its table's
+# `LOAD_ERRORS.MAXERROR` bad records rather than failing on the first one.
 
 staging_events_copy = ("""
 COPY staging_events FROM '{}' 
@@ -139,21 +315,230 @@ CREDENTIALS 'aws_iam_role={}'
 FORMAT AS JSON '{}'
 REGION '{}'
 TIMEFORMAT 'epochmillisecs'
-TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL;
+TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+MAXERROR {}
+COMPUPDATE OFF STATUPDATE OFF;
 """).format(config['S3']['LOG_DATA'],
             config['IAM_ROLE']['ARN'],
             config['S3']['LOG_JSONPATH'],
-            config['AWS']['REGION'])
+            config['AWS']['REGION'],
+            config['LOAD_ERRORS']['MAXERROR']['staging_events'])
 
 staging_songs_copy = ("""
 COPY staging_songs FROM '{}'
 CREDENTIALS 'aws_iam_role={}'
 FORMAT AS JSON 'auto'
 REGION '{}'
-TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL;
+TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+MAXERROR {}
+COMPUPDATE OFF STATUPDATE OFF;
 """).format(config['S3']['SONG_DATA'],
             config['IAM_ROLE']['ARN'],
-            config['AWS']['REGION'])
+            config['AWS']['REGION'],
+            config['LOAD_ERRORS']['MAXERROR']['staging_songs'])
+
+# Incremental loads COPY only the new log files, listed in a manifest, into
+# emptied staging tables. DELETE is used rather than TRUNCATE, which would
+# commit straight away.
+
+staging_events_clear = "DELETE FROM staging_events;"
+staging_songs_clear = "DELETE FROM staging_songs;"
+
+staging_events_manifest_copy = ("""
+COPY staging_events FROM '{{}}'
+CREDENTIALS 'aws_iam_role={}'
+FORMAT AS JSON '{}'
+REGION '{}'
+TIMEFORMAT 'epochmillisecs'
+TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+MAXERROR {}
+COMPUPDATE OFF STATUPDATE OFF
+MANIFEST;
+""").format(config['IAM_ROLE']['ARN'],
+            config['S3']['LOG_JSONPATH'],
+            config['AWS']['REGION'],
+            config['LOAD_ERRORS']['MAXERROR']['staging_events'])
+
+staging_songs_manifest_copy = ("""
+COPY staging_songs FROM '{{}}'
+CREDENTIALS 'aws_iam_role={}'
+FORMAT AS JSON 'auto'
+REGION '{}'
+TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+MAXERROR {}
+COMPUPDATE OFF STATUPDATE OFF
+MANIFEST;
+""").format(config['IAM_ROLE']['ARN'],
+            config['AWS']['REGION'],
+            config['LOAD_ERRORS']['MAXERROR']['staging_songs'])
+
+# The compaction stage rewrites the inputs as gzip newline-delimited JSON
+# under its own prefix, which the COPYs then read from instead.
+
+staging_events_compacted_copy = ("""
+COPY staging_events FROM '{}/log_data/'
+CREDENTIALS 'aws_iam_role={}'
+FORMAT AS JSON '{}'
+REGION '{}'
+TIMEFORMAT 'epochmillisecs'
+TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+MAXERROR {}
+COMPUPDATE OFF STATUPDATE OFF
+GZIP;
+""").format(config['COMPACTION']['STAGING_PREFIX'].rstrip('/'),
+            config['IAM_ROLE']['ARN'],
+            config['S3']['LOG_JSONPATH'],
+            config['AWS']['REGION'],
+            config['LOAD_ERRORS']['MAXERROR']['staging_events'])
+
+staging_songs_compacted_copy = ("""
+COPY staging_songs FROM '{}/song_data/'
+CREDENTIALS 'aws_iam_role={}'
+FORMAT AS JSON 'auto'
+REGION '{}'
+TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+MAXERROR {}
+COMPUPDATE OFF STATUPDATE OFF
+GZIP;
+""").format(config['COMPACTION']['STAGING_PREFIX'].rstrip('/'),
+            config['IAM_ROLE']['ARN'],
+            config['AWS']['REGION'],
+            config['LOAD_ERRORS']['MAXERROR']['staging_songs'])
+
+# Columnar alternatives to the JSON COPYs, loading Parquet files written by
+# `convert_parquet.py` with columns already in table order and typed.
+
+staging_events_parquet_copy = ("""
+COPY staging_events FROM '{}/log_data/'
+CREDENTIALS 'aws_iam_role={}'
+FORMAT AS PARQUET
+COMPUPDATE OFF STATUPDATE OFF;
+""").format(config['PARQUET']['PREFIX'].rstrip('/'),
+            config['IAM_ROLE']['ARN'])
+
+staging_songs_parquet_copy = ("""
+COPY staging_songs FROM '{}/song_data/'
+CREDENTIALS 'aws_iam_role={}'
+FORMAT AS PARQUET
+COMPUPDATE OFF STATUPDATE OFF;
+""").format(config['PARQUET']['PREFIX'].rstrip('/'),
+            config['IAM_ROLE']['ARN'])
+
+# MATCH KEYS
+# Songs are matched to log events on a 64-bit hash of their normalized title
+# and artist name, and optionally their duration, rather than on the two
+# free-text columns themselves.
+
+
+def match_key(title, artist, duration=None):
+    """ Builds the SQL expression of the song match key
+
+    Args:
+        title: String, the column holding the song title
+        artist: String, the column holding the artist name
+        duration: String, the column holding the song length, or None to
+            leave it out of the key
+
+    Returns:
+        String SQL expression
+    """
+    parts = ["LOWER(TRIM({}))".format(title),
+             "LOWER(TRIM({}))".format(artist)]
+    if duration is not None:
+        parts.append("CAST(CAST({} AS DECIMAL(10, 2)) AS VARCHAR)".format(
+            duration))
+    return "FNV_HASH({})".format(" || '|' || ".join(parts))
+
+
+match_on_duration = config['ETL']['MATCH_KEY_DURATION'].lower() == 'true'
+
+staging_events_keyed_insert = ("""
+DELETE FROM staging_events_keyed;
+INSERT INTO staging_events_keyed (
+    match_key,
+    user_id,
+    ts,
+    level,
+    session_id,
+    location,
+    user_agent
+)
+SELECT
+    {},
+    user_id,
+    ts,
+    level,
+    session_id,
+    location,
+    user_agent
+FROM staging_events
+WHERE page = 'NextSong'
+    AND song_title IS NOT NULL
+    AND artist_name IS NOT NULL{};
+""").format(match_key('song_title', 'artist_name',
+                      'length' if match_on_duration else None),
+            "\n    AND length IS NOT NULL" if match_on_duration else "")
+
+staging_songs_keyed_insert = ("""
+DELETE FROM staging_songs_keyed;
+INSERT INTO staging_songs_keyed (
+    match_key,
+    song_id,
+    artist_id
+)
+SELECT
+    {},
+    song_id,
+    artist_id
+FROM staging_songs
+WHERE title IS NOT NULL
+    AND artist_name IS NOT NULL{};
+""").format(match_key('title', 'artist_name',
+                      'duration' if match_on_duration else None),
+            "\n    AND duration IS NOT NULL" if match_on_duration else "")
+
+# TIME DIMENSION
+# One row per hour, or day, of `TIME_DIMENSION.GRAIN`, generated on the
+# client and extended as new dates arrive, see `time_dimension.py`. Rows are
+# keyed on the number of whole grains since the epoch, which songplays
+# carries too.
+
+time_grain_seconds = {'hour': 3600, 'day': 86400}
+
+
+def time_key(ts):
+    """ Builds the SQL expression of the time key of a timestamp
+
+    Args:
+        ts: String, the column holding the timestamp
+
+    Returns:
+        String SQL expression
+    """
+    return "CAST(FLOOR(EXTRACT(EPOCH FROM {}) / {}) AS INTEGER)".format(
+        ts, time_grain_seconds[config['TIME_DIMENSION']['GRAIN']])
+
+
+time_table_range_select = "SELECT MIN(time_key), MAX(time_key) FROM times;"
+staging_events_range_select = ("""
+SELECT MIN(ts), MAX(ts)
+FROM staging_events
+WHERE page = 'NextSong';
+""")
+time_table_values_insert = ("""
+INSERT INTO times (
+    time_key,
+    start_time,
+    hour,
+    day,
+    week,
+    month,
+    year,
+    weekday
+)
+VALUES
+{};
+""")
 
 # FINAL TABLES
 
@@ -161,27 +546,48 @@ songplay_table_insert = ("""
 INSERT INTO songplays (
     user_id,
     start_time,
+    time_key,
     level,
     song_id,
     artist_id,
     session_id,
     location,
-    user_agent
+    user_agent,
+    load_version
 )
-SELECT DISTINCT 
+SELECT DISTINCT
     s_events.user_id,
     s_events.ts,
+    {},
     s_events.level,
     s_songs.song_id,
     s_songs.artist_id,
     s_events.session_id,
     s_events.location,
-    s_events.user_agent
-FROM staging_songs s_songs
-    JOIN staging_events s_events
-        ON s_songs.title = s_events.song_title
-           AND s_songs.artist_name = s_events.artist_name
-""")
+    s_events.user_agent,
+    {}
+FROM staging_songs_keyed s_songs
+    JOIN staging_events_keyed s_events
+        ON s_songs.match_key = s_events.match_key;
+""").format(time_key('s_events.ts'), load_version_next)
+
+songplay_staging_insert = "DELETE FROM staging_songplays;" + \
+    songplay_table_insert.replace('INSERT INTO songplays',
+                                  'INSERT INTO staging_songplays', 1)
+songplay_table_append_staged = \
+    "ALTER TABLE songplays APPEND FROM staging_songplays FILLTARGET;"
+
+# The insert steps of a run commit one by one, before its log files are
+# recorded in load_state, so a run that fails in between leaves songplays
+# tagged with the load version it never got to record. The rerun loads the
+# same log files again under that same version, and first deletes them.
+songplay_table_unrecorded_select = \
+    "SELECT COUNT(*) FROM songplays WHERE load_version = {};".format(
+        load_version_next)
+songplay_table_unrecorded_delete = \
+    "DELETE FROM songplays WHERE load_version = {};".format(load_version_next)
+songplay_table_reload = songplay_table_unrecorded_delete + \
+    songplay_table_insert
 
 user_table_insert = ("""
 INSERT INTO users(
@@ -237,30 +643,135 @@ FROM staging_songs
 WHERE artist_id IS NOT NULL;
 """)
 
-time_table_insert = ("""
-INSERT INTO times(
-    start_time,
-    hour,
-    day,
-    week,
-    month,
+# FULL REFRESH
+# Without `-c`, a full refresh loads into the existing tables, so each insert
+# empties its table first. The rollup rebuilds empty theirs too, and times
+# only ever gains the rows it is missing.
+
+songplay_table_replace = "DELETE FROM songplays;" + songplay_table_insert
+user_table_replace = "DELETE FROM users;" + user_table_insert
+song_table_replace = "DELETE FROM songs;" + song_table_insert
+artist_table_replace = "DELETE FROM artists;" + artist_table_insert
+
+# INCREMENTAL INSERTS
+# Staging holds only the new log events, so songplays are appended to.
+# Users seen again are replaced so their level stays current, and songs
+# and artists not already present are added from the full song catalog.
+
+user_table_expire = ("""
+DELETE FROM users
+USING staging_events
+WHERE users.user_id = staging_events.user_id;
+""")
+
+song_table_append = ("""
+INSERT INTO songs(
+    song_id,
+    title,
+    artist_id,
     year,
-    weekday
+    duration
 )
 SELECT DISTINCT
-    ts,
-    EXTRACT(HOUR FROM ts),
-    EXTRACT(DAY FROM ts),
-    EXTRACT(WEEK FROM ts),
-    EXTRACT(MONTH FROM ts),
-    EXTRACT(YEAR FROM ts),
-    EXTRACT(DOW FROM ts)
-FROM staging_events;
+    s_songs.song_id,
+    s_songs.title,
+    s_songs.artist_id,
+    s_songs.year,
+    s_songs.duration
+FROM staging_songs s_songs
+    LEFT JOIN songs ON songs.song_id = s_songs.song_id
+WHERE s_songs.song_id IS NOT NULL
+    AND songs.song_id IS NULL;
+""")
+
+artist_table_append = ("""
+INSERT INTO artists(
+    artist_id,
+    name,
+    location,
+    latitude,
+    longitude
+)
+SELECT DISTINCT
+    s_songs.artist_id,
+    s_songs.artist_name,
+    s_songs.artist_location,
+    s_songs.artist_latitude,
+    s_songs.artist_longitude
+FROM staging_songs s_songs
+    LEFT JOIN artists ON artists.artist_id = s_songs.artist_id
+WHERE s_songs.artist_id IS NOT NULL
+    AND artists.artist_id IS NULL;
 """)
 
+# ROLLUP TABLES
+# A full refresh rebuilds each rollup from songplays; incremental runs merge
+# in the plays of the running load only.
+
+rollup_table_creates = [
+    create_table(name, columns, table_specs.get(name))
+    for name, columns in rollup_table_columns.items()]
+rollup_table_drops = ["DROP TABLE IF EXISTS {};".format(name)
+                      for name in rollups]
+rollup_table_rebuilds = {'rollup_' + name: rollup_rebuild(name, spec)
+                         for name, spec in rollups.items()}
+rollup_table_merges = {
+    'rollup_' + name: rollup_merge(name, spec, load_version_next)
+    for name, spec in rollups.items()}
+# times is extended before the insert steps run, so it is not one of them
+rollup_table_dependencies = {
+    'rollup_' + name: [table for table in rollup_dependencies(spec)
+                       if table != 'times']
+    for name, spec in rollups.items()}
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, load_state_table_create, load_version_table_create, staging_events_keyed_table_create, staging_songs_keyed_table_create, staging_songplays_table_create] + rollup_table_creates
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, load_state_table_drop, load_version_table_drop, staging_events_keyed_table_drop, staging_songs_keyed_table_drop, staging_songplays_table_drop] + rollup_table_drops
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+insert_table_queries = [staging_events_keyed_insert, staging_songs_keyed_insert, songplay_table_replace, user_table_replace, song_table_replace, artist_table_replace] + list(rollup_table_rebuilds.values())
+
+# INSERT STEPS
+# Named insert steps and the steps each one needs to have finished first,
+# used to run the inserts concurrently. Every step already requires the
+# staging tables to be loaded.
+
+insert_table_steps = {
+    'events_keyed': staging_events_keyed_insert,
+    'songs_keyed': staging_songs_keyed_insert,
+    'songplays': songplay_table_replace,
+    'users': user_table_replace,
+    'songs': song_table_replace,
+    'artists': artist_table_replace,
+}
+insert_table_steps.update(rollup_table_rebuilds)
+insert_table_dependencies = {
+    'events_keyed': [],
+    'songs_keyed': [],
+    'songplays': ['events_keyed', 'songs_keyed'],
+    'users': [],
+    'songs': [],
+    'artists': [],
+}
+insert_table_dependencies.update(rollup_table_dependencies)
+
+incremental_insert_table_steps = {
+    'events_keyed': staging_events_keyed_insert,
+    'songs_keyed': staging_songs_keyed_insert,
+    'songplays': songplay_table_reload,
+    'users_expire': user_table_expire,
+    'users': user_table_insert,
+    'songs': song_table_append,
+    'artists': artist_table_append,
+}
+incremental_insert_table_steps.update(rollup_table_merges)
+incremental_insert_table_dependencies = {
+    'events_keyed': [],
+    'songs_keyed': [],
+    'songplays': ['events_keyed', 'songs_keyed'],
+    'users_expire': [],
+    'users': ['users_expire'],
+    'songs': [],
+    'artists': [],
+}
+incremental_insert_table_dependencies.update(rollup_table_dependencies)
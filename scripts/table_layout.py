@@ -0,0 +1,107 @@
+"""
+Builds the CREATE TABLE statements from the column definitions in
+`sql_queries.py` and the physical layout of each table in `TABLES` in
+`dwh_config.json`.
+
+Each entry of `TABLES` can set:
+
+    DISTSTYLE   - AUTO, EVEN, KEY or ALL
+    DISTKEY     - the column rows are distributed on, implies DISTSTYLE KEY
+    SORTKEY     - comma-separated sort key columns
+    COLUMNS     - per-column overrides of the declared `TYPE` and `ENCODE`
+                  compression encoding, as written by `column_profiler.py`
+"""
+import re
+
+COLUMN_DEFINITION = re.compile(
+    r'^(\s*)(\w+)(\s+)(\w+(?:\s*\([\d,\s]+\))?)'
+    r'(\s+IDENTITY\s*\([^)]*\))?(?:\s+ENCODE\s+\w+)?(.*)$', re.IGNORECASE)
+
+
+def split_columns(value):
+    """ Splits a comma-separated list of column names """
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def column_types(columns):
+    """ Parses column definitions into a dict of column name to type
+
+    Args:
+        columns: String, the column definitions, one per line
+
+    Returns:
+        dict of column name to its upper-cased type, e.g. `VARCHAR(30)`,
+        in column order
+    """
+    types = {}
+    for line in columns.strip().splitlines():
+        match = COLUMN_DEFINITION.match(line)
+        if match:
+            types[match.group(2)] = re.sub(r'\s+', '', match.group(4)).upper()
+    return types
+
+
+def apply_column_overrides(columns, overrides):
+    """ Rewrites the type and encoding of overridden columns
+
+    Args:
+        columns: String, the column definitions, one per line
+        overrides: dict of column name to a dict with an optional `TYPE` and
+            `ENCODE`
+
+    Returns:
+        String, the rewritten column definitions
+    """
+    lines = []
+    for line in columns.split('\n'):
+        match = COLUMN_DEFINITION.match(line)
+        override = overrides.get(match.group(2)) if match else None
+        if override:
+            indent, name, space, data_type, identity, rest = match.groups()
+            line = '{}{}{}{}{}{}{}'.format(
+                indent, name, space, override.get('TYPE', data_type),
+                identity or '',
+                ' ENCODE {}'.format(override['ENCODE'])
+                if override.get('ENCODE') else '', rest)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def layout_clause(spec):
+    """ Builds the table attributes of a CREATE TABLE statement
+
+    Args:
+        spec: dict of a table's `TABLES` entry, or None
+
+    Returns:
+        String, e.g. `DISTSTYLE KEY DISTKEY(song_id) SORTKEY(start_time)`
+    """
+    spec = spec or {}
+    attributes = []
+    if spec.get('DISTKEY'):
+        attributes.append('DISTSTYLE KEY')
+        attributes.append('DISTKEY({})'.format(spec['DISTKEY']))
+    elif spec.get('DISTSTYLE'):
+        attributes.append('DISTSTYLE {}'.format(spec['DISTSTYLE'].upper()))
+    if spec.get('SORTKEY'):
+        attributes.append('SORTKEY({})'.format(
+            ', '.join(split_columns(spec['SORTKEY']))))
+    return ' '.join(attributes)
+
+
+def create_table(table, columns, spec=None):
+    """ Builds the CREATE TABLE statement of a table
+
+    Args:
+        table: String, the table name
+        columns: String, the column definitions, one per line
+        spec: dict of the table's `TABLES` entry, or None
+
+    Returns:
+        String SQL statement
+    """
+    clause = layout_clause(spec)
+    if spec and spec.get('COLUMNS'):
+        columns = apply_column_overrides(columns, spec['COLUMNS'])
+    return "\nCREATE TABLE IF NOT EXISTS {} ({}\n){};\n".format(
+        table, columns.rstrip(), '\n' + clause if clause else '')
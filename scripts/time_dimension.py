@@ -0,0 +1,182 @@
+"""
+Generates the rows of the `times` dimension on the client.
+
+`times` holds one row per hour, or per day with `TIME_DIMENSION.GRAIN` set
+to `day`, keyed on `time_key`: the number of whole hours (or days) since
+1970-01-01. songplays carries the same key, computed from its start time,
+and joins to the dimension on that integer rather than on a timestamp.
+
+The rows are built with numpy datetime arithmetic rather than by a SELECT
+DISTINCT over every staged event, so the replicated table no longer grows
+with the events: a year of hours is 8,760 rows. The first load fills in
+`TIME_DIMENSION.START_DATE` up to `END_DATE`. After that, each run only adds
+the rows its log events fall outside of, running `LOOKAHEAD_DAYS` past its
+last event so the next few runs find their rows already there.
+
+Typical Usage example:
+    $ python3 -m scripts.time_dimension
+"""
+import json
+import time
+import numpy as np
+from scripts.db import connect
+from scripts.sql_queries import time_table_range_select, \
+    staging_events_range_select, time_table_values_insert
+
+CFG_FILE = 'dwh_config.json'
+
+# numpy datetime unit of each grain
+GRAIN_UNITS = {'hour': 'h', 'day': 'D'}
+TIME_COLUMNS = ['time_key', 'start_time', 'hour', 'day', 'week', 'month',
+                'year', 'weekday']
+INSERT_BATCH_SIZE = 1000
+
+
+def grain_unit(grain):
+    """ Returns the numpy datetime unit of a `TIME_DIMENSION.GRAIN` """
+    if grain not in GRAIN_UNITS:
+        raise ValueError("The time dimension's grain is one of {}; not "
+                         "{}".format(', '.join(GRAIN_UNITS), grain))
+    return GRAIN_UNITS[grain]
+
+
+def time_rows(keys, unit):
+    """ Builds the rows of the time dimension
+
+    Args:
+        keys: numpy array of Int time keys, whole `unit`s since the epoch
+        unit: String numpy datetime unit of the grain, `h` or `D`
+
+    Returns:
+        dict of column name to a numpy array of its values. `week` is the
+        ISO week and `weekday` counts from 0 on Sunday, like Redshift's
+        EXTRACT(WEEK) and EXTRACT(DOW).
+    """
+    starts = keys.astype('datetime64[{}]'.format(unit))
+    days = starts.astype('datetime64[D]')
+    months = starts.astype('datetime64[M]')
+    day_numbers = days.astype(np.int64)
+    # ISO weeks belong to the year their Thursday falls in, and 1970-01-01
+    # was a Thursday
+    thursdays = days + (3 - (day_numbers + 3) % 7)
+    return {
+        'time_key': keys,
+        'start_time': np.char.replace(
+            np.datetime_as_string(starts, unit='s'), 'T', ' '),
+        'hour': (starts.astype('datetime64[h]') - days).astype(np.int64),
+        'day': (days - months).astype(np.int64) + 1,
+        'week': (thursdays - thursdays.astype('datetime64[Y]')).astype(
+            np.int64) // 7 + 1,
+        'month': months.astype(np.int64) % 12 + 1,
+        'year': starts.astype('datetime64[Y]').astype(np.int64) + 1970,
+        'weekday': (day_numbers + 4) % 7,
+    }
+
+
+def target_range(settings, events):
+    """ Works out which keys the time dimension should cover
+
+    Args:
+        settings: dict of the `TIME_DIMENSION` config
+        events: (first, last) datetimes of the staged plays, or Nones
+
+    Returns:
+        (start, end) Int time keys, end exclusive
+    """
+    unit = grain_unit(settings['GRAIN'])
+    start = np.datetime64(settings['START_DATE'], unit)
+    end = np.datetime64(settings['END_DATE'], unit)
+    first, last = events
+    if first is not None:
+        start = min(start, np.datetime64(first, unit))
+        last = np.datetime64(last, unit)
+        if last >= end:
+            end = last + 1 + np.timedelta64(
+                int(settings['LOOKAHEAD_DAYS']), 'D')
+    return int(start.astype(np.int64)), int(end.astype(np.int64))
+
+
+def missing_keys(target, covered):
+    """ Lists the keys of a range the time dimension does not have yet
+
+    Args:
+        target: (start, end) Int time keys, end exclusive
+        covered: (first, last) Int time keys already loaded, or Nones for
+            an empty dimension. Rows are only ever added at either end, so
+            the keys in between are all there.
+
+    Returns:
+        numpy array of Int time keys
+    """
+    keys = np.arange(target[0], target[1], dtype=np.int64)
+    first, last = covered
+    if first is not None:
+        keys = keys[(keys < first) | (keys > last)]
+    return keys
+
+
+def values_inserts(rows, batch_size=INSERT_BATCH_SIZE):
+    """ Builds multi-row INSERTs of the time dimension's rows
+
+    Args:
+        rows: dict of column name to its values, as from `time_rows`
+        batch_size: Int, max number of rows per INSERT
+
+    Returns:
+        list of String SQL statements
+    """
+    values = ["({}, '{}', {}, {}, {}, {}, {}, {})".format(*row)
+              for row in zip(*[rows[name].tolist()
+                               for name in TIME_COLUMNS])]
+    return [time_table_values_insert.format(
+        ',\n'.join(values[i:i + batch_size]))
+        for i in range(0, len(values), batch_size)]
+
+
+def extend_time_dimension(cur, config, report=None):
+    """ Adds the rows the time dimension is missing for the configured range
+    and the staged log events
+
+    Does not commit.
+
+    Args:
+        cur: Psycopg2 DB cursor object
+        config: a dict of the loaded json config
+        report: a metrics.RunReport to record the load in
+
+    Returns:
+        Int, the number of rows added
+    """
+    settings = config['TIME_DIMENSION']
+    start = time.time()
+    cur.execute(staging_events_range_select)
+    events = cur.fetchone()
+    cur.execute(time_table_range_select)
+    covered = cur.fetchone()
+
+    keys = missing_keys(target_range(settings, events), covered)
+    if len(keys):
+        rows = time_rows(keys, grain_unit(settings['GRAIN']))
+        for query in values_inserts(rows):
+            cur.execute(query)
+    if report is not None:
+        report.record_event('insert', 'times', time.time() - start,
+                            rows=len(keys))
+    print("Added {} rows to times".format(len(keys)))
+    return len(keys)
+
+
+def main():
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    conn = connect(config, 'insert')
+    try:
+        extend_time_dimension(conn.cursor(), config)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,26 +8,93 @@ DB, a star-schema DB optimised for queries on songs played by Sparkify users.
 Typical Usage example:
     $ export AWS_ACCESS_KEY_ID=<your_aws_access_key_id>
     $ export AWS_SECRET_ACCESS_KEY=<your_aws_secret_access_key>
-    $ python3 sparkify_redshift.py
+    $ python3 sparkify_redshift.py [-c] [--full-refresh]
+    $ python3 sparkify_redshift.py --resume <run-id>
+
+Set `ETL.BACKEND` to `local` in `dwh_config.json` to run the whole pipeline on
+a local DuckDB database instead, reading the inputs from `LOCAL.DATA_DIR`.
+
+Without `--full-refresh` only the log files that have not been loaded yet are
+copied, and their rows are appended to the existing tables.
+
+Every statement is timed, and a JSON report of the run is written to
+`METRICS.REPORT_DIR`.
+
+Every finished step is checkpointed under the run's ID. If a run fails,
+`--resume <run-id>` reruns it with the same options, skipping the steps it
+already finished, see `checkpoints.py`.
+
+With `BLUE_GREEN.ENABLED`, a full refresh is built in a shadow schema and
+swapped in once it is loaded and validated, see `blue_green.py`.
+
+With `LIFECYCLE.MODE` set to `pause`, `-c` resumes the paused cluster rather
+than creating a new one, and the cluster is paused again after the run,
+whether it succeeded or not. With `snapshot`, `-c` restores the cluster from
+the snapshot taken by the last `cleanup_redshift.py`.
 """
 import sys
+import json
 import getopt
 from scripts.setup_redshift import setup_redshift_cluster
+from scripts.cleanup_redshift import pause_redshift_cluster
+from scripts.helpers import get_aws_clients
 from scripts.create_tables import create_db_tables
-from scripts.etl import etl
+from scripts.etl import etl, CFG_FILE
+from scripts.db import is_local, warehouse_schema, close_pools
+from scripts.blue_green import rebuild
+from scripts.metrics import RunReport, publish
+from scripts.checkpoints import Checkpoints, save_document, load_document
 
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "c")
+        opts, args = getopt.getopt(argv, "c", ["full-refresh", "resume="])
     except getopt.GetoptError:
-        print("USAGE: sparkify_redshift.py -c")
+        print("USAGE: sparkify_redshift.py [-c] [--full-refresh] "
+              "[--resume <run-id>]")
         sys.exit(2)
-    for opt, arg in opts:
-        if opt == '-c':
-            setup_redshift_cluster()
-            create_db_tables()
-    etl()
+    opts = dict(opts)
+    with open(CFG_FILE) as f:
+        config = json.load(f)
+
+    if '--resume' in opts:
+        report = RunReport(opts['--resume'],
+                           redshift_stats=not is_local(config))
+        options = load_document(config, report.run_id, 'options')
+    else:
+        report = RunReport(redshift_stats=not is_local(config))
+        options = {'create': '-c' in opts,
+                   'full_refresh': '--full-refresh' in opts}
+        save_document(config, report.run_id, 'options', options)
+
+    try:
+        if options['create'] and not is_local(config):
+            if setup_redshift_cluster() != 'available':
+                sys.exit(1)
+            with open(CFG_FILE) as f:
+                config = json.load(f)
+        checkpoints = Checkpoints(config, report.run_id,
+                                  resume='--resume' in opts)
+        if options['full_refresh'] and warehouse_schema(config):
+            rebuild(config, report, checkpoints)
+        else:
+            if options['create']:
+                create_db_tables(options['full_refresh'], config, report,
+                                 checkpoints)
+            etl(options['full_refresh'], config, report, checkpoints)
+    except Exception:
+        print("Run {0} failed, resume it with:\n"
+              "    python3 sparkify_redshift.py --resume {0}".format(
+                  report.run_id))
+        raise
+    finally:
+        publish(report, config)
+        close_pools()
+        # Paused whether or not the run succeeded, so a failed run does not
+        # leave the cluster running until someone notices
+        if not is_local(config) and config['LIFECYCLE']['MODE'] == 'pause':
+            iam, redshift = get_aws_clients(config)
+            pause_redshift_cluster(config, redshift)
 
 
 if __name__ == "__main__":
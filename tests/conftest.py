@@ -2,7 +2,7 @@ import pytest
 import os
 import json
 import boto3
-from moto import mock_redshift, mock_iam
+from moto import mock_redshift, mock_iam, mock_s3
 
 CFG_FILE = 'dwh_config.json'
 
@@ -36,6 +36,12 @@ def redshift(aws_credentials):
         yield boto3.client('redshift', region_name='eu-central-1')
 
 
+@pytest.fixture(scope='function')
+def s3(aws_credentials):
+    with mock_s3():
+        yield boto3.client('s3', region_name='us-east-1')
+
+
 @pytest.fixture(scope='function')
 def cluster(redshift, config):
     redshift.create_cluster(
@@ -43,4 +49,23 @@ def cluster(redshift, config):
         NodeType=config['CLUSTER']['NODE_TYPE'],
         MasterUsername=config['CLUSTER']['DB_USER'],
         MasterUserPassword=config['CLUSTER']['DB_PASSWORD']
-    )
\ No newline at end of file
+    )
+
+
+@pytest.fixture(scope='function')
+def project_dir(monkeypatch):
+    """Runs the test from the project root, where the modules expect to find
+    the config file."""
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), '..'))
+
+
+@pytest.fixture(scope='function')
+def region_config(config, redshift, tmp_path, monkeypatch):
+    """Runs the test from a temporary directory holding a config that points
+    at the mocked Redshift region, with polling sleeps skipped."""
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    monkeypatch.chdir(tmp_path)
+    config = dict(config, AWS={'REGION': redshift.meta.region_name})
+    with open(CFG_FILE, 'w') as f:
+        json.dump(config, f)
+    return config
@@ -0,0 +1,85 @@
+"""Defines tests for the cached analytics client."""
+import os
+import copy
+import pytest
+
+
+@pytest.fixture(scope='function')
+def warehouse(config, project_dir, tmp_path):
+    from create_tables import create_db_tables
+
+    cfg = copy.deepcopy(config)
+    cfg['ETL']['BACKEND'] = 'local'
+    cfg['LOCAL']['DATA_DIR'] = str(tmp_path / 'data')
+    cfg['LOCAL']['DB_PATH'] = str(tmp_path / 'sparkify.duckdb')
+    cfg['ANALYTICS']['CACHE_DIR'] = str(tmp_path / 'cache')
+    create_db_tables(True, cfg)
+    return cfg
+
+
+def bump_version(cfg):
+    from db import connect
+    from sql_queries import load_version_bump
+
+    conn = connect(cfg)
+    conn.cursor().execute(load_version_bump)
+    conn.commit()
+    conn.close()
+
+
+def test_normalizes_sql_outside_quotes(project_dir):
+    from analytics import normalize_sql
+
+    assert normalize_sql("SELECT *\n  FROM artists -- all\n"
+                         "WHERE name = 'Katy  Perry';") == \
+        "select * from artists where name = 'Katy  Perry'"
+
+
+def test_caches_results_until_the_next_load(warehouse):
+    from analytics import AnalyticsClient
+
+    client = AnalyticsClient(warehouse)
+    assert client.query("SELECT COUNT(*) AS n FROM users") == [(0,)]
+    assert client.query("select count(*) as n\nfrom users;") == [(0,)]
+    assert (client.hits, client.misses) == (1, 1)
+
+    client.close()
+    bump_version(warehouse)
+    client.query("SELECT COUNT(*) AS n FROM users")
+    assert (client.hits, client.misses) == (1, 2)
+    client.close()
+
+
+def test_cache_misses_after_tables_are_recreated(warehouse):
+    from analytics import AnalyticsClient
+    from create_tables import create_db_tables
+
+    bump_version(warehouse)
+    client = AnalyticsClient(warehouse)
+    client.query("SELECT COUNT(*) AS n FROM users")
+    client.close()
+
+    # A full refresh with -c starts the load versions over at 1
+    create_db_tables(True, warehouse)
+    bump_version(warehouse)
+    client.query("SELECT COUNT(*) AS n FROM users")
+    assert (client.hits, client.misses) == (0, 2)
+    client.close()
+
+
+def test_evicts_least_recently_used_results(warehouse):
+    from analytics import AnalyticsClient, CACHE_SUFFIX
+
+    client = AnalyticsClient(warehouse)
+    client.query("SELECT 1 AS a")
+    size = os.path.getsize(os.path.join(
+        client.cache_dir, os.listdir(client.cache_dir)[0]))
+    client.max_bytes = size * 2
+    client.query("SELECT 2 AS a")
+    os.utime(os.path.join(client.cache_dir, os.listdir(client.cache_dir)[0]),
+             (0, 0))
+    client.query("SELECT 3 AS a")
+    client.close()
+
+    assert len([name for name in os.listdir(client.cache_dir)
+                if name.endswith(CACHE_SUFFIX)]) == 2
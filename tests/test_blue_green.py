@@ -0,0 +1,70 @@
+"""Defines tests for rebuilding the warehouse in a shadow schema."""
+import os
+import pytest
+from test_local_backend import local_config, write_json, event
+
+
+def fetch(cfg, query):
+    from db import connect
+
+    conn = connect(cfg)
+    cur = conn.cursor()
+    cur.execute(query)
+    result = cur.fetchall()
+    conn.close()
+    return result
+
+
+def add_log_file(cfg, name, events):
+    write_json(os.path.join(cfg['LOCAL']['DATA_DIR'], 'log_data/2018/11',
+                            name), events)
+
+
+def test_swaps_validated_rebuild_and_rolls_back(local_config, project_dir):
+    from blue_green import rebuild, swap_schemas
+
+    local_config['BLUE_GREEN']['ENABLED'] = 'true'
+    rebuild(local_config)
+    assert fetch(local_config, "SELECT COUNT(*) FROM songplays") == [(2,)]
+
+    add_log_file(local_config, '2018-11-02-events.json',
+                 [event(3, 1541206106796)])
+    rebuild(local_config)
+    assert fetch(local_config, "SELECT COUNT(*) FROM songplays") == [(3,)]
+    assert fetch(local_config, "SELECT COUNT(*) FROM load_state") == [(2,)]
+    assert fetch(local_config, "SELECT COUNT(*) FROM "
+                               "dwh_previous.songplays") == [(2,)]
+
+    swap_schemas(local_config, rollback=True)
+    assert fetch(local_config, "SELECT COUNT(*) FROM songplays") == [(2,)]
+    swap_schemas(local_config, rollback=True)
+    assert fetch(local_config, "SELECT COUNT(*) FROM songplays") == [(3,)]
+
+    # A shadow that fails validation is never swapped in
+    local_config['BLUE_GREEN']['MIN_ROW_RATIO'] = '2'
+    with pytest.raises(RuntimeError):
+        rebuild(local_config)
+    assert fetch(local_config, "SELECT COUNT(*) FROM songplays") == [(3,)]
+    assert fetch(local_config, "SELECT COUNT(*) FROM "
+                               "dwh_shadow.songplays") == [(3,)]
+
+
+def test_appends_new_songplays_from_staging(local_config, project_dir):
+    from blue_green import rebuild
+    from etl import etl
+
+    local_config['BLUE_GREEN']['ENABLED'] = 'true'
+    rebuild(local_config)
+    add_log_file(local_config, '2018-11-02-events.json',
+                 [event(3, 1541206106796), event(4, 1541206206796)])
+    report = etl(False, local_config)
+
+    assert {'songplays_staged', 'songplays'} <= {
+        entry['name'] for entry in report.statements
+        if entry['phase'] == 'insert'}
+    assert fetch(local_config, "SELECT COUNT(*), COUNT(DISTINCT songplay_id) "
+                               "FROM songplays") == [(4, 4)]
+    assert fetch(local_config, "SELECT COUNT(*) FROM staging_songplays") == \
+        [(0,)]
+    assert fetch(local_config, "SELECT load_version, COUNT(*) FROM songplays "
+                               "GROUP BY 1 ORDER BY 1") == [(1, 2), (2, 2)]
@@ -0,0 +1,54 @@
+"""Defines tests for resuming a failed ETL run from its checkpoints."""
+import os
+import json
+import pytest
+from test_local_backend import local_config, write_json, event, count
+
+
+@pytest.mark.parametrize('parallel', ['true', 'false'])
+def test_resumes_failed_run_from_staged_data(local_config, project_dir,
+                                             tmp_path, monkeypatch, parallel):
+    import etl as etl_module
+    from create_tables import create_db_tables
+    from checkpoints import Checkpoints
+    from metrics import RunReport, execute
+
+    local_config['ETL']['PARALLEL_INSERTS'] = parallel
+    local_config['CHECKPOINTS']['STATE_DIR'] = str(tmp_path / 'run_state')
+
+    def fail_users(cur, query, phase, report=None, name=None, params=None):
+        if 'INSERT INTO users' in query:
+            raise RuntimeError("users insert failed")
+        return execute(cur, query, phase, report, name, params)
+
+    monkeypatch.setattr(etl_module, 'execute', fail_users)
+    checkpoints = Checkpoints(local_config, 'run1')
+    create_db_tables(True, local_config, None, checkpoints)
+    with pytest.raises(RuntimeError):
+        etl_module.etl(True, local_config, RunReport('run1'), checkpoints)
+
+    assert count(local_config, 'staging_events') == 3
+    assert count(local_config, 'load_state') == 0
+    with open(tmp_path / 'run_state' / 'run-run1.json') as f:
+        finished = json.load(f)['finished']
+    assert 'staging/COPY staging_events' in finished
+    assert 'insert/users' not in finished
+
+    # Files arriving after the failure are left for the next run
+    write_json(os.path.join(local_config['LOCAL']['DATA_DIR'],
+                            'log_data/2018/11/2018-11-02-events.json'),
+               [event(3, 1541206106796)])
+    monkeypatch.setattr(etl_module, 'execute', execute)
+    report = RunReport('run1')
+    checkpoints = Checkpoints(local_config, 'run1', resume=True)
+    create_db_tables(True, local_config, report, checkpoints)
+    etl_module.etl(True, local_config, report, checkpoints)
+
+    assert [entry['name'] for entry in report.statements
+            if entry['phase'] in ('create_tables', 'staging')] == []
+    assert count(local_config, 'songplays') == 2
+    assert count(local_config, 'users') == 2
+    assert count(local_config, 'songs') == 3
+    assert count(local_config, 'load_state') == 1
+    assert checkpoints.done('load_state/record')
+
@@ -4,6 +4,8 @@ VERY IMPORTANT: Use local Python imports in each test to ensure moto mocks
 established before clients are set up (avoiding potential actual AWS
 infrastructure modifications).
 """
+import json
+import pytest
 
 
 def test_deletes_redshift_cluster(config, redshift):
@@ -29,4 +31,98 @@ def test_deletes_iam_role(config, iam):
     )
 
     response = delete_iam_role(config, iam)
-    assert response['ResponseMetadata']['HTTPStatusCode'] == 200
\ No newline at end of file
+    assert response['ResponseMetadata']['HTTPStatusCode'] == 200
+
+
+def test_cleanup_waits_until_gone_and_can_rerun(region_config, iam,
+                                                redshift):
+    from setup_redshift import create_iam_role, attach_iam_role_policy, \
+        start_redshift_cluster
+    from cleanup_redshift import cleanup_redshift_cluster
+
+    config = region_config
+    role_arn = create_iam_role(config, iam)['Role']['Arn']
+    attach_iam_role_policy(config, iam)
+    redshift.create_cluster_parameter_group(
+        ParameterGroupName=config['WLM']['PARAMETER_GROUP'],
+        ParameterGroupFamily='redshift-1.0', Description='test')
+    start_redshift_cluster(config, redshift, role_arn)
+
+    assert cleanup_redshift_cluster() is True
+
+    with pytest.raises(redshift.exceptions.ClusterNotFoundFault):
+        redshift.describe_clusters(
+            ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])
+    with pytest.raises(iam.exceptions.NoSuchEntityException):
+        iam.get_role(RoleName=config['IAM_ROLE']['NAME'])
+    assert iam.list_policies(Scope='Local')['Policies'] == []
+    with pytest.raises(
+            redshift.exceptions.ClusterParameterGroupNotFoundFault):
+        redshift.describe_cluster_parameter_groups(
+            ParameterGroupName=config['WLM']['PARAMETER_GROUP'])
+
+    assert cleanup_redshift_cluster() is True
+
+
+def test_pause_mode_resumes_paused_cluster(region_config, iam, redshift):
+    from setup_redshift import setup_redshift_cluster, cluster_status
+    from cleanup_redshift import cleanup_redshift_cluster
+
+    config = region_config
+    assert setup_redshift_cluster('pause') == 'available'
+
+    assert cleanup_redshift_cluster('pause') is True
+    assert cluster_status(config, redshift) == 'paused'
+    assert iam.get_role(RoleName=config['IAM_ROLE']['NAME'])
+
+    assert setup_redshift_cluster('pause') == 'available'
+    assert len(redshift.describe_clusters()['Clusters']) == 1
+
+
+def test_snapshot_mode_restores_from_final_snapshot(region_config, iam,
+                                                    redshift, capsys):
+    from setup_redshift import setup_redshift_cluster, cluster_status, \
+        latest_snapshot
+    from cleanup_redshift import cleanup_redshift_cluster
+
+    config = region_config
+    assert setup_redshift_cluster('snapshot') == 'available'
+    assert 'Creating Redshift Cluster' in capsys.readouterr().out
+
+    assert cleanup_redshift_cluster('snapshot') is True
+    assert cluster_status(config, redshift) is None
+    snapshot_id = latest_snapshot(config, redshift)
+    assert snapshot_id.startswith(config['LIFECYCLE']['SNAPSHOT_PREFIX'])
+
+    with open('dwh_config.json') as f:
+        saved = json.load(f)
+    saved['CLUSTER']['HOST'] = 'stale.example.com'
+    with open('dwh_config.json', 'w') as f:
+        json.dump(saved, f)
+
+    assert setup_redshift_cluster('snapshot') == 'available'
+    assert 'from snapshot {}'.format(snapshot_id) in capsys.readouterr().out
+    with open('dwh_config.json') as f:
+        assert json.load(f)['CLUSTER']['HOST'] == redshift.describe_clusters(
+            ClusterIdentifier=config['CLUSTER']['IDENTIFIER']
+        )['Clusters'][0]['Endpoint']['Address']
+
+
+def test_prunes_old_snapshots(config, redshift, cluster):
+    from cleanup_redshift import prune_snapshots
+    from setup_redshift import list_snapshots
+
+    for i in range(5):
+        redshift.create_cluster_snapshot(
+            SnapshotIdentifier='{}-{}'.format(
+                config['LIFECYCLE']['SNAPSHOT_PREFIX'], i),
+            ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])
+    redshift.create_cluster_snapshot(
+        SnapshotIdentifier='other-snapshot',
+        ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])
+
+    assert len(prune_snapshots(config, redshift)) == 2
+    assert len(list_snapshots(config, redshift)) == 3
+    assert len([snapshot for snapshot
+                in redshift.describe_cluster_snapshots()['Snapshots']
+                if snapshot['SnapshotType'] == 'manual']) == 4
@@ -0,0 +1,79 @@
+"""Defines tests for the column width and encoding profiler."""
+
+
+def test_sizes_varchars_with_headroom():
+    from column_profiler import varchar_width
+
+    assert varchar_width(1) == 16
+    assert varchar_width(13) == 32
+    assert varchar_width(200) == 256
+    assert varchar_width(100000) == 65535
+
+
+def test_chooses_encodings():
+    from column_profiler import choose_encoding
+
+    assert choose_encoding('INTEGER', {'distinct': 5}) == 'AZ64'
+    assert choose_encoding('TIMESTAMP', {'distinct': 5}, True) == 'RAW'
+    assert choose_encoding('VARCHAR(15)', {'distinct': 2}) == 'BYTEDICT'
+    assert choose_encoding('TEXT', {'distinct': 5000}) == 'ZSTD'
+    assert choose_encoding('FLOAT8', {'distinct': 2}) == 'ZSTD'
+
+
+def test_star_schema_columns_are_as_wide_as_their_source():
+    from column_profiler import recommend_columns
+
+    profiles = {
+        'staging_songs': {'rows': 10, 'columns': {
+            'artist_name': {'type': 'TEXT', 'max_bytes': 300,
+                            'distinct': 10}}},
+        'artists': {'rows': 2, 'columns': {
+            'name': {'type': 'TEXT', 'max_bytes': 10, 'distinct': 2},
+            'latitude': {'type': 'FLOAT8', 'max_bytes': None,
+                         'distinct': 2}}},
+    }
+    specs = recommend_columns(profiles, {'artists': {'SORTKEY': 'name'}})
+
+    assert specs['staging_songs']['COLUMNS']['artist_name']['TYPE'] == \
+        'VARCHAR(512)'
+    assert specs['artists']['COLUMNS']['name'] == {'TYPE': 'VARCHAR(512)',
+                                                   'ENCODE': 'RAW'}
+    assert specs['artists']['COLUMNS']['latitude'] == {'ENCODE': 'ZSTD'}
+
+
+def test_profiles_local_table(tmp_path):
+    from local_backend import LocalConnection
+    from column_profiler import profile_table
+
+    conn = LocalConnection(str(tmp_path / 'db.duckdb'), str(tmp_path))
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE t (name TEXT ENCODE ZSTD, n INTEGER);")
+    cur.execute("INSERT INTO t VALUES ('abc', 1), ('abcdef', 2), "
+                "('abc', 2);")
+    profile = profile_table(cur, 't', {'name': 'TEXT', 'n': 'INTEGER'})
+    conn.close()
+
+    assert profile['rows'] == 3
+    assert profile['columns']['name']['max_bytes'] == 6
+    assert profile['columns']['name']['distinct'] == 2
+    assert profile['columns']['n']['max_bytes'] is None
+
+
+def test_staging_columns_are_not_narrowed_below_their_ddl():
+    from column_profiler import recommend_columns
+
+    profiles = {'staging_events': {'rows': 10, 'columns': {
+        'location': {'type': 'TEXT', 'max_bytes': 20, 'distinct': 10},
+        'auth': {'type': 'VARCHAR(30)', 'max_bytes': 9, 'distinct': 2},
+        'level': {'type': 'VARCHAR(15)', 'max_bytes': 40, 'distinct': 2}}},
+        'users': {'rows': 2, 'columns': {
+            'level': {'type': 'VARCHAR(15)', 'max_bytes': 4,
+                      'distinct': 2}}}}
+    specs = recommend_columns(profiles, {})
+    columns = specs['staging_events']['COLUMNS']
+
+    assert columns['location']['TYPE'] == 'VARCHAR(256)'
+    assert columns['auth']['TYPE'] == 'VARCHAR(30)'
+    # Wider values than declared still widen the column
+    assert columns['level']['TYPE'] == 'VARCHAR(64)'
+    assert specs['users']['COLUMNS']['level']['TYPE'] == 'VARCHAR(64)'
@@ -0,0 +1,97 @@
+"""Defines tests for compacting small input files ahead of COPY.
+
+VERY IMPORTANT: Use local Python imports in each test to ensure moto mocks
+established before clients are set up (avoiding potential actual AWS
+infrastructure modifications).
+"""
+import copy
+import gzip
+import json
+import pytest
+
+
+@pytest.fixture(scope='function')
+def compaction_config(config, s3):
+    cfg = copy.deepcopy(config)
+    cfg['S3']['SONG_DATA'] = 's3://inputs/song_data'
+    cfg['S3']['LOG_DATA'] = 's3://inputs/log_data'
+    cfg['COMPACTION']['STAGING_PREFIX'] = 's3://staging/compacted'
+    cfg['COMPACTION']['WORKERS'] = '2'
+    s3.create_bucket(Bucket='inputs')
+    s3.create_bucket(Bucket='staging')
+    return cfg
+
+
+def put_inputs(s3):
+    for i in range(12):
+        song = {'song_id': 'SO{:04d}'.format(i), 'title': 'Song {}'.format(i)}
+        s3.put_object(Bucket='inputs',
+                      Key='song_data/{}/A/TR{:04d}.json'.format('AB'[i % 2], i),
+                      Body=json.dumps(song).encode('utf-8'))
+    for day in range(1, 4):
+        events = [json.dumps({'ts': day * 1000 + n}) for n in range(5)]
+        s3.put_object(Bucket='inputs',
+                      Key='log_data/2018/11/2018-11-0{}-events.json'.format(day),
+                      Body='\n'.join(events).encode('utf-8'))
+
+
+def read_compacted(s3, dataset):
+    lines = []
+    listing = s3.list_objects_v2(Bucket='staging',
+                                 Prefix='compacted/' + dataset)
+    for obj in listing.get('Contents', []):
+        body = s3.get_object(Bucket='staging', Key=obj['Key'])['Body'].read()
+        lines.extend(gzip.decompress(body).decode('utf-8').splitlines())
+    return lines, len(listing.get('Contents', []))
+
+
+def test_compacts_every_record_into_gzip_objects(s3, compaction_config):
+    from compact import compact_inputs
+
+    put_inputs(s3)
+    summary = compact_inputs(s3, compaction_config)
+
+    assert summary == {'compacted': 3, 'skipped': 0, 'removed': 0}
+    songs, song_objects = read_compacted(s3, 'song_data')
+    events, event_objects = read_compacted(s3, 'log_data')
+    assert sorted(json.loads(line)['song_id'] for line in songs) == \
+        ['SO{:04d}'.format(i) for i in range(12)]
+    assert len(events) == 15
+    assert event_objects == 1
+
+
+def test_skips_unchanged_partitions(s3, compaction_config):
+    from compact import compact_inputs
+
+    put_inputs(s3)
+    compact_inputs(s3, compaction_config)
+    first, _ = read_compacted(s3, 'log_data')
+
+    s3.put_object(Bucket='inputs', Key='song_data/A/A/TR0000.json',
+                  Body=b'{"song_id": "SO0000", "title": "Renamed"}')
+    summary = compact_inputs(s3, compaction_config)
+
+    assert summary == {'compacted': 1, 'skipped': 2, 'removed': 0}
+    songs, _ = read_compacted(s3, 'song_data')
+    assert len(songs) == 12
+    assert '{"song_id": "SO0000", "title": "Renamed"}' in songs
+    assert read_compacted(s3, 'log_data')[0] == first
+
+
+def test_starts_new_object_at_target_size(s3):
+    import os
+    from compact import CompactedObjectWriter
+
+    s3.create_bucket(Bucket='staging')
+    writer = CompactedObjectWriter(s3, 'staging', 'out/part', 64 * 1024)
+    lines = [os.urandom(512).hex().encode('ascii') for _ in range(300)]
+    for line in lines:
+        writer.write(line)
+    writer.close()
+
+    assert len(writer.keys) > 1
+    written = []
+    for key in writer.keys:
+        body = s3.get_object(Bucket='staging', Key=key)['Body'].read()
+        written.extend(gzip.decompress(body).splitlines())
+    assert written == lines
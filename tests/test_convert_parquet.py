@@ -0,0 +1,99 @@
+"""Defines tests for converting the JSON inputs to Parquet."""
+import json
+from datetime import datetime
+
+EVENT = {"artist": "Des'ree", "auth": "Logged In", "firstName": "Kaylee",
+         "gender": "F", "itemInSession": 1, "lastName": "Summers",
+         "length": 246.30812, "level": "free",
+         "location": "Phoenix-Mesa-Scottsdale, AZ", "method": "PUT",
+         "page": "NextSong", "registration": 1540344794796.0,
+         "sessionId": 139, "song": "You Gotta Be", "status": 200,
+         "ts": 1541106106796, "userAgent": "Mozilla/5.0", "userId": "8"}
+SONG = {"num_songs": 1, "artist_id": "ARJIE2Y1187B994AB7",
+        "artist_latitude": None, "artist_longitude": None,
+        "artist_location": "", "artist_name": "Line Renaud",
+        "song_id": "SOUPIRU12A6D4FA1E1", "title": "Der Kleine Dompfaff",
+        "duration": 152.92036, "year": 0}
+
+
+def test_converts_events_to_staging_schema(tmp_path):
+    import pyarrow.parquet as pq
+    from convert_parquet import convert_lines, STAGING_EVENTS_SCHEMA
+
+    logout = dict(EVENT, artist=None, song=None, page="Logout", userId="")
+    lines = [json.dumps(EVENT).encode('utf-8'),
+             json.dumps(logout).encode('utf-8')]
+    paths = convert_lines(lines, 'log_data', str(tmp_path), batch_rows=1)
+
+    table = pq.read_table(paths[0])
+    assert table.schema.equals(STAGING_EVENTS_SCHEMA)
+    rows = table.to_pylist()
+    assert rows[0]['ts'] == datetime(2018, 11, 1, 21, 1, 46, 796000)
+    assert rows[0]['user_id'] == 8
+    assert rows[0]['song_title'] == "You Gotta Be"
+    assert rows[1]['user_id'] is None
+
+
+def test_splits_output_into_files_and_blanks_to_null(tmp_path):
+    import pyarrow.parquet as pq
+    from convert_parquet import convert_lines
+
+    lines = [json.dumps(dict(SONG, song_id='SO{}'.format(i))).encode('utf-8')
+             for i in range(5)]
+    paths = convert_lines(lines, 'song_data', str(tmp_path), batch_rows=2,
+                          rows_per_file=4)
+
+    assert len(paths) == 2
+    rows = pq.read_table(str(tmp_path)).to_pylist()
+    assert [row['song_id'] for row in rows] == ['SO{}'.format(i)
+                                                for i in range(5)]
+    assert rows[0]['artist_location'] is None
+
+
+def test_converts_only_changed_partitions(config, tmp_path):
+    import copy
+    import os
+    import pyarrow.parquet as pq
+    from local_backend import LocalObjectStore
+    from convert_parquet import convert_to_s3
+
+    def write(key, records):
+        path = tmp_path / key
+        os.makedirs(str(path.parent), exist_ok=True)
+        path.write_text('\n'.join(json.dumps(r) for r in records))
+
+    def parquet_keys(dataset):
+        return sorted(obj['Key'] for obj in s3.list_objects_v2(
+            '', 'parquet/' + dataset + '/')['Contents'])
+
+    cfg = copy.deepcopy(config)
+    cfg['S3']['LOG_DATA'] = 's3://udacity-dend/log_data'
+    cfg['S3']['SONG_DATA'] = 's3://udacity-dend/song_data'
+    cfg['PARQUET']['PREFIX'] = 's3://sparkify-dwh-etl/parquet'
+    s3 = LocalObjectStore(str(tmp_path))
+    write('log_data/2018/11/a.json', [EVENT])
+    write('log_data/2018/12/b.json', [EVENT])
+    write('song_data/A/A/c.json', [SONG])
+    # Left over from converting the whole dataset at once
+    write('parquet/log_data/part-00000.parquet', [])
+
+    assert convert_to_s3(s3, cfg) == {
+        'log_data': {'converted': 2, 'skipped': 0},
+        'song_data': {'converted': 1, 'skipped': 0}}
+    logs = parquet_keys('log_data')
+    assert len(logs) == 2
+    assert pq.read_table(str(tmp_path / 'parquet/log_data')).num_rows == 2
+
+    write('log_data/2018/12/b.json', [EVENT, EVENT])
+    write('song_data/A/A/c.json', [SONG, SONG])
+    # Incremental runs load raw log files, so only songs are converted
+    assert convert_to_s3(s3, cfg, ['song_data']) == {
+        'song_data': {'converted': 1, 'skipped': 0}}
+    assert parquet_keys('log_data') == logs
+
+    assert convert_to_s3(s3, cfg) == {
+        'log_data': {'converted': 1, 'skipped': 1},
+        'song_data': {'converted': 0, 'skipped': 1}}
+    assert logs[0] in parquet_keys('log_data')
+    assert logs[1] not in parquet_keys('log_data')
+    assert pq.read_table(str(tmp_path / 'parquet/log_data')).num_rows == 3
@@ -0,0 +1,110 @@
+"""Defines tests for pooled connections, single-transaction phases and
+session settings."""
+import pytest
+from test_local_backend import local_config, count
+
+
+def test_pool_reuses_connections_and_rolls_back(local_config):
+    from db import connect, get_pool
+
+    conn = connect(local_config)
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE kept (x INTEGER)")
+    conn.commit()
+    cur.execute("INSERT INTO kept VALUES (1)")
+    conn.close()
+    with pytest.raises(Exception):
+        conn.cursor()
+
+    conn = connect(local_config)
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM kept")
+    assert cur.fetchone()[0] == 0
+    conn.close()
+
+    pool = get_pool(local_config)
+    assert (pool.opened, pool.reused) == (1, 1)
+
+
+def run_sequential(cfg, phases):
+    # etl() connects through scripts.db, so count commits on that pool
+    from scripts.db import get_pool
+    from create_tables import create_db_tables
+    from etl import etl
+
+    cfg['ETL']['PARALLEL_STAGING'] = 'false'
+    cfg['ETL']['PARALLEL_INSERTS'] = 'false'
+    cfg['CONNECTIONS']['SINGLE_TRANSACTION_PHASES'] = phases
+    pool = get_pool(cfg)
+    create_db_tables(True, cfg)
+    etl(True, cfg)
+    return pool.commits, pool.opened
+
+
+def test_single_transaction_phases_commit_once(local_config, project_dir):
+    single_commits, opened = run_sequential(
+        local_config, 'create_tables,staging,insert')
+    rows = {table: count(local_config, table)
+            for table in ('songplays', 'users', 'songs', 'load_state')}
+    assert rows == {'songplays': 2, 'users': 2, 'songs': 3, 'load_state': 1}
+    assert opened == 1
+
+    local_config['LOCAL']['DB_PATH'] += '.per_statement'
+    statement_commits, opened = run_sequential(local_config, '')
+    assert {table: count(local_config, table) for table in rows} == rows
+    assert single_commits < statement_commits
+
+
+def test_failed_insert_rolls_back_whole_phase(local_config, project_dir,
+                                              monkeypatch):
+    import etl as etl_module
+    from metrics import execute
+
+    def fail_users(cur, query, phase, report=None, name=None, params=None):
+        if 'INSERT INTO users' in query:
+            raise RuntimeError("users insert failed")
+        return execute(cur, query, phase, report, name, params)
+
+    monkeypatch.setattr(etl_module, 'execute', fail_users)
+    with pytest.raises(RuntimeError):
+        run_sequential(local_config, 'create_tables,staging,insert')
+    assert count(local_config, 'staging_events') == 3
+    assert count(local_config, 'songplays') == 0
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        self.executed.append(query)
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_applies_session_settings_of_phase(config):
+    from db import set_phase
+
+    wlm = dict(config['WLM'], ENABLED='true')
+    cfg = dict(config, WLM=wlm)
+    conn = RecordingConnection()
+    set_phase(conn, cfg, 'dashboard')
+    assert conn.executed[0].endswith(
+        "RESET enable_result_cache_for_session; "
+        "SET query_group TO 'dashboard'; SET wlm_query_slot_count TO 1; "
+        "SET statement_timeout TO 60000; "
+        "SET enable_result_cache_for_session TO on;")
+    assert conn.commits == 1
+
+    # Phases without settings go back to the cluster's defaults
+    set_phase(conn, cfg, 'blue_green')
+    assert conn.executed[1].startswith("RESET query_group;")
+    assert 'SET' not in conn.executed[1].replace('RESET', '')
+
+    set_phase(conn, dict(cfg, WLM=dict(wlm, ENABLED='false')), 'staging')
+    assert len(conn.executed) == 2
@@ -1,3 +1,109 @@
-import os
+"""Defines tests for the ETL pipeline.
+
+The DB connections are faked, so these tests never touch a real cluster.
+"""
+import threading
 import pytest
 
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query):
+        self.conn.executed.append(query)
+        if self.conn.barrier is not None:
+            # Only passes once another connection is executing too
+            self.conn.barrier.wait(timeout=5)
+        if self.conn.error is not None:
+            raise self.conn.error
+
+
+class FakeConnection:
+    def __init__(self, error=None, barrier=None):
+        self.error = error
+        self.barrier = barrier
+        self.executed = []
+        self.committed = False
+        self.rolled_back = False
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+COPIES = ["COPY staging_events FROM 's3://bucket/log_data';",
+          "COPY staging_songs FROM 's3://bucket/song_data';"]
+
+
+def test_runs_staging_copies_concurrently(aws_credentials, project_dir):
+    from etl import load_staging_tables_parallel
+
+    conns = []
+    barrier = threading.Barrier(2)
+
+    def connect_db():
+        conns.append(FakeConnection(barrier=barrier))
+        return conns[-1]
+
+    timings = load_staging_tables_parallel(connect_db, 2, COPIES)
+
+    assert set(timings) == {'staging_events', 'staging_songs'}
+    assert all(c.committed and c.closed for c in conns)
+
+
+def test_failed_copy_rolls_back_whole_phase(aws_credentials, project_dir):
+    from etl import load_staging_tables_parallel
+
+    conns = []
+
+    def connect_db():
+        error = ValueError("bad json") if len(conns) == 1 else None
+        conns.append(FakeConnection(error=error))
+        return conns[-1]
+
+    with pytest.raises(ValueError):
+        load_staging_tables_parallel(connect_db, 2, COPIES)
+
+    assert not any(c.committed for c in conns)
+    assert all(c.rolled_back and c.closed for c in conns)
+
+
+def test_copies_into_one_table_share_a_connection(aws_credentials,
+                                                  project_dir):
+    from etl import load_staging_tables_parallel
+
+    conns = []
+
+    def connect_db():
+        conns.append(FakeConnection())
+        return conns[-1]
+
+    queries = COPIES + ["COPY staging_songs FROM 's3://bucket/m1.manifest';"]
+    timings = load_staging_tables_parallel(connect_db, 2, queries)
+
+    assert len(conns) == 2
+    assert set(timings) == {'staging_events', 'staging_songs',
+                            'staging_songs[1]'}
+
+
+def test_match_key_join_inserts_same_songplays(config, project_dir,
+                                               tmp_path):
+    from benchmarks.etl_benchmark import generate_scale
+    from benchmarks.songplays_join import compare_songplays
+
+    result = compare_songplays(generate_scale(config, 1, str(tmp_path)))
+    assert result['equivalent']
+    assert result['after']['rows'] > 0
@@ -0,0 +1,63 @@
+"""Defines tests for the synthetic data generator and benchmark harness."""
+import os
+import json
+
+
+def read_tree(path):
+    files = {}
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name)) as f:
+                files[os.path.relpath(os.path.join(root, name), path)] = \
+                    f.read()
+    return files
+
+
+def test_same_seed_gives_same_files(tmp_path):
+    from generate_data import generate
+
+    generate(str(tmp_path / 'a'), seed=7, n_songs=20, n_events=50, days=3)
+    generate(str(tmp_path / 'b'), seed=7, n_songs=20, n_events=50, days=3)
+    generate(str(tmp_path / 'c'), seed=8, n_songs=20, n_events=50, days=3)
+
+    assert read_tree(str(tmp_path / 'a')) == read_tree(str(tmp_path / 'b'))
+    assert read_tree(str(tmp_path / 'a')) != read_tree(str(tmp_path / 'c'))
+
+
+def test_files_match_dataset_layout(tmp_path):
+    from generate_data import generate, LOG_FIELDS
+
+    summary = generate(str(tmp_path), n_songs=10, n_users=5, n_events=40,
+                       start='2018-11-30', days=2)
+    files = read_tree(str(tmp_path))
+
+    song_files = [p for p in files if p.startswith('song_data')]
+    log_files = sorted(p for p in files if p.startswith('log_data'))
+    assert len(song_files) == 10
+    assert summary['files'] == 12
+    assert log_files == [os.path.join('log_data', '2018', '11',
+                                      '2018-11-30-events.json'),
+                         os.path.join('log_data', '2018', '12',
+                                      '2018-12-01-events.json')]
+
+    song = json.loads(files[song_files[0]])
+    assert set(song) == {'num_songs', 'artist_id', 'artist_latitude',
+                         'artist_longitude', 'artist_location',
+                         'artist_name', 'song_id', 'title', 'duration',
+                         'year'}
+    events = [json.loads(line) for p in log_files
+              for line in files[p].splitlines()]
+    assert len(events) == 40
+    assert all(set(event) == set(LOG_FIELDS) for event in events)
+    assert any(event['page'] == 'NextSong' for event in events)
+
+
+def test_flags_regressions_against_baseline(project_dir):
+    from benchmarks.etl_benchmark import find_regressions
+
+    baseline = {'1': {'copy staging_songs': 1.0, 'insert songs': 0.01}}
+    results = {'1': {'copy staging_songs': 1.5, 'insert songs': 0.03,
+                     'insert times': 2.0}}
+
+    regressions = find_regressions(results, baseline, 0.25)
+    assert [r['step'] for r in regressions] == ['copy staging_songs']
@@ -0,0 +1,80 @@
+"""Defines tests for the table layout spec and the layout advisor."""
+
+DASHBOARD_QUERIES = [
+    """SELECT sp.songplay_id, sp.location, s.title, a.name
+    FROM songplays AS sp
+    JOIN songs AS s ON sp.song_id = s.song_id
+    JOIN artists AS a ON sp.artist_id = a.artist_id
+    WHERE a.name = 'Katy Perry'""",
+    """SELECT COUNT(songplays.songplay_id)
+    FROM songplays
+    JOIN times ON songplays.start_time = times.start_time
+    GROUP BY times.weekday""",
+]
+TABLE_ROWS = {'songplays': 300000, 'songs': 15000, 'artists': 10000,
+              'times': 8000, 'users': 100}
+
+
+def test_builds_layout_clause_from_spec():
+    from table_layout import layout_clause, create_table
+
+    assert layout_clause({'DISTKEY': 'song_id', 'SORTKEY': 'start_time'}) \
+        == 'DISTSTYLE KEY DISTKEY(song_id) SORTKEY(start_time)'
+    assert layout_clause({'DISTSTYLE': 'all', 'SORTKEY': 'a, b'}) == \
+        'DISTSTYLE ALL SORTKEY(a, b)'
+    assert create_table('t', '\n    a INTEGER\n') == \
+        '\nCREATE TABLE IF NOT EXISTS t (\n    a INTEGER\n);\n'
+
+
+def test_parses_joins_and_filters(project_dir):
+    from layout_advisor import parse_query
+
+    tables, joins, filters = parse_query(
+        DASHBOARD_QUERIES[0], {'songplays', 'songs', 'artists'})
+    assert tables == {'songplays', 'songs', 'artists'}
+    assert (('songplays', 'song_id'), ('songs', 'song_id')) in joins
+    assert filters == [('artists', 'name')]
+
+
+def test_recommends_collocated_fact_and_replicated_dims(project_dir):
+    from layout_advisor import analyze_workload, recommend
+    from sql_queries import table_columns
+
+    workload = analyze_workload(DASHBOARD_QUERIES, set(table_columns))
+    specs, reasons = recommend(TABLE_ROWS, workload, {},
+                               columns=table_columns)
+
+    assert specs['songplays'] == {'DISTKEY': 'song_id',
+                                  'SORTKEY': 'start_time'}
+    assert specs['songs'] == {'DISTKEY': 'song_id', 'SORTKEY': 'song_id'}
+    assert specs['times'] == {'DISTSTYLE': 'ALL', 'SORTKEY': 'start_time'}
+    assert specs['artists'] == {'DISTSTYLE': 'ALL', 'SORTKEY': 'name'}
+
+
+def test_large_dimensions_are_not_replicated(project_dir):
+    from layout_advisor import analyze_workload, recommend
+    from sql_queries import table_columns
+
+    workload = analyze_workload(DASHBOARD_QUERIES, set(table_columns))
+    specs, reasons = recommend(TABLE_ROWS, workload, {}, all_max_rows=9000,
+                               columns=table_columns)
+    assert specs['artists']['DISTSTYLE'] == 'EVEN'
+    assert specs['times']['DISTSTYLE'] == 'ALL'
+
+
+def test_keeps_profiled_columns_of_recommended_tables(project_dir):
+    from column_profiler import recommend_columns
+    from layout_advisor import analyze_workload, recommend
+    from sql_queries import table_columns
+
+    profiles = {'artists': {'rows': 2, 'columns': {
+        'name': {'type': 'TEXT', 'max_bytes': 10, 'distinct': 2}}}}
+    current = recommend_columns(profiles, {
+        'artists': {'DISTKEY': 'artist_id', 'SORTKEY': 'artist_id'}})
+    columns = current['artists']['COLUMNS']
+
+    workload = analyze_workload(DASHBOARD_QUERIES, set(table_columns))
+    specs, reasons = recommend(TABLE_ROWS, workload, current,
+                               columns=table_columns)
+    assert specs['artists'] == {'DISTSTYLE': 'ALL', 'SORTKEY': 'name',
+                                'COLUMNS': columns}
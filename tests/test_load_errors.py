@@ -0,0 +1,113 @@
+"""Defines tests for triaging the records COPY rejects."""
+import copy
+import json
+import pytest
+
+ROWS = [
+    ('s3://udacity-dend/log_data/2018/11/2018-11-01-events.json   ', 3,
+     'ts        ', 'int8      ', 0, 'yesterday', 1207,
+     'Invalid digit, Value \'y\', Pos 0, Type: Long    ',
+     '{"ts": "yesterday"}'),
+    ('s3://udacity-dend/log_data/2018/11/2018-11-01-events.json   ', 9,
+     'ts        ', 'int8      ', 0, '', 1207,
+     'Invalid digit, Value \'y\', Pos 0, Type: Long    ', '{"ts": "y"}'),
+    ('s3://udacity-dend/log_data/2018/11/2018-11-02-events.json   ', 1,
+     'userid    ', 'int4      ', 0, 'abc', 1207,
+     'Invalid digit, Value \'a\', Pos 0, Type: Integer ', '{"userId": "abc"}'),
+]
+
+
+class FakeCursor:
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def fetchone(self):
+        return (42,)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def load_errors_config(config, tmp_path, monkeypatch):
+    import load_errors
+
+    monkeypatch.setattr(load_errors, 'connect', lambda cfg: FakeConnection())
+    cfg = copy.deepcopy(config)
+    cfg['ETL']['BACKEND'] = 'redshift'
+    cfg['LOAD_ERRORS']['MAXERROR'] = {'staging_events': '3',
+                                      'staging_songs': '0'}
+    cfg['LOAD_ERRORS']['REPORT_DIR'] = str(tmp_path / 'load_errors')
+    return cfg
+
+
+def test_parses_and_summarizes_error_rows():
+    from load_errors import parse_load_errors, summarize
+
+    errors = parse_load_errors(ROWS)
+    assert errors[0]['colname'] == 'ts'
+    assert errors[0]['line_number'] == 3
+    assert errors[2]['raw_line'] == '{"userId": "abc"}'
+
+    summary = summarize(errors)
+    assert summary['rejected'] == 3
+    assert summary['by_reason'] == {
+        "Invalid digit, Value 'y', Pos 0, Type: Long": 2,
+        "Invalid digit, Value 'a', Pos 0, Type: Integer": 1}
+    assert summary['by_file'][
+        's3://udacity-dend/log_data/2018/11/2018-11-01-events.json'] == 2
+
+
+def test_quarantines_rejects_within_budget(load_errors_config):
+    from load_errors import LoadErrors
+    from metrics import RunReport
+
+    report = RunReport(run_id='run1')
+    errors = LoadErrors(load_errors_config, 'run1')
+    cur = FakeCursor(ROWS[:2])
+    assert len(errors.triage(cur, 'staging_events', 'staging_events',
+                             report)) == 2
+    assert 'INSERT INTO public.load_errors' in cur.executed[-1][0]
+    assert cur.executed[-1][1] == ('run1', 'staging_events', 42)
+    assert report.events[0]['rejected'] == 2
+
+    # A COPY without rejects quarantines nothing
+    cur = FakeCursor()
+    assert errors.triage(cur, 'staging_songs', 'staging_songs') == []
+    assert len(cur.executed) == 2
+
+    with open(errors.write_report()) as f:
+        written = json.load(f)
+    assert written['tables'] == {
+        'staging_events': {'budget': 3, 'rejected': 2},
+        'staging_songs': {'budget': 0, 'rejected': 0}}
+    assert written['copies']['staging_events']['errors'][1]['line_number'] \
+        == 9
+
+
+def test_fails_when_copies_of_a_table_exceed_its_budget(load_errors_config):
+    from load_errors import LoadErrors
+
+    errors = LoadErrors(load_errors_config, 'run1')
+    errors.triage(FakeCursor(ROWS[:2]), 'staging_events', 'staging_events')
+    with pytest.raises(RuntimeError, match='over its budget of 3'):
+        errors.triage(FakeCursor(ROWS[:2]), 'staging_events[1]',
+                      'staging_events')
+
+    with open(errors.report_path()) as f:
+        assert json.load(f)['tables']['staging_events']['rejected'] == 4
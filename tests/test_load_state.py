@@ -0,0 +1,76 @@
+"""Defines tests for incremental loading of new log files.
+
+VERY IMPORTANT: Use local Python imports in each test to ensure moto mocks
+established before clients are set up (avoiding potential actual AWS
+infrastructure modifications).
+"""
+import json
+
+
+class FakeCursor:
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def fetchall(self):
+        return self.rows
+
+
+def put_log_files(s3, keys):
+    s3.create_bucket(Bucket='udacity-dend')
+    for key in keys:
+        s3.put_object(Bucket='udacity-dend', Key=key, Body=b'{}\n')
+
+
+def test_lists_only_unloaded_log_files(s3):
+    from load_state import pending_objects
+
+    put_log_files(s3, ['log_data/2018/11/2018-11-01-events.json',
+                       'log_data/2018/11/2018-11-02-events.json'])
+    cur = FakeCursor([('log_data/2018/11/2018-11-01-events.json',)])
+
+    pending = pending_objects(cur, s3, 's3://udacity-dend/log_data')
+    assert pending == [('log_data/2018/11/2018-11-02-events.json', 3)]
+
+
+def test_records_loaded_keys_in_batches():
+    import load_state
+
+    cur = FakeCursor()
+    keys = ['log_data/{}.json'.format(i) for i in range(700)]
+    load_state.record_loaded_keys(cur, keys, replace=True)
+
+    assert cur.executed[0][0] == "DELETE FROM load_state;"
+    inserts = cur.executed[1:]
+    assert len(inserts) == 2
+    assert sum(len(params) for query, params in inserts) == 2 * len(keys)
+
+
+def test_incremental_run_copies_new_files_from_manifest(config, s3,
+                                                        project_dir):
+    from etl import plan_staging
+    from manifests import split_s3_url
+
+    put_log_files(s3, ['log_data/2018/11/2018-11-01-events.json',
+                       'log_data/2018/11/2018-11-02-events.json',
+                       'song_data/A/B/C/TRABCEI128F424C983.json'])
+    manifest_bucket, _ = split_s3_url(config['S3']['MANIFEST_PREFIX'])
+    s3.create_bucket(Bucket=manifest_bucket)
+    cur = FakeCursor([('log_data/2018/11/2018-11-01-events.json',)])
+
+    queries, keys = plan_staging(cur, config, full_refresh=False)
+
+    assert keys == ['log_data/2018/11/2018-11-02-events.json']
+    assert len(queries) == 2
+    assert 'MANIFEST' in queries[0]
+    assert queries[1].startswith('DELETE FROM staging_songs;')
+    manifest_url = queries[0].split("COPY staging_events FROM '")[1]
+    bucket, key = split_s3_url(manifest_url.split("'")[0])
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    assert manifest['entries'] == [{
+        'url': 's3://udacity-dend/log_data/2018/11/2018-11-02-events.json',
+        'mandatory': True,
+    }]
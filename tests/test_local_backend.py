@@ -0,0 +1,177 @@
+"""Defines tests for running the pipeline on the local DuckDB backend."""
+import os
+import copy
+import json
+import pytest
+
+JSONPATHS = {"jsonpaths": [
+    "$['artist']", "$['auth']", "$['firstName']", "$['gender']",
+    "$['itemInSession']", "$['lastName']", "$['length']", "$['level']",
+    "$['location']", "$['method']", "$['page']", "$['registration']",
+    "$['sessionId']", "$['song']", "$['status']", "$['ts']",
+    "$['userAgent']", "$['userId']"]}
+
+
+def event(user_id, ts, song='Song 0', artist='Artist 0', page='NextSong'):
+    return {"artist": artist, "auth": "Logged In", "firstName": "Kaylee",
+            "gender": "F", "itemInSession": 1, "lastName": "Summers",
+            "length": 200.5, "level": "free", "location": "Phoenix, AZ",
+            "method": "PUT", "page": page, "registration": 1540344794796.0,
+            "sessionId": 139, "song": song, "status": 200, "ts": ts,
+            "userAgent": "Mozilla/5.0", "userId": str(user_id)}
+
+
+def write_json(path, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('\n'.join(json.dumps(r) for r in records))
+
+
+@pytest.fixture(scope='function')
+def local_config(config, tmp_path):
+    cfg = copy.deepcopy(config)
+    cfg['ETL']['BACKEND'] = 'local'
+    cfg['ETL']['SONG_MANIFESTS'] = 'false'
+    cfg['LOCAL']['DATA_DIR'] = str(tmp_path / 'data')
+    cfg['LOCAL']['DB_PATH'] = str(tmp_path / 'sparkify.duckdb')
+    cfg['METRICS']['REPORT_DIR'] = str(tmp_path / 'reports')
+
+    data = tmp_path / 'data'
+    write_json(str(data / 'log_json_path.json'), [JSONPATHS])
+    for i in range(3):
+        write_json(str(data / 'song_data/A/A/TR{}.json'.format(i)), [{
+            "num_songs": 1, "artist_id": "AR{}".format(i),
+            "artist_latitude": None, "artist_longitude": None,
+            "artist_location": "", "artist_name": "Artist {}".format(i),
+            "song_id": "SO{}".format(i), "title": "Song {}".format(i),
+            "duration": 200.5, "year": 2000}])
+    write_json(str(data / 'log_data/2018/11/2018-11-01-events.json'), [
+        event(1, 1541106106796), event(2, 1541106206796, 'Song 1', 'Artist 1'),
+        event('', 1541106306796, None, None, page='Home')])
+    return cfg
+
+
+def count(cfg, table):
+    from db import connect
+
+    conn = connect(cfg)
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM " + table)
+    result = cur.fetchone()[0]
+    conn.close()
+    return result
+
+
+def test_translates_redshift_ddl():
+    from local_backend import translate
+
+    statements = translate("""
+    CREATE TABLE IF NOT EXISTS songplays (
+        songplay_id INTEGER IDENTITY(0,1) PRIMARY KEY SORTKEY DISTKEY,
+        song_id TEXT ENCODE zstd
+    )
+    diststyle all;""")
+
+    assert statements[0].startswith(
+        "CREATE SEQUENCE IF NOT EXISTS songplays_identity_seq START 0")
+    assert "DEFAULT nextval('songplays_identity_seq')" in statements[1]
+    for keyword in ['SORTKEY', 'DISTKEY', 'diststyle', 'ENCODE']:
+        assert keyword not in statements[1]
+
+
+def test_runs_full_pipeline_locally(local_config, project_dir):
+    from create_tables import create_db_tables
+    from etl import etl
+
+    create_db_tables(True, local_config)
+    report = etl(True, local_config)
+
+    assert count(local_config, 'staging_events') == 3
+    assert count(local_config, 'staging_songs') == 3
+    assert count(local_config, 'songplays') == 2
+    assert count(local_config, 'users') == 2
+    assert count(local_config, 'songs') == 3
+    assert count(local_config, 'load_state') == 1
+    copies = {entry['name']: entry['rowcount']
+              for entry in report.statements if entry['phase'] == 'staging'}
+    assert copies == {'COPY staging_events': 3, 'COPY staging_songs': 3}
+    assert os.listdir(local_config['METRICS']['REPORT_DIR']) == [
+        'run-{}.json'.format(report.run_id)]
+
+
+def test_full_refresh_replaces_existing_rows(local_config, project_dir):
+    from create_tables import create_db_tables
+    from etl import etl
+
+    create_db_tables(True, local_config)
+    etl(True, local_config)
+    etl(True, local_config)
+
+    assert count(local_config, 'songplays') == 2
+    assert count(local_config, 'users') == 2
+    assert count(local_config, 'songs') == 3
+    assert count(local_config, 'artists') == 3
+    assert count(local_config, 'load_state') == 1
+    assert count(local_config, 'plays_by_artist') == 2
+
+
+def test_incremental_run_appends_new_log_files(local_config, project_dir):
+    from create_tables import create_db_tables
+    from etl import etl
+
+    create_db_tables(True, local_config)
+    etl(True, local_config)
+    write_json(os.path.join(local_config['LOCAL']['DATA_DIR'],
+                            'log_data/2018/11/2018-11-02-events.json'),
+               [event(3, 1541206106796, 'Song 2', 'Artist 2')])
+    etl(False, local_config)
+
+    assert count(local_config, 'staging_events') == 1
+    assert count(local_config, 'songplays') == 3
+    assert count(local_config, 'users') == 3
+    assert count(local_config, 'songs') == 3
+    assert count(local_config, 'load_state') == 2
+
+    etl(False, local_config)
+    assert count(local_config, 'songplays') == 3
+
+
+def test_rerun_replaces_plays_of_a_failed_run(local_config, project_dir,
+                                              monkeypatch):
+    import etl as etl_module
+    from create_tables import create_db_tables
+    from etl import etl
+    from db import connect
+    from rollups import check_rollups
+
+    create_db_tables(True, local_config)
+    etl(True, local_config)
+    write_json(os.path.join(local_config['LOCAL']['DATA_DIR'],
+                            'log_data/2018/11/2018-11-02-events.json'),
+               [event(3, 1541206106796, 'Song 2', 'Artist 2')])
+
+    # users fails once songplays and the rollups have committed
+    steps = etl_module.incremental_insert_table_steps
+    dependencies = etl_module.incremental_insert_table_dependencies
+    monkeypatch.setattr(etl_module, 'incremental_insert_table_steps',
+                        dict(steps, users="SELECT * FROM no_such_table;"))
+    monkeypatch.setattr(etl_module, 'incremental_insert_table_dependencies',
+                        dict(dependencies, users=[
+                            step for step in steps
+                            if step.startswith('rollup_')]))
+    with pytest.raises(Exception):
+        etl(False, local_config)
+    assert count(local_config, 'songplays') == 3
+    assert count(local_config, 'load_state') == 1
+
+    monkeypatch.undo()
+    etl(False, local_config)
+    assert count(local_config, 'songplays') == 3
+    assert count(local_config, 'load_state') == 2
+
+    conn = connect(local_config)
+    cur = conn.cursor()
+    cur.execute("SELECT SUM(plays) FROM plays_by_level")
+    assert cur.fetchone()[0] == 3
+    assert not any(check_rollups(cur, local_config['ROLLUPS']).values())
+    conn.close()
@@ -0,0 +1,67 @@
+"""Defines tests for the post-load VACUUM/ANALYZE stage."""
+import psycopg2
+
+SETTINGS = {'ENABLED': 'true', 'UNSORTED_PCT': '10', 'STATS_OFF_PCT': '10',
+            'DELETED_PCT': '10', 'TIME_BUDGET_SECONDS': '60'}
+
+
+class FakeCursor:
+    def __init__(self, rows=None, cancel=()):
+        self.rows = rows or []
+        self.cancel = cancel
+        self.executed = []
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self.executed.append(query)
+        if any(table in query for table in self.cancel):
+            raise psycopg2.extensions.QueryCanceledError("timeout")
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_plans_actions_over_thresholds():
+    from maintenance import table_health, plan_maintenance
+
+    cur = FakeCursor([('songplays', 40.0, 5.0, 1000, 1000),
+                      ('users', 0.0, 50.0, 100, 100),
+                      ('staging_events', 0.0, 0.0, 1000, 500),
+                      ('songs', 2.0, 1.0, 100, 100)])
+    actions = plan_maintenance(table_health(cur), SETTINGS)
+
+    assert [a['statement'] for a in actions] == [
+        'ANALYZE users PREDICATE COLUMNS;',
+        'VACUUM DELETE ONLY staging_events;',
+        'VACUUM SORT ONLY songplays;']
+
+
+def test_skips_actions_past_the_time_budget():
+    from maintenance import run_maintenance
+    from metrics import RunReport
+
+    report = RunReport(run_id='test')
+    actions = [{'table': 'songplays', 'reason': 'unsorted',
+                'statement': 'VACUUM SORT ONLY songplays;'}]
+    results = run_maintenance(FakeCursor(), actions, 0, report)
+
+    assert results[0]['skipped'] == 'time budget used up'
+    assert report.events[0]['name'] == 'VACUUM SORT ONLY songplays;'
+
+
+def test_records_actions_and_timeouts():
+    from maintenance import run_maintenance
+    from metrics import RunReport
+
+    report = RunReport(run_id='test')
+    cur = FakeCursor(cancel=['songplays'])
+    actions = [{'table': 'songplays', 'reason': 'unsorted',
+                'statement': 'VACUUM SORT ONLY songplays;'},
+               {'table': 'users', 'reason': 'stats_off',
+                'statement': 'ANALYZE users PREDICATE COLUMNS;'}]
+    results = run_maintenance(cur, actions, 60, report)
+
+    assert results[0]['skipped'] == 'cut short by the time budget'
+    assert 'skipped' not in results[1]
+    assert [s['phase'] for s in report.statements] == ['maintenance'] * 2
+    assert cur.executed[-1] == "SET statement_timeout TO 0;"
@@ -0,0 +1,49 @@
+"""Defines tests for listing S3 inputs and building COPY manifests.
+
+VERY IMPORTANT: Use local Python imports in each test to ensure moto mocks
+established before clients are set up (avoiding potential actual AWS
+infrastructure modifications).
+"""
+
+
+def put_song_files(s3, count):
+    s3.create_bucket(Bucket='udacity-dend')
+    keys = []
+    for i in range(count):
+        key = 'song_data/{}/{}/TR{:04d}.json'.format(
+            'AB'[i % 2], 'ABC'[i % 3], i)
+        s3.put_object(Bucket='udacity-dend', Key=key, Body=b'x' * (i + 1))
+        keys.append(key)
+    return keys
+
+
+def test_parallel_listing_finds_every_object(s3):
+    from manifests import list_objects_parallel, list_objects
+
+    keys = put_song_files(s3, 30)
+    s3.put_object(Bucket='udacity-dend', Key='song_data/README', Body=b'')
+
+    objects = list_objects_parallel(s3, 's3://udacity-dend/song_data', 4)
+
+    assert [key for key, size in objects] == sorted(keys + ['song_data/README'])
+    assert objects == list_objects(s3, 's3://udacity-dend/song_data')
+
+
+def test_counts_slices_from_config(config):
+    from manifests import cluster_slices
+
+    assert cluster_slices(config) == 2 * int(config['CLUSTER']['NUM_NODES'])
+
+
+def test_manifests_hold_multiples_of_slice_count():
+    from manifests import build_slice_manifests
+
+    objects = [('song_data/{}.json'.format(i), 100 + i) for i in range(50)]
+    manifests, report = build_slice_manifests('udacity-dend', objects, 8, 20)
+
+    assert report['manifests'] == [16, 16, 16, 2]
+    assert report['files_per_slice'] == 50 / 8
+    assert report['max_slice_bytes'] - report['min_slice_bytes'] <= 149
+    urls = [e['url'] for m in manifests for e in m['entries']]
+    assert sorted(urls) == sorted(
+        's3://udacity-dend/' + key for key, size in objects)
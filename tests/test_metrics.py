@@ -0,0 +1,87 @@
+"""Defines tests for the per-statement run report."""
+import json
+import pytest
+
+
+class FakeCursor:
+    def __init__(self, rows=None, error=None):
+        self.rows = rows or {}
+        self.error = error
+        self.executed = []
+        self.rowcount = -1
+        self.result = None
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        if self.error is not None:
+            raise self.error
+        self.rowcount = 7
+        self.result = next((row for key, row in self.rows.items()
+                            if key in query), None)
+
+    def fetchone(self):
+        return self.result
+
+
+def test_names_statements_by_action_and_table():
+    from metrics import statement_name
+
+    assert statement_name("COPY staging_events FROM 's3://x'") == \
+        'COPY staging_events'
+    assert statement_name("DELETE FROM staging_songs; COPY staging_songs "
+                          "FROM 's3://x'") == 'COPY staging_songs'
+    assert statement_name("INSERT INTO songplays (start_time) SELECT 1") == \
+        'INSERT songplays'
+    assert statement_name("CREATE TABLE IF NOT EXISTS users (a INT)") == \
+        'CREATE users'
+
+
+def test_records_statements_and_calls_sinks():
+    from metrics import RunReport
+
+    seen = []
+    report = RunReport(run_id='test', sinks=[seen.append])
+    report.execute(FakeCursor(), "INSERT INTO users SELECT 1", 'insert')
+
+    assert report.statements[0]['name'] == 'INSERT users'
+    assert report.statements[0]['rowcount'] == 7
+    assert seen == report.statements
+
+
+def test_records_failed_statements():
+    from metrics import RunReport
+
+    report = RunReport(run_id='test')
+    with pytest.raises(ValueError):
+        report.execute(FakeCursor(error=ValueError('boom')),
+                       "COPY songs FROM 's3://x'", 'staging')
+    assert report.statements[0]['error'] == 'boom'
+
+
+def test_collects_redshift_load_stats():
+    from metrics import RunReport
+
+    cur = FakeCursor(rows={'pg_last_query_id': (42,),
+                           'stl_query': ('COPY', 't0', 't1', 0),
+                           'stl_load_commits': (3, 300, 4096)})
+    report = RunReport(run_id='test', redshift_stats=True)
+    entry = report.execute(cur, "COPY staging_songs FROM 's3://x'",
+                           'staging')
+
+    assert entry['query_id'] == 42
+    assert entry['load_commits'] == {'files': 3, 'lines': 300,
+                                     'bytes': 4096}
+    assert cur.executed[-1][1] == (42,)
+
+
+def test_writes_json_and_prometheus(tmp_path):
+    from metrics import RunReport
+
+    report = RunReport(run_id='test')
+    report.execute(FakeCursor(), "INSERT INTO users SELECT 1", 'insert')
+    report.finish()
+
+    with open(report.write_json(str(tmp_path))) as f:
+        assert json.load(f)['statements'][0]['rowcount'] == 7
+    assert 'sparkify_etl_statement_rows{phase="insert",' \
+        'statement="INSERT users"} 7' in report.to_prometheus()
@@ -0,0 +1,89 @@
+"""Defines tests for the query plan audit."""
+import copy
+import pytest
+
+COLLOCATED_PLAN = """XN Hash Join DS_DIST_NONE  (cost=112.50..3540.43 rows=6840 width=40)
+  Hash Cond: ("outer".song_key = "inner".song_key)
+  ->  XN Seq Scan on staging_events_keyed e  (cost=0.00..80.00 rows=8000 width=32)
+  ->  XN Hash  (cost=90.00..90.00 rows=9000 width=24)
+        ->  XN Seq Scan on staging_songs_keyed s  (cost=0.00..90.00 rows=9000 width=24)"""
+
+BROADCAST_PLAN = """XN Hash Join DS_BCAST_INNER  (cost=112.50..720003540.43 rows=6840 width=40)
+  Hash Cond: ("outer".song_key = "inner".song_key)
+  ->  XN Seq Scan on staging_events_keyed e  (cost=0.00..80.00 rows=8000 width=32)
+  ->  XN Hash  (cost=90.00..90.00 rows=9000 width=24)
+        ->  XN Seq Scan on staging_songs_keyed s  (cost=0.00..90.00 rows=9000 width=24)"""
+
+
+class FakeCursor:
+    def __init__(self, plan):
+        self.plan = plan
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append(query)
+
+    def fetchall(self):
+        return [(line,) for line in self.plan.split('\n')]
+
+
+@pytest.fixture
+def audit_config(config, tmp_path):
+    cfg = copy.deepcopy(config)
+    cfg['ETL']['BACKEND'] = 'redshift'
+    cfg['PLAN_AUDIT']['WORKLOAD'] = ''
+    cfg['PLAN_AUDIT']['STORE_DIR'] = str(tmp_path / 'plans')
+    return cfg
+
+
+def test_parses_joins_and_redistribution():
+    from plan_audit import parse_plan
+
+    plan = parse_plan(BROADCAST_PLAN.split('\n'))
+    assert plan['cost'] == 720003540.43
+    assert plan['rows'] == 6840
+    assert plan['joins'] == [{'operator': 'Hash Join',
+                              'distribution': 'DS_BCAST_INNER',
+                              'cost': 720003540.43}]
+    assert plan['redistribution'] == ['DS_BCAST_INNER']
+    assert parse_plan(COLLOCATED_PLAN.split('\n'))['redistribution'] == []
+
+
+def test_flags_new_redistribution_and_cost_jumps():
+    from plan_audit import parse_plan, find_regressions, failing
+
+    before = {'songplays': parse_plan(COLLOCATED_PLAN.split('\n'))}
+    after = {'songplays': parse_plan(BROADCAST_PLAN.split('\n')),
+             'users': parse_plan(BROADCAST_PLAN.split('\n'))}
+    regressions = find_regressions(
+        before, after, {'DS_BCAST_INNER': 'error'}, 3.0)
+
+    assert [(r['statement'], r['kind'], r['severity'])
+            for r in regressions] == [
+        ('songplays', 'DS_BCAST_INNER', 'error'),
+        ('songplays', 'COST_JUMP', 'warning')]
+    assert len(failing(regressions, 'error')) == 1
+    assert len(failing(regressions, 'warning')) == 2
+
+
+def test_preflight_stores_plans_and_fails_fast(audit_config):
+    from plan_audit import preflight, load_plans, schema_version
+    from sql_queries import songplay_staging_insert, \
+        songplay_table_append_staged
+
+    steps = {'songplays_staged': songplay_staging_insert,
+             'songplays': songplay_table_append_staged}
+    cur = FakeCursor(COLLOCATED_PLAN)
+    preflight(cur, audit_config, steps)
+    assert [query.split()[:2] for query in cur.executed] == [
+        ['EXPLAIN', 'DELETE'], ['EXPLAIN', 'INSERT']]
+    stored = load_plans(audit_config['PLAN_AUDIT']['STORE_DIR'],
+                        schema_version())
+    assert set(stored['plans']) == {'songplays_staged', 'songplays_staged[1]'}
+
+    with pytest.raises(RuntimeError, match='query plans regressed'):
+        preflight(FakeCursor(BROADCAST_PLAN), audit_config, steps)
+    # The failing capture does not replace the stored plans
+    stored = load_plans(audit_config['PLAN_AUDIT']['STORE_DIR'],
+                        schema_version())
+    assert stored['plans']['songplays_staged[1]']['redistribution'] == []
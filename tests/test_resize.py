@@ -0,0 +1,73 @@
+"""Defines tests for resizing the cluster around the ETL window.
+
+VERY IMPORTANT: Use local Python imports in each test to ensure moto mocks
+established before clients are set up (avoiding potential actual AWS
+infrastructure modifications).
+"""
+import copy
+
+MB = 1024 ** 2
+SETTINGS = {'ENABLED': 'true', 'MB_PER_NODE_MINUTE': '100',
+            'FIXED_MINUTES': '0', 'TARGET_MINUTES': '10', 'MAX_NODES': '8',
+            'RESIZE_MINUTES': '1', 'MAX_RESIZE_MINUTES': '30'}
+
+
+def test_picks_smallest_node_count_within_target():
+    from resize import plan_resize
+
+    plan = plan_resize(6000 * MB, 4, SETTINGS)
+    assert plan['nodes'] == 6
+    assert plan['base_minutes'] == 15
+    assert plan['minutes'] == 10
+
+    assert plan_resize(1000 * MB, 4, SETTINGS)['nodes'] == 4
+
+
+def test_resize_guardrails():
+    from resize import plan_resize
+
+    # Never more than double the usual node count, nor MAX_NODES
+    assert plan_resize(100000 * MB, 4, SETTINGS)['nodes'] == 8
+    assert plan_resize(100000 * MB, 4, dict(SETTINGS, MAX_NODES='5'))[
+        'nodes'] == 5
+    assert plan_resize(100000 * MB, 4, dict(SETTINGS, MAX_NODES='2'))[
+        'nodes'] == 4
+
+    # Saving 5 minutes does not pay for two 5 minute resizes
+    plan = plan_resize(6000 * MB, 4, dict(SETTINGS, RESIZE_MINUTES='5'))
+    assert plan['nodes'] == 4
+    assert plan['minutes'] == plan['base_minutes']
+
+
+def test_measures_pending_input_and_keeps_size(config, redshift, s3):
+    from resize import scale_up
+    from metrics import RunReport
+
+    cfg = copy.deepcopy(config)
+    cfg['AWS']['REGION'] = redshift.meta.region_name
+    cfg['RESIZE'] = dict(SETTINGS)
+    redshift.create_cluster(
+        ClusterIdentifier=cfg['CLUSTER']['IDENTIFIER'],
+        ClusterType='multi-node',
+        NumberOfNodes=int(cfg['CLUSTER']['NUM_NODES']),
+        NodeType=cfg['CLUSTER']['NODE_TYPE'],
+        MasterUsername=cfg['CLUSTER']['DB_USER'],
+        MasterUserPassword=cfg['CLUSTER']['DB_PASSWORD']
+    )
+    s3.create_bucket(Bucket='udacity-dend')
+    s3.put_object(Bucket='udacity-dend', Key='log_data/2018/11/a.json',
+                  Body=b'x' * 3000)
+    s3.put_object(Bucket='udacity-dend', Key='song_data/A/A/b.json',
+                  Body=b'x' * 1000)
+
+    report = RunReport()
+    assert scale_up(None, cfg, True, report) is None
+
+    event = report.events[0]
+    assert event['phase'] == 'resize'
+    assert event['log_bytes'] == 3000
+    assert event['song_bytes'] == 1000
+    assert event['nodes'] == int(cfg['CLUSTER']['NUM_NODES'])
+
+    cfg['RESIZE']['ENABLED'] = 'false'
+    assert scale_up(None, cfg, True) is None
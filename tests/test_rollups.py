@@ -0,0 +1,101 @@
+"""Defines tests for the incrementally maintained rollup tables."""
+import os
+import pytest
+from test_local_backend import local_config, write_json, event
+
+
+def fetch(cfg, query):
+    from db import connect
+
+    conn = connect(cfg)
+    cur = conn.cursor()
+    cur.execute(query)
+    result = cur.fetchall()
+    conn.close()
+    return result
+
+
+def test_builds_rollup_columns_from_references(project_dir):
+    from rollups import rollup_columns, rollup_dependencies
+    from sql_queries import table_columns
+
+    spec = {'GROUP_BY': 'songplays.song_id, songs.title, times.hour'}
+    columns = rollup_columns(spec, table_columns)
+
+    assert [line.split()[:2] for line in columns.strip().split(',\n')] == [
+        ['song_id', 'TEXT'], ['title', 'TEXT'], ['hour', 'INTEGER'],
+        ['plays', 'BIGINT']]
+    assert rollup_dependencies(spec) == ['songplays', 'songs', 'times']
+    with pytest.raises(ValueError):
+        rollup_columns({'GROUP_BY': 'users.gender'}, table_columns)
+    with pytest.raises(ValueError):
+        rollup_columns({'GROUP_BY': 'songs.artist_id, artists.artist_id'},
+                       table_columns)
+
+
+def test_merges_new_plays_into_rollups(local_config, project_dir):
+    from create_tables import create_db_tables
+    from etl import etl
+    from db import connect
+    from rollups import check_rollups
+
+    create_db_tables(True, local_config)
+    etl(True, local_config)
+    write_json(os.path.join(local_config['LOCAL']['DATA_DIR'],
+                            'log_data/2018/11/2018-11-02-events.json'),
+               [event(3, 1541106106796), event(4, 1541206106796,
+                                               'Song 2', 'Artist 2')])
+    etl(False, local_config)
+
+    assert fetch(local_config, "SELECT load_version, COUNT(*) FROM songplays "
+                               "GROUP BY 1 ORDER BY 1") == [(1, 2), (2, 2)]
+    assert fetch(local_config, "SELECT name, plays FROM plays_by_artist "
+                               "ORDER BY name") == [
+        ('Artist 0', 2), ('Artist 1', 1), ('Artist 2', 1)]
+    assert fetch(local_config, "SELECT SUM(plays) FROM plays_by_hour") == \
+        [(4,)]
+
+    conn = connect(local_config)
+    cur = conn.cursor()
+    assert not any(check_rollups(cur, local_config['ROLLUPS']).values())
+    cur.execute("UPDATE plays_by_level SET plays = plays + 1;")
+    mismatches = check_rollups(cur, local_config['ROLLUPS'])
+    conn.close()
+    assert mismatches['plays_by_level'] == [(('free',), 5, 4), (None, 5, 4)]
+    assert not mismatches['plays_by_hour']
+
+
+def test_counts_each_play_once_per_dimension_key(local_config,
+                                                 project_dir):
+    from create_tables import create_db_tables
+    from etl import etl
+
+    # The song data spells Artist 0 a second way
+    write_json(os.path.join(local_config['LOCAL']['DATA_DIR'],
+                            'song_data/A/A/TR3.json'), [{
+        "num_songs": 1, "artist_id": "AR0", "artist_latitude": None,
+        "artist_longitude": None, "artist_location": "",
+        "artist_name": "Artist Zero", "song_id": "SO3", "title": "Song 3",
+        "duration": 200.5, "year": 2000}])
+    create_db_tables(True, local_config)
+    etl(True, local_config)
+
+    assert fetch(local_config, "SELECT COUNT(*) FROM artists "
+                               "WHERE artist_id = 'AR0'") == [(2,)]
+    assert fetch(local_config, "SELECT artist_id, name, plays "
+                               "FROM plays_by_artist ORDER BY 1") == [
+        ('AR0', 'Artist Zero', 1), ('AR1', 'Artist 1', 1)]
+    assert fetch(local_config, "SELECT SUM(plays) FROM plays_by_song") == \
+        [(2,)]
+
+
+def test_sample_rollups_match_recomputation(config, project_dir, tmp_path):
+    from generate_data import generate
+    from rollups import check_sample
+
+    generate(str(tmp_path / 'data'), seed=3, n_songs=30, n_users=10,
+             n_events=300, days=4)
+    mismatches = check_sample(config, str(tmp_path / 'data'), loads=3)
+
+    assert set(mismatches) == set(config['ROLLUPS'])
+    assert not any(mismatches.values())
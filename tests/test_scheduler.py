@@ -0,0 +1,66 @@
+"""Defines tests for the dependency-aware step scheduler."""
+import time
+import pytest
+
+
+def test_runs_independent_steps_concurrently():
+    from scheduler import run_dag
+
+    steps = {name: 0.2 for name in ['a', 'b', 'c']}
+    start = time.time()
+    timeline = run_dag(steps, {}, lambda step, delay: time.sleep(delay), 3)
+
+    assert time.time() - start < 0.35
+    assert {entry['step'] for entry in timeline} == {'a', 'b', 'c'}
+
+
+def test_waits_for_dependencies_and_reports_critical_path():
+    from scheduler import run_dag, critical_path
+
+    steps = {'stage': 0.1, 'dim': 0.0, 'fact': 0.05}
+    dependencies = {'fact': ['stage', 'dim']}
+    timeline = run_dag(steps, dependencies,
+                       lambda step, delay: time.sleep(delay), 3)
+    entries = {entry['step']: entry for entry in timeline}
+
+    assert entries['fact']['start'] >= entries['stage']['end']
+    assert entries['fact']['ready'] >= entries['stage']['end']
+    assert critical_path(timeline, dependencies) == ['stage', 'fact']
+
+
+def test_rejects_dependency_cycles():
+    from scheduler import run_dag
+
+    with pytest.raises(ValueError):
+        run_dag({'a': 0, 'b': 0}, {'a': ['b'], 'b': ['a']},
+                lambda step, payload: None, 2)
+
+
+def test_failed_step_stops_its_dependents():
+    from scheduler import run_dag
+
+    ran = []
+
+    def run_step(step, payload):
+        ran.append(step)
+        if step == 'stage':
+            raise RuntimeError("COPY failed")
+
+    with pytest.raises(RuntimeError):
+        run_dag({'stage': 0, 'fact': 0}, {'fact': ['stage']}, run_step, 2)
+    assert ran == ['stage']
+
+
+def test_failed_step_stops_steps_waiting_for_a_worker():
+    from scheduler import run_dag
+
+    ran = []
+
+    def run_step(step, payload):
+        ran.append(step)
+        if step == 'a':
+            raise RuntimeError("insert failed")
+
+    with pytest.raises(RuntimeError):
+        run_dag({'a': 0, 'b': 0, 'c': 0}, {}, run_step, 1)
+    assert ran == ['a']
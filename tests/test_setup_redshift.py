@@ -4,6 +4,7 @@ VERY IMPORTANT: Use local Python imports in each test to ensure moto mocks
 established before clients are set up (avoiding potential actual AWS
 infrastructure modifications).
 """
+import json
 
 
 def test_creates_iam_role_and_attaches_policy(config, iam):
@@ -35,4 +36,79 @@ def test_confirms_cluster_available(config, redshift, cluster, monkeypatch):
 
     monkeypatch.setattr(time, 'sleep', sleep)
     result = confirm_cluster_available(config, redshift)
-    assert result == 'available'
\ No newline at end of file
+    assert result == 'available'
+
+
+def test_polls_with_growing_delay_until_deadline(monkeypatch):
+    from helpers import poll
+    import time
+
+    clock = {'now': 0.0}
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock['now'] += seconds
+
+    monkeypatch.setattr(time, 'time', lambda: clock['now'])
+    monkeypatch.setattr(time, 'sleep', sleep)
+
+    assert poll(lambda: False, 100, initial_delay=5, max_delay=30) is False
+    assert sleeps == [5, 10, 20, 30, 30, 5]
+
+    sleeps.clear()
+    calls = iter([None, None, 'available'])
+    assert poll(lambda: next(calls), 100, initial_delay=5) == 'available'
+    assert sleeps == [5, 10]
+
+
+def test_setup_resumes_after_partial_failure(region_config, iam, redshift):
+    from setup_redshift import setup_redshift_cluster, create_iam_role
+
+    config = region_config
+
+    # A previous run that failed after creating the role
+    create_iam_role(config, iam)
+
+    assert setup_redshift_cluster() == 'available'
+    assert setup_redshift_cluster() == 'available'
+
+    with open('dwh_config.json') as f:
+        saved = json.load(f)
+    assert saved['CLUSTER']['HOST'] == redshift.describe_clusters(
+        ClusterIdentifier=config['CLUSTER']['IDENTIFIER']
+    )['Clusters'][0]['Endpoint']['Address']
+    policies = iam.list_attached_role_policies(
+        RoleName=config['IAM_ROLE']['NAME'])['AttachedPolicies']
+    assert [p['PolicyName'] for p in policies] == [
+        config['IAM_ROLE']['POLICY_NAME']]
+
+
+def test_checks_wlm_phases_have_queues(config):
+    from setup_redshift import wlm_config_problems
+
+    assert wlm_config_problems(config) == []
+
+    wlm = dict(config['WLM'], PHASES={
+        'staging': {'QUERY_GROUP': 'etl', 'SLOT_COUNT': '9'},
+        'dashboard': {'QUERY_GROUP': 'bi', 'SLOT_COUNT': '1'}})
+    assert wlm_config_problems(dict(config, WLM=wlm)) == [
+        "Phase staging takes 9 slots, more than the 4 of its queue",
+        "No WLM queue has query group 'bi' of phase dashboard"]
+
+
+def test_creates_cluster_in_wlm_parameter_group(config, redshift):
+    from setup_redshift import start_redshift_cluster, check_cluster_wlm
+
+    config = dict(config, WLM=dict(config['WLM'], ENABLED='true'))
+    redshift.create_cluster_parameter_group(
+        ParameterGroupName=config['WLM']['PARAMETER_GROUP'],
+        ParameterGroupFamily='redshift-1.0', Description='test')
+    start_redshift_cluster(config, redshift,
+                           "arn:aws:iam::711914867513:role/dwhRole")
+
+    cluster = redshift.describe_clusters(
+        ClusterIdentifier=config['CLUSTER']['IDENTIFIER'])['Clusters'][0]
+    assert cluster['ClusterParameterGroups'][0]['ParameterGroupName'] == \
+        config['WLM']['PARAMETER_GROUP']
+    assert check_cluster_wlm(config, redshift) == 'in-sync'
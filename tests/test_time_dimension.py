@@ -0,0 +1,68 @@
+"""Defines tests for the generated time dimension."""
+import os
+from datetime import datetime, timedelta
+import numpy as np
+from test_local_backend import local_config, write_json, event, count
+
+SETTINGS = {'GRAIN': 'hour', 'START_DATE': '2018-11-01',
+            'END_DATE': '2018-12-01', 'LOOKAHEAD_DAYS': '7'}
+
+
+def test_builds_calendar_columns_like_redshift(project_dir):
+    from time_dimension import time_rows
+
+    keys = np.arange(0, 24 * 365 * 50, 37, dtype=np.int64)
+    rows = time_rows(keys, 'h')
+    for i in range(0, len(keys), 97):
+        start = datetime(1970, 1, 1) + timedelta(hours=int(keys[i]))
+        assert [rows[column][i] for column in
+                ('start_time', 'hour', 'day', 'week', 'month', 'year',
+                 'weekday')] == [
+            start.strftime('%Y-%m-%d %H:%M:%S'), start.hour, start.day,
+            start.isocalendar()[1], start.month, start.year,
+            start.isoweekday() % 7]
+
+
+def test_extends_range_only_past_loaded_rows(project_dir):
+    from time_dimension import target_range, missing_keys
+
+    november = target_range(SETTINGS, (None, None))
+    assert november[1] - november[0] == 30 * 24
+    assert len(missing_keys(november, (None, None))) == 30 * 24
+    covered = (november[0], november[1] - 1)
+    assert len(missing_keys(november, covered)) == 0
+
+    # A play on the last day runs the range a week past it
+    target = target_range(SETTINGS, (datetime(2018, 11, 2),
+                                     datetime(2018, 12, 2, 5, 30)))
+    assert len(missing_keys(target, covered)) == 24 + 6 + 7 * 24
+
+    day = target_range(dict(SETTINGS, GRAIN='day'), (None, None))
+    assert day[1] - day[0] == 30
+
+
+def test_songplays_join_generated_hours(local_config, project_dir):
+    from create_tables import create_db_tables
+    from etl import etl
+    from db import connect
+
+    create_db_tables(True, local_config)
+    etl(True, local_config)
+    assert count(local_config, 'times') == 30 * 24
+
+    write_json(os.path.join(local_config['LOCAL']['DATA_DIR'],
+                            'log_data/2018/12/2018-12-02-events.json'),
+               [event(3, 1543708800000, 'Song 2', 'Artist 2')])
+    etl(False, local_config)
+    assert count(local_config, 'times') == 30 * 24 + 24 + 1 + 7 * 24
+
+    conn = connect(local_config)
+    cur = conn.cursor()
+    cur.execute("""SELECT times.start_time, times.hour, times.weekday
+                   FROM songplays
+                   JOIN times ON times.time_key = songplays.time_key
+                   ORDER BY songplays.start_time""")
+    assert cur.fetchall() == [(datetime(2018, 11, 1, 21), 21, 4),
+                              (datetime(2018, 11, 1, 21), 21, 4),
+                              (datetime(2018, 12, 2), 0, 0)]
+    conn.close()
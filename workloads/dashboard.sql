@@ -0,0 +1,16 @@
+-- Queries run by dashboard.ipynb, for `scripts/layout_advisor.py -w`
+
+SELECT sp.songplay_id, sp.location, s.title, a.name
+FROM songplays AS sp
+JOIN songs AS s ON sp.song_id = s.song_id
+JOIN artists AS a ON sp.artist_id = a.artist_id
+WHERE a.name = 'Katy Perry';
+
+SELECT weekday, plays
+FROM plays_by_weekday
+ORDER BY weekday;
+
+SELECT name, plays
+FROM plays_by_artist
+ORDER BY plays DESC
+LIMIT 10;